@@ -0,0 +1,338 @@
+from a2wsgi import WSGIMiddleware
+from hedge import HEDGE_READS, hedger
+from network import finished, HTTPMethods, POOL_MAXSIZE, POOL_SOURCE_ADDRESS, requests_sent, stats_lock, UnicastResponse
+from selector import selector
+from starlette.applications import Starlette
+from starlette.requests import ClientDisconnect
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from werkzeug.exceptions import BadRequest
+import asyncio
+import clock
+import concurrent.futures
+import httpx
+import json
+import kvs
+import network
+import os
+import time
+
+# Entry point for ASGI servers.  The key routes are served natively on the
+# event loop, so waiting for causal dependencies, replication acks or a
+# forwarded request doesn't hold a thread.  Every other route is served by
+# the Flask app, on a2wsgi's thread pool.  Reading and applying keys take
+# locks and write to the log, so they run on a pool of their own, never on
+# the loop.  Like wsgi.py, run a single worker process, since all node state
+# lives in kvs's globals:
+#
+#     uvicorn asgi:app --workers 1 --host 0.0.0.0 --port 8080
+
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'content-length', 'host'}
+BLOCKING_WORKERS = int(os.environ.get('ASGI_BLOCKING_WORKERS', 32)) # Threads reading and applying keys for the event loop.
+
+client = None # Created on the event loop by get_client().
+blocking_executor = concurrent.futures.ThreadPoolExecutor(BLOCKING_WORKERS, thread_name_prefix='asgi-blocking')
+
+
+async def run_blocking(fn, *args):
+    # Runs fn on the blocking pool, so its locks and fsyncs don't stall the loop.
+    return await asyncio.get_running_loop().run_in_executor(blocking_executor, fn, *args)
+
+
+def get_client():
+    global client
+    if client is None:
+        limits = httpx.Limits(max_keepalive_connections=POOL_MAXSIZE * len(kvs.replicas_view_universe))
+        transport = httpx.AsyncHTTPTransport(limits=limits, local_address=POOL_SOURCE_ADDRESS) if POOL_SOURCE_ADDRESS else None
+        client = httpx.AsyncClient(limits=limits, timeout=None, transport=transport)
+    return client
+
+
+async def unicast(address, address_to_uri, http_method=HTTPMethods.GET, timeout=None, data=None, headers=None):
+    """
+    Same as network.unicast, on the event loop.
+    """
+    uri = address_to_uri(address)
+
+    delay, drop = network.data_path_jitter(address) # Looked up on every send, as set_jitter_policy() rebinds it.
+    if delay > 0:
+        await asyncio.sleep(delay)
+    if drop:
+        return UnicastResponse(uri, address, None)
+
+    with stats_lock:
+        requests_sent[address] += 1
+
+    selector.started(address)
+    start = time.monotonic()
+    try:
+        resp = await get_client().request(http_method.name, uri, timeout=timeout, content=data, headers=headers)
+    except (httpx.TimeoutException, httpx.TransportError):
+        resp = None
+    except asyncio.CancelledError: # A hedged read that lost.
+        selector.cancelled(address)
+        raise
+    except Exception:
+        finished(address, time.monotonic() - start, None)
+        raise
+    finished(address, time.monotonic() - start, resp)
+
+    return UnicastResponse(uri, address, resp)
+
+
+def json_response(obj, status=200):
+    # Serialized like Flask's jsonify, so both modes answer byte for byte the same.
+    return Response(kvs.app.json.dumps(obj, separators=(',', ':')) + '\n', status_code=status, media_type='application/json')
+
+
+def respond(result):
+    res, status = result
+    return json_response(kvs.with_metadata(res), status)
+
+
+async def get_json(request, silent=False):
+    """
+    Raises:
+        ValueError: If the body isn't JSON, unless silent, which returns
+                    None instead.
+    """
+    try:
+        return json.loads(await request.body())
+    except ValueError:
+        if silent:
+            return None
+        raise
+
+
+def bad_request():
+    # What the Flask app answers a body that isn't JSON.
+    error = BadRequest()
+    return Response(error.get_body(), status_code=error.code, media_type='text/html')
+
+
+async def hedged_send(shard_id, shard, send):
+    """
+    Same as hedge.Hedger.send, on the event loop, where the losing read is
+    actually cancelled.
+    """
+    async def timed_send(address):
+        start = time.monotonic()
+        response = await send(address)
+        hedger.record(shard_id, time.monotonic() - start)
+        return response
+
+    hedger.started()
+    first = selector.choose(shard)
+    pending = {asyncio.ensure_future(timed_send(first))}
+    done, pending = await asyncio.wait(pending, timeout=hedger.delay(shard_id))
+
+    hedge = None
+    others = [a for a in shard if a != first]
+    if not any(kvs.valid_read(t.result()) for t in done) and others and hedger.take_hedge():
+        hedge = asyncio.ensure_future(timed_send(selector.choose(others)))
+        pending.add(hedge)
+
+    response = None
+    while True:
+        for t in done:
+            response = t.result()
+            if kvs.valid_read(response):
+                for p in pending:
+                    p.cancel()
+                if t is hedge:
+                    hedger.hedge_won()
+                return response
+        if not pending:
+            return response
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+
+async def forward_request(request, shard_id, key, handoff=False):
+    shard = sorted(kvs.shard_view_alive[shard_id])
+    if (len(shard) == 0):
+        return Response('', status_code=418)
+
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+    if handoff:
+        headers[kvs.HANDOFF_HEADER] = '1'
+    http_method = HTTPMethods[request.method]
+    data = await request.body()
+
+    async def send(address):
+        return (await unicast(
+            address,
+            lambda a: 'http://' + a + kvs.route('/' + key),
+            http_method=http_method,
+            data=data,
+            headers=headers
+        )).response
+
+    if HEDGE_READS and http_method == HTTPMethods.GET:
+        response = await hedged_send(shard_id, shard, send)
+    else:
+        response = await send(selector.choose(shard))
+
+    if response is None:
+        raise kvs.ShardNoResponse
+    headers = {k: v for k, v in response.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+    return Response(response.content, status_code=response.status_code, headers=headers)
+
+
+async def forward_get(request, shard_id, key):
+    """
+    Same as kvs.forward_get.
+    """
+    cached = kvs.cached_remote_read(shard_id, key, await get_json(request, silent=True))
+    if cached is not None:
+        kvs.key_requests.inc('GET', 'cached')
+        return Response(cached.body, status_code=cached.status, media_type='application/json')
+
+    kvs.key_requests.inc('GET', 'forwarded')
+    started = kvs.remote_cache.begin()
+    forwarded = await forward_request(request, shard_id, key)
+    kvs.cache_remote_read(shard_id, key, started, forwarded.body, forwarded.status_code)
+    return forwarded
+
+
+async def wait_for_causal_metadata(json_data):
+    """
+    Same as kvs.wait_for_causal_metadata, awaiting instead of blocking.
+    """
+    incoming_vec = kvs.causal_dependencies(json_data)
+    if incoming_vec is None:
+        return True
+
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    def wake():
+        loop.call_soon_threadsafe(lambda: ready.done() or ready.set_result(True))
+
+    start = time.monotonic()
+    waiter = kvs.causal_waiters.add(lambda: kvs.first_missing_dependency(incoming_vec), wake)
+    try:
+        await asyncio.wait_for(asyncio.shield(ready), kvs.CAUSAL_WAIT_TIMEOUT)
+        delivered = True
+    except asyncio.TimeoutError:
+        kvs.causal_waiters.remove(waiter)
+        delivered = ready.done()
+    kvs.causal_wait.observe(time.monotonic() - start, 'delivered' if delivered else 'timed_out')
+    return delivered
+
+
+async def wait_for_replication(offset):
+    """
+    Same as kvs.wait_for_replication, awaiting instead of blocking.
+    """
+    count = kvs.replication_acks_required(offset)
+    if count is None:
+        return
+
+    loop = asyncio.get_running_loop()
+    acked = loop.create_future()
+    def wake(result):
+        loop.call_soon_threadsafe(lambda: acked.done() or acked.set_result(result))
+
+    start = time.monotonic()
+    waiter = kvs.replication_log.add_waiter(offset, count, wake)
+    try:
+        done = await asyncio.wait_for(asyncio.shield(acked), kvs.REPLICATION_ACK_TIMEOUT)
+    except asyncio.TimeoutError:
+        kvs.replication_log.remove_waiter(waiter)
+        done = acked.done() and acked.result()
+    kvs.replication_waited(offset, count, time.monotonic() - start, done)
+
+
+async def kvs_get(request):
+    key = request.path_params['key']
+    kvs.update_replicas_view_alive()
+
+    if kvs.HANDOFF_HEADER in request.headers:
+        kvs.key_requests.inc('GET', 'handoff')
+        return respond(await run_blocking(kvs.attempt_get_message, key))
+
+    stale = kvs.stale_shard_map(request.headers)
+    if stale is not None:
+        return respond(stale)
+
+    hashed_id = kvs.key_to_shard_id(key)
+    my_id = kvs.get_my_id()
+    if hashed_id != my_id:
+        return await forward_get(request, hashed_id, key)
+
+    kvs.key_requests.inc('GET', 'local')
+    if not await wait_for_causal_metadata(await get_json(request, silent=True)):
+        return respond((kvs.format_result('Error in GET', error=kvs.CAUSAL_WAIT_TIMED_OUT), 503))
+
+    previous_shard_id = kvs.migration.previous_shard_id(key)
+    if key not in kvs.store and previous_shard_id not in (None, my_id):
+        try:
+            forwarded = await forward_request(request, previous_shard_id, key, handoff=True)
+            if forwarded.status_code != 404 or key not in kvs.store:
+                return forwarded
+        except kvs.ShardNoResponse:
+            pass
+    return respond(await run_blocking(kvs.attempt_get_message, key))
+
+
+async def kvs_write(request):
+    key = request.path_params['key']
+    http_method = HTTPMethods[request.method]
+    error_message = 'Error in ' + http_method.name
+    kvs.update_replicas_view_alive()
+
+    stale = kvs.stale_shard_map(request.headers)
+    if stale is not None:
+        return respond(stale)
+
+    hashed_id = kvs.key_to_shard_id(key)
+    my_id = kvs.get_my_id()
+    if hashed_id != my_id:
+        kvs.key_requests.inc(http_method.name, 'forwarded')
+        return await forward_request(request, hashed_id, key)
+
+    incoming_addr = request.client.host
+    try:
+        json_data = await get_json(request, silent=http_method == HTTPMethods.DELETE) # Deletes may have no body.
+    except ValueError:
+        return bad_request()
+    if incoming_addr == kvs.my_address_no_port:
+        # Ignore messages sent from itself
+        return respond((kvs.format_result('Discarded'), 200))
+    elif incoming_addr not in kvs.shard_view_universe_no_port[my_id]:
+        kvs.key_requests.inc(http_method.name, 'local')
+        if not await wait_for_causal_metadata(json_data):
+            return respond((kvs.format_result(error_message, error=kvs.CAUSAL_WAIT_TIMED_OUT), 503))
+        offset, out = await run_blocking(kvs.apply_client_write, http_method, key, json_data)
+        await wait_for_replication(offset)
+        return respond(out)
+    else:
+        incoming_vec = clock.decode(request.headers.get('VC'))
+        kvs.key_requests.inc(http_method.name, 'replicated')
+        return respond(await run_blocking(kvs.receive_update, http_method, key, json_data, incoming_vec, incoming_addr))
+
+
+def timed(handler):
+    """
+    Records the latency of a key route served on the event loop, like
+    kvs.record_latency does for the Flask routes.
+    """
+    async def timed_handler(request):
+        start = time.monotonic()
+        response = await handler(request)
+        kvs.request_latency.observe(time.monotonic() - start, kvs.route('/<key>'), request.method, str(response.status_code))
+        return response
+    return timed_handler
+
+
+async def client_disconnected(request, exc):
+    # Usually a hedged read cancelled by its sender, as the other one answered first.
+    return Response('', status_code=499)
+
+
+kvs.startup()
+
+app = Starlette(routes=[
+    Route(kvs.route('/{key}'), timed(kvs_get), methods=['GET']),
+    Route(kvs.route('/{key}'), timed(kvs_write), methods=['PUT', 'DELETE']),
+    Mount('/', app=WSGIMiddleware(kvs.app))
+], exception_handlers={ClientDisconnect: client_disconnected})
@@ -0,0 +1,483 @@
+from bisect import bisect_left
+from collections import Counter, defaultdict
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+# Benchmarks a cluster of local processes:
+#
+#     python bench.py --nodes 6 --shards 2 --duration 30 --output results.json
+#
+# Nodes identify each other by IP address, so each one listens on its own
+# loopback address (127.0.0.2, 127.0.0.3, ...), which Linux routes without
+# any setup.  Other systems need those addresses aliased first.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+READY_TIMEOUT = 60 # Seconds to wait for nodes to start serving.
+SCENARIO_TIMEOUT = 120 # Seconds to wait for a reshard, failure detection or recovery.
+POLL_INTERVAL = 0.1 # Seconds between checks while waiting.
+REQUEST_TIMEOUT = 30
+PERCENTILES = {'p50': 0.5, 'p99': 0.99, 'p999': 0.999}
+REGRESSION_TOLERANCE = 0.1 # Relative change flagged when comparing runs.
+
+
+class Cluster:
+    """
+    Nodes started as local processes with SOCKET_ADDRESS, VIEW and
+    SHARD_COUNT set, each in its own directory, where its write-ahead log
+    and kvs.log go.  The directories are removed when the cluster stops.
+
+    Args:
+        server (str): 'gunicorn' or 'asgi', as SERVER_MODE in startup.sh.
+        env (dict): Extra environment variables for every node.
+        keep (bool): Keeps the directories, to look at the logs.
+    """
+
+    def __init__(self, nodes, shards, server='gunicorn', first_ip=2, port=8080, env=None, keep=False):
+        self.addresses = [f'127.0.0.{first_ip + i}:{port}' for i in range(nodes)]
+        self.shards = shards
+        self.server = server
+        self.env = env or {}
+        self.keep = keep
+        self.directory = tempfile.mkdtemp(prefix='kvs-bench-')
+        self.processes = {}
+
+    def node_directory(self, address):
+        path = os.path.join(self.directory, address.replace(':', '_'))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def command(self, address):
+        host, port = address.split(':')
+        if self.server == 'asgi':
+            return [sys.executable, '-m', 'uvicorn', 'asgi:app', '--workers', '1', '--timeout-keep-alive', '30',
+                    '--host', host, '--port', port, '--no-access-log']
+        return [sys.executable, '-m', 'gunicorn', '--workers', '1', '--worker-class', 'gthread', '--threads', '32',
+                '--keep-alive', '30', '--bind', address, 'wsgi:app']
+
+    def start_node(self, address):
+        env = dict(os.environ, **self.env)
+        env.update({
+            'SOCKET_ADDRESS': address,
+            'VIEW': ','.join(self.addresses),
+            'SHARD_COUNT': str(self.shards),
+            'POOL_SOURCE_ADDRESS': address.split(':')[0],
+            'PYTHONPATH': os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')]))
+        })
+        directory = self.node_directory(address)
+        with open(os.path.join(directory, 'kvs.log'), 'a') as log:
+            self.processes[address] = subprocess.Popen(
+                self.command(address), cwd=directory, env=env, stdout=log, stderr=subprocess.STDOUT,
+                start_new_session=True # So kill_node() also kills gunicorn's worker.
+            )
+
+    def kill_node(self, address):
+        process = self.processes.pop(address)
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.wait()
+
+    def start(self):
+        for address in self.addresses:
+            self.start_node(address)
+        wait_until(lambda: all(is_serving(a) for a in self.addresses), READY_TIMEOUT, 'nodes to start serving')
+
+    def stop(self):
+        for address in list(self.processes):
+            self.kill_node(address)
+        if not self.keep:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def wait_until(condition, timeout, what):
+    """
+    Polls condition until it's true.
+
+    Returns:
+        float: Seconds it took.
+    """
+    start = time.monotonic()
+    while not condition():
+        if time.monotonic() - start > timeout:
+            raise TimeoutError(f'Timed out waiting for {what}')
+        time.sleep(POLL_INTERVAL)
+    return time.monotonic() - start
+
+
+def get_json(address, path):
+    try:
+        response = requests.get('http://' + address + path, timeout=REQUEST_TIMEOUT)
+    except requests.exceptions.RequestException:
+        return None
+    return response.json() if response.status_code == 200 else None
+
+
+def is_serving(address):
+    return get_json(address, '/key-value-store-shard/node-shard-id') is not None
+
+
+def view(address):
+    body = get_json(address, '/key-value-store-view')
+    return set(body['view'].split(',')) if body is not None else None
+
+
+class Zipf:
+    """
+    Draws ranks 0 to n - 1, rank k with probability proportional to
+    1 / (k + 1) ** s.  s = 0 is uniform; s around 1 is typical of caches and
+    web workloads.
+    """
+
+    def __init__(self, n, s):
+        total = 0
+        self.cdf = []
+        for k in range(n):
+            total += 1 / (k + 1) ** s
+            self.cdf.append(total)
+        self.total = total
+
+    def sample(self, rng):
+        return min(bisect_left(self.cdf, rng.random() * self.total), len(self.cdf) - 1)
+
+
+def merge_metadata(a, b):
+    """
+    Returns:
+        str: The entrywise max of two causal metadata strings.
+    """
+    if not a or not b:
+        return a or b
+    merged = json.loads(a)
+    for replica, entry in json.loads(b).items():
+        merged[replica] = max(merged.get(replica, 0), entry)
+    return json.dumps(merged, sort_keys=True, separators=(',', ':'))
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+    summary = {name: ordered[min(len(ordered) - 1, int(len(ordered) * q))] for name, q in PERCENTILES.items()}
+    summary['mean'] = sum(ordered) / len(ordered)
+    summary['count'] = len(ordered)
+    return summary
+
+
+class Workload:
+    """
+    Clients sending GETs, PUTs and DELETEs to random nodes, on keys drawn
+    from a Zipf distribution.
+
+    Each client sends the causal metadata of its last response with its
+    next request, so its requests are chained causally.  With share > 0, it
+    also merges in the metadata of another random client before a request
+    with that probability, as if the clients talked to each other, which
+    chains requests across clients and shards.
+    """
+
+    def __init__(self, addresses, keys=1000, zipf=0.99, reads=0.8, deletes=0.0, value_size=16,
+                 clients=16, causal=True, share=0.0, seed=0):
+        self.addresses = addresses
+        self.keys = keys
+        self.zipf = Zipf(keys, zipf)
+        self.reads = reads
+        self.deletes = deletes
+        self.value = 'x' * value_size
+        self.clients = clients
+        self.causal = causal
+        self.share = share
+        self.seed = seed
+        self.metadata = [''] * clients # Each client's last causal metadata.
+
+    def preload(self):
+        """
+        Writes every key once, so reads don't all miss.
+        """
+        def load(client):
+            session = requests.Session()
+            for k in range(client, self.keys, self.clients):
+                session.put(
+                    f'http://{self.addresses[k % len(self.addresses)]}/key-value-store/key{k}',
+                    json={'value': self.value, 'causal-metadata': ''},
+                    timeout=REQUEST_TIMEOUT
+                )
+        threads = [threading.Thread(target=load, args=(c,)) for c in range(self.clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def run_client(self, client, deadline, latencies, statuses):
+        rng = random.Random(self.seed * 1000003 + client)
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            if self.share > 0 and rng.random() < self.share:
+                self.metadata[client] = merge_metadata(self.metadata[client], self.metadata[rng.randrange(self.clients)])
+
+            r = rng.random()
+            method = 'GET' if r < self.reads else ('DELETE' if r < self.reads + self.deletes else 'PUT')
+            body = {'causal-metadata': self.metadata[client] if self.causal else ''}
+            if method == 'PUT':
+                body['value'] = self.value
+            url = f'http://{rng.choice(self.addresses)}/key-value-store/key{self.zipf.sample(rng)}'
+
+            start = time.perf_counter()
+            try:
+                response = session.request(method, url, json=body, timeout=REQUEST_TIMEOUT)
+            except requests.exceptions.RequestException:
+                statuses['connection error'] += 1
+                session = requests.Session()
+                continue
+            latencies[method].append(time.perf_counter() - start)
+            statuses[str(response.status_code)] += 1
+
+            if self.causal and response.status_code < 500:
+                try:
+                    self.metadata[client] = response.json().get('causal-metadata') or self.metadata[client]
+                except ValueError:
+                    pass
+
+    def run(self, duration):
+        """
+        Returns:
+            dict: Throughput, latency percentiles per method, and the count
+                  of each status.
+        """
+        per_client = [(defaultdict(list), Counter()) for _ in range(self.clients)]
+        deadline = time.monotonic() + duration
+        threads = [
+            threading.Thread(target=self.run_client, args=(c, deadline) + per_client[c])
+            for c in range(self.clients)
+        ]
+        start = time.monotonic()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.monotonic() - start
+
+        latencies = defaultdict(list)
+        statuses = Counter()
+        for client_latencies, client_statuses in per_client:
+            for method, values in client_latencies.items():
+                latencies[method].extend(values)
+            statuses.update(client_statuses)
+        ops = sum(len(values) for values in latencies.values())
+        return {
+            'ops': ops,
+            'seconds': elapsed,
+            'throughput': ops / elapsed,
+            'latency': {method: percentiles(values) for method, values in sorted(latencies.items())},
+            'all_latency': percentiles([v for values in latencies.values() for v in values]),
+            'statuses': dict(statuses)
+        }
+
+
+def measure_failure_detection(cluster, victim):
+    """
+    Kills a node, and times until every other node dropped it from its view.
+    """
+    others = [a for a in cluster.addresses if a != victim]
+    cluster.kill_node(victim)
+    start = time.monotonic()
+    detected = {}
+    def all_detected():
+        for address in others:
+            if address not in detected:
+                current = view(address)
+                if current is not None and victim not in current:
+                    detected[address] = time.monotonic() - start
+        return len(detected) == len(others)
+    seconds = wait_until(all_detected, SCENARIO_TIMEOUT, f'{victim} to be detected as down')
+    return {'node': victim, 'seconds': seconds, 'first': min(detected.values()), 'per_node': detected}
+
+
+def measure_restart_recovery(cluster, victim):
+    """
+    Restarts a killed node, and times until it serves, every node has it in
+    its view again, and its store matches the other members of its shard.
+    """
+    start = time.monotonic()
+    cluster.start_node(victim)
+    serving = wait_until(lambda: is_serving(victim), SCENARIO_TIMEOUT, f'{victim} to serve')
+
+    def recovered():
+        if any(victim not in (view(a) or ()) for a in cluster.addresses):
+            return False
+        shard_map = get_json(victim, '/key-value-store-shard')
+        if shard_map is None:
+            return False
+        peers = next((s for s in shard_map['shard_view_universe'] if victim in s), [])
+        dumps = [get_json(a, '/key-value-store') for a in peers]
+        return all(d is not None and d['store'] == dumps[0]['store'] for d in dumps)
+    wait_until(recovered, SCENARIO_TIMEOUT, f'{victim} to recover')
+    return {'node': victim, 'seconds': time.monotonic() - start, 'serving_after': serving}
+
+
+def measure_reshard(cluster, shard_count):
+    """
+    Reshards, and times until every node moved to the new shard view and
+    finished moving keys.
+    """
+    start = time.monotonic()
+    response = requests.put(
+        f'http://{cluster.addresses[0]}/key-value-store-shard/reshard',
+        json={'shard-count': shard_count},
+        timeout=SCENARIO_TIMEOUT
+    )
+    acknowledged = time.monotonic() - start
+    if response.status_code != 200:
+        return {'shard_count': shard_count, 'error': response.json().get('message')}
+    version = get_json(cluster.addresses[0], '/key-value-store-shard')['version']
+
+    statuses = {}
+    def done():
+        for address in cluster.addresses:
+            statuses[address] = get_json(address, '/key-value-store-shard/reshard-status')
+        return all(s is not None and s['version'] >= version and s['state'] in ('idle', 'done') for s in statuses.values())
+    wait_until(done, SCENARIO_TIMEOUT, 'the reshard to finish')
+    return {
+        'shard_count': shard_count,
+        'seconds': time.monotonic() - start,
+        'acknowledged_after': acknowledged,
+        'keys_moved': sum(s.get('keys_moved', 0) for s in statuses.values()),
+        'bytes_moved': sum(s.get('bytes_moved', 0) for s in statuses.values())
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def comparable(results):
+    """
+    Returns:
+        dict: The numbers to compare between runs, by name, with whether
+              higher is better.
+    """
+    numbers = {}
+    workload = results.get('workload')
+    if workload:
+        numbers['throughput'] = (workload['throughput'], True)
+        for method, summary in workload['latency'].items():
+            for name in PERCENTILES:
+                numbers[f'{method} {name}'] = (summary[name], False)
+    for scenario in ('failure_detection', 'restart_recovery', 'reshard'):
+        if results.get(scenario, {}).get('seconds') is not None:
+            numbers[f'{scenario} seconds'] = (results[scenario]['seconds'], False)
+    return numbers
+
+
+def compare(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """
+    Returns:
+        list: Descriptions of the numbers that got worse than the baseline's
+              by more than tolerance.
+    """
+    regressions = []
+    current = comparable(results)
+    for name, (before, higher_is_better) in comparable(baseline).items():
+        if name not in current or before == 0:
+            continue
+        after = current[name][0]
+        change = (after - before) / before
+        worse = change < -tolerance if higher_is_better else change > tolerance
+        print(f'{name:32} {before:12.6g} -> {after:12.6g} ({change:+.1%}){"  REGRESSION" if worse else ""}')
+        if worse:
+            regressions.append(f'{name}: {before:.6g} -> {after:.6g}')
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks a cluster of local nodes.')
+    parser.add_argument('--nodes', type=int, default=6)
+    parser.add_argument('--shards', type=int, default=2)
+    parser.add_argument('--server', choices=['gunicorn', 'asgi'], default='gunicorn')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='Set for every node.')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run the workload for.')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--keys', type=int, default=1000)
+    parser.add_argument('--zipf', type=float, default=0.99, help='Key skew, 0 for uniform.')
+    parser.add_argument('--reads', type=float, default=0.8, help='Share of GETs.')
+    parser.add_argument('--deletes', type=float, default=0.0, help='Share of DELETEs.  The rest are PUTs.')
+    parser.add_argument('--value-size', type=int, default=16)
+    parser.add_argument('--no-causal', dest='causal', action='store_false', help="Don't send causal metadata.")
+    parser.add_argument('--share', type=float, default=0.0, help="Chance a client first merges another's metadata.")
+    parser.add_argument('--no-preload', dest='preload', action='store_false')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenarios', default='workload,failure,restart,reshard',
+                        help='Comma separated: workload, failure, restart and reshard.')
+    parser.add_argument('--reshard-to', type=int, help='Shard count to reshard to, by default one more if possible.')
+    parser.add_argument('--output', help='File to write the results to, as JSON.')
+    parser.add_argument('--keep', action='store_true', help="Keep the nodes' directories, with their logs.")
+    parser.add_argument('--baseline', help='Results of an earlier run to compare with.')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = args.scenarios.split(',')
+    env = dict(e.split('=', 1) for e in args.env)
+
+    results = {'config': vars(args), 'commit': git_commit(), 'started': time.time()}
+    cluster = Cluster(args.nodes, args.shards, args.server, env=env, keep=args.keep)
+    print(f'Starting {args.nodes} nodes in {cluster.directory}')
+    try:
+        cluster.start()
+        victim = cluster.addresses[-1]
+
+        if 'workload' in scenarios:
+            workload = Workload(
+                cluster.addresses, keys=args.keys, zipf=args.zipf, reads=args.reads, deletes=args.deletes,
+                value_size=args.value_size, clients=args.clients, causal=args.causal, share=args.share, seed=args.seed
+            )
+            if args.preload:
+                workload.preload()
+            results['workload'] = workload.run(args.duration)
+            print(f"Workload: {results['workload']['throughput']:.1f} ops/s, {results['workload']['statuses']}")
+
+        if 'failure' in scenarios or 'restart' in scenarios:
+            results['failure_detection'] = measure_failure_detection(cluster, victim)
+            print(f"Failure detected in {results['failure_detection']['seconds']:.2f}s")
+            results['restart_recovery'] = measure_restart_recovery(cluster, victim)
+            print(f"Restarted node recovered in {results['restart_recovery']['seconds']:.2f}s")
+
+        if 'reshard' in scenarios:
+            shard_count = args.reshard_to
+            if shard_count is None:
+                shard_count = args.shards + 1 if args.nodes >= 2 * (args.shards + 1) else max(1, args.shards - 1)
+            results['reshard'] = measure_reshard(cluster, shard_count)
+            print(f"Reshard: {results['reshard']}")
+    finally:
+        cluster.stop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print('Regressions:\n  ' + '\n  '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
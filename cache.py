@@ -0,0 +1,161 @@
+from collections import namedtuple, OrderedDict
+import logging
+import os
+import threading
+import time
+
+REMOTE_CACHE_SIZE = int(os.environ.get('REMOTE_CACHE_SIZE', 10000)) # Other shards' keys cached, 0 to disable.
+REMOTE_CACHE_TTL = float(os.environ.get('REMOTE_CACHE_TTL', 10)) # Seconds a cached read is served for.
+INVALIDATION_LINGER = float(os.environ.get('CACHE_INVALIDATION_LINGER', 0.005)) # Seconds to batch invalidations for.
+
+CachedRead = namedtuple('CachedRead', ['shard_id', 'body', 'status', 'vector_clock', 'expires'])
+
+logger = logging.getLogger(__name__)
+
+
+class RemoteCache:
+    """
+    LRU cache of the answers to GETs we forwarded to other shards.
+
+    Each answer is tagged with the vector clock the owning shard answered
+    with, and only served to requests whose causal metadata it satisfies:
+    the clock must be at least as far along as the metadata on every member
+    of that shard.  Entries expire after REMOTE_CACHE_TTL seconds, and are
+    dropped as soon as the owning shard tells us the key was written.
+
+    A read may race with the invalidation of a write it didn't see, so
+    reads are started with begin(), and put() ignores answers to reads
+    started before their key's last invalidation.
+    """
+
+    def __init__(self, capacity=REMOTE_CACHE_SIZE, ttl=REMOTE_CACHE_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict() # Key to its CachedRead, least recently used first.
+        self.invalidated = OrderedDict() # Key to the sequence number of its last invalidation.
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.causal_misses = 0 # Cached, but older than the request's causal metadata.
+        self.expirations = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.capacity > 0
+
+    def get(self, key, shard_id, incoming_vec, shard_members):
+        """
+        Args:
+            incoming_vec (dict): The request's causal metadata, or None.
+            shard_members (iterable): Addresses, without port, of the
+                                      members of the key's shard.
+
+        Returns:
+            CachedRead: The cached answer, or None if there's none we can serve.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.shard_id != shard_id:
+                self.misses += 1
+                return None
+            if entry.expires <= time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            if incoming_vec is not None and any(entry.vector_clock.get(a, 0) < incoming_vec.get(a, 0) for a in shard_members):
+                self.causal_misses += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def begin(self):
+        with self.lock:
+            return self.sequence
+
+    def put(self, key, shard_id, body, status, vector_clock, started):
+        with self.lock:
+            if self.invalidated.get(key, -1) >= started:
+                return
+            self.entries[key] = CachedRead(shard_id, body, status, vector_clock, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                if self.entries.pop(key, None) is not None:
+                    self.invalidations += 1
+                self.invalidated[key] = self.sequence
+                self.invalidated.move_to_end(key)
+            self.sequence += 1
+            # Reads outlive neither the TTL nor thousands of invalidations.
+            while len(self.invalidated) > max(self.capacity, 1000):
+                self.invalidated.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0,
+                'causal_misses': self.causal_misses,
+                'expirations': self.expirations,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+
+class InvalidationFeed:
+    """
+    Tells the other shards which of our keys were written, so they drop
+    them from their RemoteCache.  Keys are batched for INVALIDATION_LINGER
+    seconds and sent in one request by a single sender thread.  Delivery is
+    best effort: the TTL bounds how long a lost invalidation matters.
+
+    Args:
+        send (function): Called as send(keys) with a batch of keys.
+    """
+
+    def __init__(self, send, linger=INVALIDATION_LINGER):
+        self.send = send
+        self.linger = linger
+        self.pending = set()
+        self.cond = threading.Condition()
+        self.sender = None
+
+    def start(self):
+        self.sender = threading.Thread(target=self.run, daemon=True)
+        self.sender.start()
+
+    def add(self, key):
+        with self.cond:
+            self.pending.add(key)
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            time.sleep(self.linger)
+            with self.cond:
+                keys, self.pending = self.pending, set()
+            try:
+                self.send(sorted(keys))
+            except Exception:
+                logger.exception('Failed to send cache invalidations')
@@ -0,0 +1,93 @@
+from collections import defaultdict
+import threading
+
+
+class CausalWaiters:
+    """
+    Requests waiting for our vector clock to catch up with their causal
+    metadata.
+
+    Each waiter is filed under one clock entry it's still missing, and is
+    only re-checked when that entry advances, or when membership changes
+    what deliverable means.  A re-checked waiter either fires or is filed
+    under the next entry it's missing.
+
+    Waiters are described by a function returning an entry (address) the
+    waiter is still missing, or None once it can proceed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiting = defaultdict(list) # Address to the waiters missing its clock entry.
+
+    def add(self, first_missing, callback):
+        """
+        Calls callback once first_missing returns None, which may be right
+        away.  Entries must be advanced before advanced() is called for them.
+
+        Returns:
+            list: A handle to pass to remove().
+        """
+        waiter = [first_missing, callback]
+        with self.lock:
+            missing = first_missing()
+            if missing is not None:
+                self.waiting[missing].append(waiter)
+                return waiter
+        callback()
+        return waiter
+
+    def remove(self, waiter):
+        with self.lock:
+            for waiters in self.waiting.values():
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                    return
+
+    def recheck(self, waiters):
+        # Caller holds the lock.  Returns the callbacks of waiters that can proceed.
+        ready = []
+        for waiter in waiters:
+            missing = waiter[0]()
+            if missing is None:
+                ready.append(waiter[1])
+            else:
+                self.waiting[missing].append(waiter)
+        return ready
+
+    def advanced(self, address):
+        """
+        Re-checks the waiters missing address's clock entry.
+        """
+        with self.lock:
+            if not self.waiting.get(address):
+                return
+            ready = self.recheck(self.waiting.pop(address))
+        for callback in ready:
+            callback()
+
+    def changed(self):
+        """
+        Re-checks every waiter, after the clock was replaced or membership
+        changed.
+        """
+        with self.lock:
+            waiters = [waiter for waiters in self.waiting.values() for waiter in waiters]
+            self.waiting.clear()
+            ready = self.recheck(waiters)
+        for callback in ready:
+            callback()
+
+    def wait(self, first_missing, timeout):
+        """
+        Blocks until first_missing returns None.
+
+        Returns:
+            bool: False if we timed out first.
+        """
+        event = threading.Event()
+        waiter = self.add(first_missing, event.set)
+        if event.wait(timeout):
+            return True
+        self.remove(waiter)
+        return event.is_set()
@@ -0,0 +1,131 @@
+from hashring import HashRing, VNODES_PER_SHARD
+from network import HTTPMethods, unicast
+from selector import selector
+import json
+import random
+import threading
+
+SHARD_VIEW_VERSION_HEADER = 'X-Shard-View-Version' # Shard map version a client routed the request with.
+STALE_SHARD_MAP = 421 # Status nodes answer a request routed with an older shard map with.
+DEFAULT_TIMEOUT = 10 # Seconds to wait for a node.
+MAX_ATTEMPTS = 3 # Times a request is routed again after refreshing the shard map.
+
+
+class NoNodeResponse(Exception):
+    pass
+
+
+class KVSClient:
+    """
+    Client sending each key request straight to a member of the key's shard,
+    instead of to any node which then forwards it, saving a hop.
+
+    It fetches the shard map from GET /key-value-store-shard, keeps it, and
+    hashes keys onto the same consistent-hash ring as the nodes.  Requests
+    carry the map's version, and nodes answer STALE_SHARD_MAP if it's older
+    than theirs, in which case we fetch it again, drop the causal metadata
+    of the previous shard view, and retry.  Connections are pooled per
+    node, and the causal metadata of every response is merged into the
+    metadata sent with the next request, so a client sees its own writes
+    and their causal dependencies, whichever shard it talks to.  Safe to
+    share between threads.
+
+    Args:
+        addresses (iterable): Addresses of nodes to fetch the shard map from.
+        timeout (float): Seconds to wait for a node.
+    """
+
+    def __init__(self, addresses, timeout=DEFAULT_TIMEOUT):
+        self.addresses = sorted(addresses)
+        self.timeout = timeout
+        self.version = None
+        self.shards = None
+        self.ring = None
+        self.vector_clock = {} # Merged causal metadata of every response.
+        self.lock = threading.Lock()
+
+        self.refresh()
+
+    def refresh(self):
+        """
+        Fetches the shard map from the first node that answers.
+        """
+        for address in random.sample(self.addresses, len(self.addresses)):
+            response = unicast(address, lambda a: 'http://' + a + '/key-value-store-shard', timeout=self.timeout).response
+            if response is None or response.status_code != 200:
+                continue
+            shard_map = response.json()
+            with self.lock:
+                if self.version is not None and shard_map['version'] < self.version:
+                    continue # That node hasn't resharded yet.
+                if shard_map['version'] != self.version:
+                    self.vector_clock = {} # Vector clocks restart with every shard view.
+                self.version = shard_map['version']
+                self.shards = [sorted(shard) for shard in shard_map['shard_view_universe']]
+                self.ring = HashRing(len(self.shards), shard_map.get('vnodes', VNODES_PER_SHARD))
+                self.addresses = sorted(set(self.addresses).union(*self.shards))
+            return
+        raise NoNodeResponse
+
+    def shard_members(self, key):
+        with self.lock:
+            return self.version, self.shards[self.ring.get_shard_id(key)]
+
+    def causal_metadata(self):
+        with self.lock:
+            return json.dumps(self.vector_clock, sort_keys=True, separators=(',', ':')) if self.vector_clock else ''
+
+    def merge_causal_metadata(self, metadata):
+        if not metadata:
+            return
+        incoming = json.loads(metadata)
+        with self.lock:
+            for address, counter in incoming.items():
+                self.vector_clock[address] = max(self.vector_clock.get(address, 0), counter)
+
+    def request(self, http_method, key, body=None):
+        """
+        Sends a key request to a member of the key's shard, trying the
+        others if it doesn't answer.
+
+        Returns:
+            requests.Response: The node's response.
+        """
+        for _ in range(MAX_ATTEMPTS):
+            version, members = self.shard_members(key)
+            data = json.dumps(dict(body or {}, **{'causal-metadata': self.causal_metadata()}))
+            headers = {'Content-Type': 'application/json', SHARD_VIEW_VERSION_HEADER: str(version)}
+
+            response = None
+            first = selector.choose(members)
+            for address in [first] + [a for a in random.sample(members, len(members)) if a != first]:
+                response = unicast(
+                    address,
+                    lambda a: 'http://' + a + '/key-value-store/' + key,
+                    http_method=http_method,
+                    timeout=self.timeout,
+                    data=data,
+                    headers=headers
+                ).response
+                if response is not None:
+                    break
+
+            if response is None or response.status_code == STALE_SHARD_MAP:
+                # The shard moved or is down: its members may have changed.
+                self.refresh()
+                continue
+            try:
+                self.merge_causal_metadata(response.json().get('causal-metadata'))
+            except ValueError:
+                pass
+            return response
+        raise NoNodeResponse
+
+    def get(self, key):
+        return self.request(HTTPMethods.GET, key)
+
+    def put(self, key, value):
+        return self.request(HTTPMethods.PUT, key, {'value': value})
+
+    def delete(self, key):
+        return self.request(HTTPMethods.DELETE, key)
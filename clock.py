@@ -0,0 +1,81 @@
+from functools import lru_cache
+import ipaddress
+import json
+
+
+@lru_cache(maxsize=4096)
+def replica_id(address):
+    """
+    Returns:
+        str: The integer form of an IP address, which names the replica in
+             encoded clocks.  It's shorter than the address, and unlike an
+             index into the view, it doesn't change when the view does.
+             Host names are kept as they are.
+    """
+    try:
+        return str(int(ipaddress.ip_address(address)))
+    except ValueError:
+        return address
+
+
+@lru_cache(maxsize=4096)
+def replica_address(replica):
+    if replica.isdigit():
+        return str(ipaddress.ip_address(int(replica)))
+    return replica
+
+
+def encode(vector_clock, addresses=None):
+    """
+    Encodes the entries of a vector clock for the given addresses, all of
+    them by default.  Zero entries are left out, as they don't order
+    anything, so the encoding only grows with the writes of one shard
+    rather than with the cluster.
+
+    Returns:
+        str: The encoded clock, such as {"2130706434":3,"2130706436":1}.
+    """
+    if addresses is None:
+        addresses = vector_clock
+    entries = sorted((replica_id(a), vector_clock.get(a, 0)) for a in addresses)
+    return json.dumps({replica: entry for replica, entry in entries if entry}, separators=(',', ':'))
+
+
+def decode(encoded):
+    """
+    Decodes what encode() returns.  Also accepts clocks that were already
+    decoded, or keyed by address, as clients from before may still send.
+
+    Returns:
+        dict: Maps address, without port, to its entry.  Missing entries are 0.
+    """
+    if isinstance(encoded, str):
+        encoded = json.loads(encoded) if encoded else {}
+    return {replica_address(replica): entry for replica, entry in encoded.items()}
+
+
+class EncodedClock:
+    """
+    Our clock's encoding, reused until the clock or our shard's members
+    change.  Every response carries it, and most responses follow reads,
+    which change neither.
+
+    Writers call changed() after changing the clock.  Shard members are
+    compared by identity, as views are replaced rather than changed.
+    """
+
+    def __init__(self):
+        self.generation = 0
+        self.cached = (None, None, None) # Generation, members and encoding.
+
+    def changed(self):
+        self.generation += 1
+
+    def get(self, vector_clock, members):
+        generation, cached_members, encoded = self.cached
+        if generation == self.generation and cached_members is members:
+            return encoded
+        generation = self.generation
+        encoded = encode(vector_clock, members)
+        self.cached = (generation, members, encoded)
+        return encoded
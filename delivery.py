@@ -0,0 +1,168 @@
+from collections import defaultdict
+import os
+import shelve
+import threading
+import time
+
+
+MAX_IN_MEMORY = int(os.environ.get('DELIVERY_BUFFER_MAX_IN_MEMORY', 10000)) # Messages kept in memory before spilling.
+SPILL_FILENAME = os.environ.get('DELIVERY_BUFFER_SPILL_FILENAME', '.delivery_buffer.spill')
+LAG_SMOOTHING = 0.1 # Weight of the latest delivery in the average delivery lag.
+
+
+class DeliveryBuffer:
+    """
+    Messages received out of causal order, indexed by sender and by the
+    sender's clock entry in the message.
+
+    A message from a sender is only deliverable once we delivered every
+    earlier message from that sender, so after each delivery we only need
+    to look up each sender's next clock entry instead of scanning the whole
+    buffer.  Past MAX_IN_MEMORY messages, the ones furthest from being
+    delivered are spilled to disk and loaded back as their turn comes.
+
+    Messages are [incoming_vec, [op, sender, key, (json_data)]], the format
+    stored in the buffer before it was indexed.
+    """
+
+    def __init__(self, max_in_memory=MAX_IN_MEMORY, spill_filename=SPILL_FILENAME):
+        self.max_in_memory = max_in_memory
+        self.spill_filename = spill_filename
+
+        self.messages = defaultdict(dict) # Sender to clock entry to (message, received_at).
+        self.spilled = defaultdict(set) # Sender to clock entries of its messages on disk.
+        self.in_memory = 0
+        self.spill = None # Opened on first spill.
+        self.lock = threading.RLock()
+
+        self.delivered = 0
+        self.average_lag = 0.0 # Seconds between buffering and delivering a message.
+        self.max_lag = 0.0
+
+    def __len__(self):
+        return self.in_memory + sum(len(entries) for entries in self.spilled.values())
+
+    def __contains__(self, sender_and_entry):
+        sender, entry = sender_and_entry
+        return entry in self.messages[sender] or entry in self.spilled[sender]
+
+    def senders(self):
+        with self.lock:
+            return [sender for sender in set(self.messages).union(self.spilled) if self.messages[sender] or self.spilled[sender]]
+
+    def spill_key(self, sender, entry):
+        return f'{sender}/{entry}'
+
+    def add(self, message):
+        """
+        Buffers a message, ignoring it if we already buffered it.
+        """
+        incoming_vec, meta_data = message
+        sender = meta_data[1]
+        entry = incoming_vec[sender]
+        with self.lock:
+            if (sender, entry) in self:
+                return
+            self.messages[sender][entry] = (message, time.time())
+            self.in_memory += 1
+            if self.in_memory > self.max_in_memory:
+                self.spill_furthest()
+
+    def spill_furthest(self):
+        # Spill the later half of the sender with the most messages in memory.
+        sender = max(self.messages, key=lambda s: len(self.messages[s]))
+        entries = sorted(self.messages[sender])
+        if self.spill is None:
+            self.spill = shelve.open(self.spill_filename, flag='n')
+        for entry in entries[len(entries) // 2:]:
+            self.spill[self.spill_key(sender, entry)] = self.messages[sender].pop(entry)
+            self.spilled[sender].add(entry)
+            self.in_memory -= 1
+
+    def load_spilled(self, sender):
+        # Load back the earliest spilled messages of a sender, as many as fit in memory.
+        room = max(self.max_in_memory - self.in_memory, 1)
+        for entry in sorted(self.spilled[sender])[:room]:
+            self.messages[sender][entry] = self.spill.pop(self.spill_key(sender, entry))
+            self.spilled[sender].discard(entry)
+            self.in_memory += 1
+
+    def get(self, sender, entry):
+        """
+        Returns:
+            list: The buffered message from sender with the given clock
+                  entry, or None.
+        """
+        with self.lock:
+            if entry not in self.messages[sender] and entry in self.spilled[sender]:
+                self.load_spilled(sender)
+            if entry in self.messages[sender]:
+                return self.messages[sender][entry][0]
+            return None
+
+    def pop(self, sender, entry):
+        """
+        Removes a message once it's delivered.
+        """
+        with self.lock:
+            message, received_at = self.messages[sender].pop(entry)
+            self.in_memory -= 1
+
+            lag = time.time() - received_at
+            self.delivered += 1
+            self.average_lag += LAG_SMOOTHING * (lag - self.average_lag)
+            self.max_lag = max(self.max_lag, lag)
+            return message
+
+    def prune(self, vector_clock):
+        """
+        Drops the messages older than what vector_clock already delivered.
+        """
+        with self.lock:
+            for sender in self.senders():
+                for entry in [e for e in self.messages[sender] if e <= vector_clock.get(sender, 0)]:
+                    del self.messages[sender][entry]
+                    self.in_memory -= 1
+                for entry in [e for e in self.spilled[sender] if e <= vector_clock.get(sender, 0)]:
+                    del self.spill[self.spill_key(sender, entry)]
+                    self.spilled[sender].discard(entry)
+
+    def clear(self):
+        with self.lock:
+            self.messages.clear()
+            self.spilled.clear()
+            self.in_memory = 0
+            if self.spill is not None:
+                self.spill.clear()
+
+    def to_list(self):
+        """
+        Returns:
+            list: Every buffered message, including the spilled ones.
+        """
+        with self.lock:
+            buffered = [message for entries in self.messages.values() for message, _ in entries.values()]
+            for sender, entries in self.spilled.items():
+                buffered.extend(self.spill[self.spill_key(sender, entry)][0] for entry in entries)
+            return buffered
+
+    def stats(self, vector_clock):
+        """
+        Returns:
+            dict: Buffer depth, delivery lag in seconds, and how many clock
+                  entries each sender's latest buffered message is ahead.
+        """
+        with self.lock:
+            lag_entries = {}
+            for sender in self.senders():
+                latest = max(set(self.messages[sender]).union(self.spilled[sender]))
+                lag_entries[sender] = latest - vector_clock.get(sender, 0)
+            return {
+                'depth': len(self),
+                'in_memory': self.in_memory,
+                'spilled': len(self) - self.in_memory,
+                'delivered': self.delivered,
+                'average_lag': self.average_lag,
+                'max_lag': self.max_lag,
+                'lag_entries': lag_entries
+            }
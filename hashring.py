@@ -0,0 +1,51 @@
+import bisect
+import hashlib
+import os
+
+
+VNODES_PER_SHARD = int(os.environ.get('VNODES_PER_SHARD', 128)) # Points each shard owns on the ring.
+
+
+def int_sha256(key):
+    key_bytestring = str(key).encode()
+    hex_hash = hashlib.sha256(key_bytestring).hexdigest()
+    return int(hex_hash, 16)
+
+
+class HashRing:
+    """
+    Consistent-hash ring mapping keys to shard ids.
+
+    Each shard id owns `vnodes` points on the ring.  The points of shard i
+    depend only on i, so growing the shard count from N to N + 1 only moves
+    the keys that the new shard's points capture (about 1 / (N + 1) of them),
+    and shrinking it only moves the keys of the removed shards.
+    """
+
+    def __init__(self, shard_count, vnodes=VNODES_PER_SHARD):
+        self.shard_count = shard_count
+        self.vnodes = vnodes
+
+        points = []
+        for shard_id in range(shard_count):
+            for vnode in range(vnodes):
+                points.append((int_sha256(f'shard-{shard_id}-vnode-{vnode}'), shard_id))
+        points.sort()
+
+        self._hashes = [h for h, _ in points]
+        self._shard_ids = [shard_id for _, shard_id in points]
+
+    def get_shard_id(self, key):
+        """
+        Returns the shard id owning the key: the first ring point clockwise
+        from the key's hash.  O(log n) in the number of ring points.
+
+        Returns:
+            int: The owning shard id, or -1 if the ring is empty.
+        """
+        if not self._hashes:
+            return -1
+        i = bisect.bisect_right(self._hashes, int_sha256(key))
+        if i == len(self._hashes):
+            i = 0
+        return self._shard_ids[i]
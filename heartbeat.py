@@ -1,149 +1,508 @@
-from network import multicast, unicast
+from collections import defaultdict, deque, namedtuple
+from network import HTTPMethods, bounded_jitter, multicast, unicast
 from view import init_view
 import concurrent.futures
 import json
 import logging
+import math
+import metrics
 import os
 import random
+import threading
 import time
 
 
 MY_ADDRESS = os.environ['SOCKET_ADDRESS']
 ADDRESSES = init_view()
-VECTOR_CLOCK_FILENAME = '.vector_clock.json'
-UNIVERSE_FILENAME = '.universe.json'
-ALIVE_FILENAME = '.alive.json'
 ENDPOINT = '/heartbeat'
-INTERVAL = 2.5 # How often to run heartbeat.
-TIMEOUT = 2 # Seconds until heartbeat failure.
+PROBE_ENDPOINT = '/heartbeat-probe' # Asks a member to probe another one for us.
+INTERVAL = float(os.environ.get('HEARTBEAT_INTERVAL', 1)) # Seconds per protocol period, each probing one member.
+TIMEOUT = float(os.environ.get('HEARTBEAT_TIMEOUT', 0.5)) # Seconds until a probe fails.
+JOIN_TIMEOUT = 0.3 # Seconds to wait for members when we start.
+INDIRECT_PROBES = int(os.environ.get('HEARTBEAT_INDIRECT_PROBES', 3)) # Members asked to probe a member that didn't answer us.
+SUSPICION_MULT = float(os.environ.get('HEARTBEAT_SUSPICION_MULT', 3)) # Protocol periods, per log2 of the cluster size, a member is suspected for before it's declared dead.
+RETRANSMIT_MULT = 3 # Times each membership update is piggybacked, per log2 of the cluster size.
+MAX_PIGGYBACK = 16 # Most membership updates piggybacked on one message.
+PHI_THRESHOLD = float(os.environ.get('HEARTBEAT_PHI_THRESHOLD', 8)) # Suspicion level past which a member is probed before its turn.  A suspected member's suspicion timeout shrinks to nothing as its level nears it.
+PHI_WINDOW = 100 # Intervals between messages from a member its suspicion level is computed over.
+DEAD_PROBE_EVERY = 5 # Protocol periods between probes of a dead member, to notice it came back.
+JITTER = float(os.environ.get('HEARTBEAT_JITTER', 0)) # Max seconds to delay each heartbeat by.
+
+# Member states.  At the same incarnation, later states override earlier ones.
+ALIVE = 'alive'
+SUSPECT = 'suspect'
+DEAD = 'dead'
+STATE_RANK = {ALIVE: 0, SUSPECT: 1, DEAD: 2}
+
+Member = namedtuple('Member', ['state', 'incarnation', 'since'])
+
+heartbeat_jitter = bounded_jitter(JITTER) if JITTER > 0 else None # None falls back to the data path policy.
+
+logger = logging.getLogger(__name__)
+
+# Membership shared with the KVS, which runs us as a thread in its own process.
+alive = {MY_ADDRESS}
+alive_version = 0 # Bumped on every change, so readers can cheaply tell if alive changed.
+alive_lock = threading.Lock() # Guards alive and every membership global below.
+listeners = [] # Called with the new alive set after every change.
+
+incarnation = 0 # Only we bump ours, to refute suspicions of us.
+members = {} # Address to its Member, for every member we heard of.
+updates = {} # Address to [update, times left to piggyback it], for recent changes.
+arrivals = defaultdict(lambda: ArrivalWindow()) # Address to the times we heard from it directly.
+probe_order = [] # Members left to probe in this round robin.
+
+probe_rtt = metrics.Histogram('kvs_heartbeat_rtt_seconds', 'Round trip time of answered direct probes, by member.', ['peer'])
+probe_failures = metrics.Counter('kvs_heartbeat_probe_failures_total', 'Direct probes a member did not answer in time, by member.', ['peer'])
+
+# Set by start().
+get_replicas_view_universe = None
+get_vector_clock = None
+
+
+class ArrivalWindow:
+    """
+    The intervals between the last PHI_WINDOW messages from a member, for
+    the phi accrual failure detector.  Rather than alive or dead, it tells
+    how suspicious the silence since the last message is, given how often
+    the member usually talks to us.
+    """
+
+    def __init__(self):
+        self.intervals = deque(maxlen=PHI_WINDOW)
+        self.total = 0
+        self.last = None
+
+    def add(self, now):
+        if self.last is not None:
+            if len(self.intervals) == self.intervals.maxlen:
+                self.total -= self.intervals[0]
+            self.intervals.append(now - self.last)
+            self.total += now - self.last
+        self.last = now
+
+    def phi(self, now):
+        """
+        Returns:
+            float: -log10 of the probability that the member would stay
+                   silent this long, with messages arriving as a Poisson
+                   process.  1 means a 10% chance, 2 a 1% chance, and so on.
+        """
+        if not self.intervals or self.total <= 0:
+            return 0.0
+        # Bursts, like when members join, would otherwise make any pause look suspicious.
+        mean = max(self.total / len(self.intervals), INTERVAL)
+        return (now - self.last) / mean * math.log10(math.e)
+
+
+def cluster_log():
+    return max(1, math.ceil(math.log2(len(get_replicas_view_universe()) + 1)))
+
+
+def suspicion_timeout():
+    return SUSPICION_MULT * cluster_log() * INTERVAL
 
 
 def address_to_heartbeat_uri(address):
     return 'http://' + address + ENDPOINT
 
 
-def unicast_heartbeat(address, timeout=TIMEOUT):
-    return unicast(
+def address_to_probe_uri(address):
+    return 'http://' + address + PROBE_ENDPOINT
+
+
+def get_alive():
+    """
+    Returns:
+        tuple: A copy of the alive set and its version.
+    """
+    with alive_lock:
+        return set(alive), alive_version
+
+
+def _update_alive():
+    """
+    Recomputes the alive set from members, with alive_lock held.  Suspected
+    members still count as alive until they're declared dead.
+
+    Returns:
+        set: A copy of the new alive set if it changed, else None.
+    """
+    global alive
+    global alive_version
+    current_alive = {MY_ADDRESS}.union(a for a, m in members.items() if m.state != DEAD)
+    if current_alive == alive:
+        return None
+    alive = current_alive
+    alive_version += 1
+    return set(alive)
+
+
+def _notify(current_alive):
+    if current_alive is None:
+        return
+    for listener in listeners:
+        listener(current_alive)
+
+
+def _disseminate(address, state, member_incarnation):
+    """
+    Queues an update to piggyback on our next messages, with alive_lock held.
+    """
+    updates[address] = [[address, state, member_incarnation], RETRANSMIT_MULT * cluster_log()]
+
+
+def _apply(address, state, member_incarnation):
+    """
+    Applies a membership update, with alive_lock held.  The update wins over
+    what we know if it has a higher incarnation, or the same one and a later
+    state.  Updates suspecting us are refuted by bumping our incarnation.
+
+    Returns:
+        bool: Whether what we know of the member changed.
+    """
+    global incarnation
+    if address == MY_ADDRESS:
+        if state != ALIVE and member_incarnation >= incarnation:
+            incarnation = member_incarnation + 1
+            logger.info(f'Refuting {state} at incarnation {member_incarnation}, now at {incarnation}')
+            _disseminate(MY_ADDRESS, ALIVE, incarnation)
+        return False
+    if address not in get_replicas_view_universe():
+        return False
+
+    member = members.get(address)
+    if member is not None and (member_incarnation, STATE_RANK[state]) <= (member.incarnation, STATE_RANK[member.state]):
+        return False
+    if member is None or member.state != state:
+        logger.info(f'{address} is {state} at incarnation {member_incarnation}')
+    members[address] = Member(state, member_incarnation, time.monotonic())
+    _disseminate(address, state, member_incarnation)
+    return True
+
+
+def set_alive(address, is_alive):
+    """
+    Marks an address alive or dead, as we learned out of band, and notifies
+    the listeners if that changed our alive set.
+    """
+    with alive_lock:
+        member = members.get(address)
+        member_incarnation = member.incarnation if member is not None else 0
+        if is_alive:
+            members[address] = Member(ALIVE, member_incarnation, time.monotonic())
+        else:
+            members[address] = Member(DEAD, member_incarnation, time.monotonic())
+        current_alive = _update_alive()
+
+    _notify(current_alive)
+
+
+def add_listener(listener):
+    listeners.append(listener)
+
+
+def message(recipient=None):
+    """
+    Returns:
+        dict: Our incarnation and the membership updates to piggyback, the
+              ones sent the fewest times first.  If we suspect the recipient
+              or believe it dead, that's always included, so it can refute it.
+    """
+    with alive_lock:
+        pending = sorted(updates.values(), key=lambda u: -u[1])[:MAX_PIGGYBACK]
+        for u in pending:
+            u[1] -= 1
+            if u[1] <= 0:
+                del updates[u[0][0]]
+        piggyback = [u[0] for u in pending]
+
+        member = members.get(recipient)
+        if member is not None and member.state != ALIVE and all(p[0] != recipient for p in piggyback):
+            piggyback.append([recipient, member.state, member.incarnation])
+
+        return {'from': MY_ADDRESS, 'incarnation': incarnation, 'updates': piggyback}
+
+
+def receive(body):
+    """
+    Handles a message from a member: it's proof the sender is alive, and
+    carries membership updates.
+
+    Returns:
+        dict: The message to answer with.
+    """
+    if not body or 'from' not in body:
+        return message()
+    sender = body['from']
+
+    with alive_lock:
+        arrivals[sender].add(time.monotonic())
+        _apply(sender, ALIVE, body.get('incarnation', 0))
+        for address, state, member_incarnation in body.get('updates', []):
+            if state in STATE_RANK:
+                _apply(address, state, member_incarnation)
+        current_alive = _update_alive()
+
+    _notify(current_alive)
+    return message(sender)
+
+
+def ping(address, timeout=TIMEOUT):
+    """
+    Probes a member directly.
+
+    Returns:
+        bool: Whether it answered.
+    """
+    start = time.monotonic()
+    response = unicast(
         address,
         address_to_heartbeat_uri,
+        http_method=HTTPMethods.POST,
         timeout=timeout,
-        headers={'VC': json.dumps(get_vector_clock())}
+        data=json.dumps(message(address)),
+        headers={'Content-Type': 'application/json', 'VC': get_vector_clock()},
+        jitter=heartbeat_jitter
+    ).response
+    if response is None or response.status_code != 200:
+        probe_failures.inc(address)
+        return False
+    probe_rtt.observe(time.monotonic() - start, address)
+    try:
+        receive(response.json())
+    except ValueError:
+        pass
+    return True
+
+
+def ping_indirectly(target):
+    """
+    Asks up to INDIRECT_PROBES random members to probe target for us, in
+    case only the path between us and target is broken.
+
+    Returns:
+        bool: Whether any of them reached target.
+    """
+    with alive_lock:
+        relays = [a for a, m in members.items() if m.state == ALIVE and a != target and a in get_replicas_view_universe()]
+    relays = random.sample(relays, min(INDIRECT_PROBES, len(relays)))
+    if not relays:
+        return False
+
+    fs = multicast(
+        relays,
+        address_to_probe_uri,
+        http_method=HTTPMethods.POST,
+        timeout=TIMEOUT * 2,
+        data=json.dumps(dict(message(), target=target)),
+        headers={'Content-Type': 'application/json'},
+        jitter=heartbeat_jitter,
+        wait=False
     )
+    acked = False
+    for f in concurrent.futures.as_completed(fs):
+        response = f.result().response
+        if response is None or response.status_code != 200:
+            continue
+        try:
+            body = response.json()
+        except ValueError:
+            continue
+        receive(body)
+        acked = acked or body.get('ack', False)
+    return acked
+
 
+def probe_for(body):
+    """
+    Handles an indirect probe request: probes the target for the sender.
 
-def get_replicas_view_universe():
-    with open(UNIVERSE_FILENAME, 'r') as f:
-        universe = set(json.load(f))
-    return universe
+    Returns:
+        dict: The message to answer with, and whether the target answered.
+    """
+    receive(body)
+    target = body.get('target')
+    acked = target is not None and ping(target)
+    return dict(message(body.get('from')), ack=acked)
 
 
-def get_vector_clock():
-    with open(VECTOR_CLOCK_FILENAME, 'r') as f:
-        vector_clock = json.load(f)
-    return vector_clock
+def suspect(address):
+    with alive_lock:
+        member = members.get(address)
+        if member is None or member.state != ALIVE:
+            return
+        _apply(address, SUSPECT, member.incarnation)
 
 
-def multicast_heartbeat_blocking(addresses):
-    logger.info(f'Starting HB multicast: {addresses}')
+def expire_suspicions():
+    """
+    Declares dead the members suspected for longer than their suspicion
+    timeout without refuting it.  The timeout shrinks as the member's
+    suspicion level grows, to nothing at PHI_THRESHOLD: the longer it's
+    been silent, compared to how often it usually talks to us, the less
+    likely it's still alive.  A member we heard from just before we
+    suspected it gets nearly the whole timeout to refute it.
+    """
+    now = time.monotonic()
+    timeout = suspicion_timeout()
+    with alive_lock:
+        for address, member in list(members.items()):
+            if member.state == SUSPECT and now - member.since >= timeout * max(0.0, 1 - arrivals[address].phi(now) / PHI_THRESHOLD):
+                _apply(address, DEAD, member.incarnation)
+        current_alive = _update_alive()
 
+    _notify(current_alive)
+
+
+def next_target(probe_dead):
+    """
+    Picks the member to probe this protocol period: a member whose silence
+    passed PHI_THRESHOLD if any, else the next one of a round robin over the
+    shuffled members, so every member is probed once per round.  Every
+    DEAD_PROBE_EVERY periods, a dead member instead.
+
+    Returns:
+        str: The member's address, None if there's none.
+    """
+    global probe_order
+    universe = [a for a in sorted(get_replicas_view_universe()) if a != MY_ADDRESS]
+    now = time.monotonic()
+    with alive_lock:
+        dead = [a for a in universe if a in members and members[a].state == DEAD]
+        if probe_dead and dead:
+            return random.choice(dead)
+
+        live = [a for a in universe if a not in dead]
+        overdue = [a for a in live if a in members and members[a].state == ALIVE and arrivals[a].phi(now) > PHI_THRESHOLD]
+        if overdue:
+            return max(overdue, key=lambda a: arrivals[a].phi(now))
+
+        while probe_order:
+            address = probe_order.pop()
+            if address in live:
+                return address
+        if not live:
+            return None
+        probe_order = random.sample(live, len(live))
+        return probe_order.pop()
+
+
+def probe(address):
+    if ping(address):
+        return
+    with alive_lock:
+        member = members.get(address)
+    if member is None or member.state == DEAD:
+        return # Nothing to suspect.
+    if not ping_indirectly(address):
+        suspect(address)
+
+
+def join():
+    """
+    Probes every member at once when we start, so the KVS knows who's alive
+    before serving.  Members that start later do the same with us.
+    """
+    addresses = [a for a in get_replicas_view_universe() if a != MY_ADDRESS]
+    logger.info(f'Joining: {addresses}')
     fs = multicast(
         addresses,
         address_to_heartbeat_uri,
-        timeout=TIMEOUT,
-        headers={'VC': json.dumps(get_vector_clock())}
+        http_method=HTTPMethods.POST,
+        timeout=JOIN_TIMEOUT,
+        data=json.dumps(message()),
+        headers={'Content-Type': 'application/json', 'VC': get_vector_clock()},
+        jitter=heartbeat_jitter
     )
-    unicast_responses = [f.result() for f in concurrent.futures.as_completed(fs)]
-    alive = [ur.address for ur in unicast_responses if ur.response is not None and ur.response.status_code == 200]
-    logger.info(f'Alive: {alive}')
-    return alive
+    for f in fs:
+        response = f.result().response
+        if response is not None and response.status_code == 200:
+            try:
+                receive(response.json())
+            except ValueError:
+                pass
+    logger.info(f'Alive: {sorted(get_alive()[0])}')
 
 
-def write_alive(address_pool=None, timeout=TIMEOUT):
-    if address_pool is None:
-        address_pool = sorted(get_replicas_view_universe())
+def count_members():
+    with alive_lock:
+        counts = {(state,): 0 for state in STATE_RANK}
+        for member in members.values():
+            counts[(member.state,)] += 1
+        return counts
 
-    random_server = address_pool[random.randrange(0, len(address_pool))]
-    response = unicast_heartbeat(random_server, timeout=timeout).response
-    random_server_ok = True if response is not None and response.status_code == 200 else False
 
-    try:
-        with open(ALIVE_FILENAME, 'r+') as f:
-            previous_alive = set(json.load(f))
-
-            if random_server in previous_alive:
-                current_alive = previous_alive if random_server_ok else previous_alive.difference({random_server})
-            else:
-                current_alive = previous_alive.union({random_server}) if random_server_ok else previous_alive
+metrics.Gauge('kvs_membership_members', 'Other members we know of, by state.', count_members, ['state'])
 
-            f.truncate(0)
-            f.seek(0)
-            json.dump(list(current_alive), f)
-    except (FileNotFoundError, IOError):
-        current_alive = {MY_ADDRESS, random_server} if random_server_ok else {MY_ADDRESS}
-        with open(ALIVE_FILENAME, 'w') as f:
-            json.dump(list(current_alive), f)
 
-    return random_server, random_server_ok
+def stats():
+    now = time.monotonic()
+    with alive_lock:
+        return {
+            'incarnation': incarnation,
+            'suspicion_timeout': suspicion_timeout(),
+            'pending_updates': len(updates),
+            'members': {
+                address: {
+                    'state': member.state,
+                    'incarnation': member.incarnation,
+                    'phi': arrivals[address].phi(now)
+                }
+                for address, member in members.items()
+            }
+        }
 
 
 def run():
-    logger.info(f'Reading universe from: {UNIVERSE_FILENAME}')
-    logger.info(f'Writing alive to: {ALIVE_FILENAME}')
-
-    # Settings for initial runs to populate our alive servers faster.
-    # We exhaust the address pool and then fallback to normal functionality.
-    in_initial_runs = True
-    interval = INTERVAL / 7 # Let intervals be 7x faster.
-    exhaust_universe_pool = sorted(get_replicas_view_universe()) # Check every server in our universe exactly once.
+    """
+    SWIM membership: every protocol period we probe one member, and if it
+    doesn't answer, ask INDIRECT_PROBES others to probe it.  If none
+    reaches it, it's suspected, and declared dead unless it refutes that
+    within the suspicion timeout.  The phi accrual suspicion level of each
+    member feeds both steps: members whose level passed PHI_THRESHOLD are
+    probed before their turn, and the higher a suspected member's level,
+    the shorter its suspicion timeout.  Suspicion itself still takes failed
+    probes, so a member isn't suspected just for being quiet.  Changes are
+    piggybacked on probes and their answers, each O(log n) times, so they
+    reach every member in O(log n) periods, while each member sends O(1)
+    probes per period.
+    """
+    logger.info('Starting heartbeat')
+    join()
+
+    periods = 0
     while True:
-        start = time.time()
-
-        if in_initial_runs:
-            checked_server, checked_server_ok = write_alive(address_pool=exhaust_universe_pool, timeout=0.3)
-            if checked_server_ok:
-                exhaust_universe_pool.remove(checked_server)
-            if len(exhaust_universe_pool) == 0: # We've exhausted our pool.  Fallback to default values.
-                in_initial_runs = False
-                interval = INTERVAL
-        else:
-            write_alive()
+        start = time.monotonic()
+        periods += 1
+
+        target = next_target(probe_dead=periods % DEAD_PROBE_EVERY == 0)
+        if target is not None:
+            probe(target)
+        expire_suspicions()
 
-        end = time.time()
-        elapsed = end - start
-        remaining = interval - elapsed
+        remaining = INTERVAL - (time.monotonic() - start)
         if remaining > 0:
             time.sleep(remaining)
 
-if __name__ == '__main__':
-    logging.basicConfig(format='[%(levelname)s] %(asctime)s > %(message)s', datefmt='%d-%b-%y %H:%M:%S')
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.INFO)
 
-    with open(ALIVE_FILENAME, 'w') as f:
-        json.dump([], f)
+def start(replicas_view_universe_getter, vector_clock_getter):
+    """
+    Starts the heartbeat in a background thread of the KVS process.
 
-    universe_ready = False
-    while not universe_ready:
-        try:
-            universe = get_replicas_view_universe()
-            if universe is not None:
-                universe_ready = True
-        except:
-            pass
-
-    vector_clock_ready = False
-    while not vector_clock_ready:
-        try:
-            vector_clock = get_vector_clock()
-            if vector_clock is not None:
-                vector_clock_ready = True
-        except:
-            pass
-
-    our_server_online = False
-    while not our_server_online:
-        time.sleep(3)
-        unicast_response = unicast_heartbeat(MY_ADDRESS).response
-        if unicast_response is not None:
-            our_server_online = unicast_response.status_code == 200
-    run()
+    Args:
+        replicas_view_universe_getter (function): Returns the addresses to probe.
+        vector_clock_getter (function): Returns the encoded vector clock to send along.
+    """
+    global get_replicas_view_universe
+    global get_vector_clock
+    get_replicas_view_universe = replicas_view_universe_getter
+    get_vector_clock = vector_clock_getter
+
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('[%(levelname)s] %(asctime)s > %(message)s', datefmt='%d-%b-%y %H:%M:%S'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+
+    threading.Thread(target=run, daemon=True).start()
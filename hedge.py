@@ -0,0 +1,155 @@
+from collections import defaultdict, deque
+from selector import selector
+import concurrent.futures
+import os
+import threading
+import time
+
+HEDGE_READS = os.environ.get('HEDGE_READS', '0') != '0' # Set to 1 to hedge forwarded GETs.
+HEDGE_DELAY = float(os.environ.get('HEDGE_DELAY', 0)) # Seconds before hedging, 0 for the shard's observed latency percentile.
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 95)) # Latency percentile to hedge after.
+HEDGE_MAX_RATE = float(os.environ.get('HEDGE_MAX_RATE', 0.1)) # Most hedged requests per forwarded GET.
+HEDGE_WORKERS = int(os.environ.get('HEDGE_WORKERS', 64)) # Threads sending hedged GETs.
+LATENCY_WINDOW = 1000 # Latencies per shard the percentile is computed over.
+MIN_SAMPLES = 20 # Latencies we need before hedging after the percentile.
+MAX_BUDGET = 10 # Hedges that can be saved up for a burst.
+
+
+class LatencyWindow:
+    """
+    The last LATENCY_WINDOW latencies of a shard's reads, with a percentile
+    recomputed every few samples rather than on every read.
+    """
+
+    def __init__(self, percentile):
+        self.percentile = percentile
+        self.samples = deque(maxlen=LATENCY_WINDOW)
+        self.value = None
+        self.since_update = 0
+
+    def add(self, latency):
+        self.samples.append(latency)
+        self.since_update += 1
+        if len(self.samples) >= MIN_SAMPLES and (self.value is None or self.since_update >= LATENCY_WINDOW // 10):
+            ordered = sorted(self.samples)
+            self.value = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+            self.since_update = 0
+
+
+class Hedger:
+    """
+    Decides when to hedge a forwarded GET: send it to a second replica of
+    the shard if the first hasn't answered after the shard's observed
+    HEDGE_PERCENTILE latency, or HEDGE_DELAY if set.
+
+    Hedges are paid for out of a budget that every forwarded GET adds
+    HEDGE_MAX_RATE to, so at most that share of GETs is hedged, however slow
+    a shard gets, and load never doubles.
+    """
+
+    def __init__(self, delay=HEDGE_DELAY, percentile=HEDGE_PERCENTILE, max_rate=HEDGE_MAX_RATE):
+        self.fixed_delay = delay
+        self.max_rate = max_rate
+        self.windows = defaultdict(lambda: LatencyWindow(percentile)) # Shard id to its read latencies.
+        self.budget = 0
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=HEDGE_WORKERS)
+            return self.executor
+
+    def record(self, shard_id, latency):
+        with self.lock:
+            self.windows[shard_id].add(latency)
+
+    def started(self):
+        with self.lock:
+            self.requests += 1
+            self.budget = min(self.budget + self.max_rate, MAX_BUDGET)
+
+    def delay(self, shard_id):
+        """
+        Returns:
+            float: Seconds to wait before hedging a read of the shard, None
+                   if we don't know its latency yet.
+        """
+        if self.fixed_delay > 0:
+            return self.fixed_delay
+        with self.lock:
+            return self.windows[shard_id].value
+
+    def take_hedge(self):
+        with self.lock:
+            if self.budget < 1:
+                return False
+            self.budget -= 1
+            self.hedges += 1
+            return True
+
+    def hedge_won(self):
+        with self.lock:
+            self.hedge_wins += 1
+
+    def send(self, shard_id, addresses, send, valid):
+        """
+        Sends a read to a replica out of addresses, and hedges it to another
+        if it's slow.  The read that loses is cancelled if it wasn't sent yet,
+        and its answer ignored otherwise.
+
+        Args:
+            send (function): Sends the read to the given address, returns
+                             its response.
+            valid (function): Whether a response answers the read.
+
+        Returns:
+            The first valid response, or the last response if none is.
+        """
+        def timed_send(address):
+            start = time.monotonic()
+            response = send(address)
+            self.record(shard_id, time.monotonic() - start)
+            return response
+
+        self.started()
+        executor = self.get_executor()
+        first = selector.choose(addresses)
+        pending = {executor.submit(timed_send, first)}
+        done, pending = concurrent.futures.wait(pending, timeout=self.delay(shard_id))
+
+        hedge = None
+        others = [a for a in addresses if a != first]
+        if not any(valid(f.result()) for f in done) and others and self.take_hedge():
+            hedge = executor.submit(timed_send, selector.choose(others))
+            pending.add(hedge)
+
+        response = None
+        while True:
+            for f in done:
+                response = f.result()
+                if valid(response):
+                    for p in pending:
+                        p.cancel()
+                    if f is hedge:
+                        self.hedge_won()
+                    return response
+            if not pending:
+                return response
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'hedges': self.hedges,
+                'hedge_wins': self.hedge_wins,
+                'delays': {shard_id: window.value for shard_id, window in self.windows.items()}
+            }
+
+
+hedger = Hedger()
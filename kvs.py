@@ -1,21 +1,32 @@
+from cache import InvalidationFeed, RemoteCache
+from causal import CausalWaiters
+from clock import EncodedClock
+from client import SHARD_VIEW_VERSION_HEADER, STALE_SHARD_MAP
 from collections import defaultdict
-from flask import abort, Flask, request, jsonify, Response
-from network import HTTPMethods, multicast
-from time import sleep
+from delivery import DeliveryBuffer
+from flask import abort, Flask, g, request, jsonify, Response
+from hashring import HashRing
+from hedge import HEDGE_READS, hedger
+from locks import CommitQueue, StripedLock
+from migration import Migration
+from network import get_executor, HTTPMethods, multicast, pool_stats, unicast
+from oplog import OpLog
+from replication import ReplicationLog
+from selector import selector
+from storage import open_storage_engine, VERSION_ZERO
+from time import monotonic, sleep, time
+from ttl import TTL_SWEEP_BATCH, TTL_SWEEP_INTERVAL
+import clock
 import concurrent.futures
 import heartbeat
 import json
+import math
+import metrics
 import os
 import sys
-import requests
-import hashlib
 import logging
 import random
-
-def int_sha256(key):
-    key_bytestring = str(key).encode()
-    hex_hash = hashlib.sha256(key_bytestring).hexdigest()
-    return int(hex_hash, 16)
+import threading
 
 UNAUTHED_REPLICA_ORIGIN = {'error': 'Request must originate from a replica in the view'}
 VIEW_PUT_SOCKET_EXISTS = {
@@ -23,38 +34,107 @@ VIEW_PUT_SOCKET_EXISTS = {
     'message': 'Error in PUT'
 }
 
+REPLICATION_ACK = os.environ.get('REPLICATION_ACK', 'local') # Acknowledge writes after 'local', 'one' or 'all' replicas.
+REPLICATION_ACK_TIMEOUT = float(os.environ.get('REPLICATION_ACK_TIMEOUT', 3))
+CAUSAL_WAIT_TIMEOUT = float(os.environ.get('CAUSAL_WAIT_TIMEOUT', 10)) # Seconds a request waits for its causal dependencies.
+CAUSAL_WAIT_TIMED_OUT = 'Timed out waiting for causal dependencies'
+INVALID_TTL = 'ttl must be a positive number of seconds'
+INVALID_KEY = 'Key must be a non-empty string'
+MAX_KEY_LENGTH = 50
+NO_SHARD = '' # Stands in for a missing clock entry while we aren't in any shard.
+HANDOFF_HEADER = 'X-Handoff' # Asks a key's previous owner to serve it during a reshard.
+VERSION_FIELD = 'key-version' # Carries the version of a replicated write along with its data.
+VERSION_RESOLUTION = 1e-6 # Seconds a new version is past the newest we stored, at least.
+CATCHUP_TIMEOUT = 10 # Seconds to wait on each read while catching up.
+CATCHUP_CHUNK_SIZE = 1000 # Keys per line of a snapshot sent to a lagging replica.
+ANTI_ENTROPY_INTERVAL = float(os.environ.get('ANTI_ENTROPY_INTERVAL', 30)) # Seconds between Merkle tree comparisons with a peer.
+
 app = Flask(__name__)
 app.logger.setLevel(logging.DEBUG)
 
-store = {}
-delivery_buffer = [] # Messages received but not yet delivered.
+store = open_storage_engine() # Persists the vector clock and delivery buffer along with the data.
+delivery_buffer = DeliveryBuffer() # Messages received but not yet delivered.
+op_log = OpLog() # Operations delivered, for replicas catching up.
+catch_up_lock = threading.Lock() # Held while we catch up, so heartbeats don't start another.
 previously_received_vector_clocks = defaultdict(list)
 previously_received_vector_clocks_CAPACITY = 1
+peer_clocks = {} # Member of our shard, without port, to the shard view version and vector clock it last showed us in anti-entropy.
 
 replicas_view_universe = heartbeat.ADDRESSES
 replicas_view_no_port = {x.split(":")[0] for x in replicas_view_universe}
-replicas_view_universe_filename = heartbeat.UNIVERSE_FILENAME
 
 my_address = heartbeat.MY_ADDRESS
 my_address_no_port = my_address.split(":")[0]
 replicas_view_alive = {my_address}
-replicas_view_alive_filename = heartbeat.ALIVE_FILENAME
-replicas_view_alive_last_read = float('-inf') # When was the last time we read from alive?  Initially never read.
+replicas_view_alive_version = -1 # Version of the heartbeat's alive set we last copied.  Initially never copied.
 
 vector_clock = {address: 0 for address in replicas_view_no_port}
-vector_clock_filename = heartbeat.VECTOR_CLOCK_FILENAME
+encoded_clock = EncodedClock() # Our shard's entries of the vector clock, as sent with every response.
+vector_clock_lock = threading.RLock() # Guards the vector clock and delivery buffer, and orders stamping and logging writes.
+key_locks = StripedLock() # Guards applying and reading keys.  Taken after vector_clock_lock, never before.
+commits = CommitQueue(vector_clock_lock) # Advances the clock for the writes applied outside vector_clock_lock, in the order they were stamped.
+view_lock = threading.Lock() # Serializes changes to the views, which are replaced rather than changed in place.
+causal_waiters = CausalWaiters()
+remote_cache = RemoteCache() # Reads forwarded to other shards.
+
+request_latency = metrics.Histogram('kvs_request_seconds', 'Time to answer requests, by route, method and status.', ['route', 'method', 'status'])
+key_requests = metrics.Counter('kvs_key_requests_total', 'Key requests, by method and how they were served: local, forwarded, cached, replicated or handoff.', ['method', 'served'])
+causal_wait = metrics.Histogram('kvs_causal_wait_seconds', 'Time requests waited for their causal dependencies, by whether they were delivered in time.', ['outcome'])
+replication_wait = metrics.Histogram('kvs_replication_wait_seconds', 'Time client writes waited for the acks REPLICATION_ACK requires, by whether they came in time.', ['outcome'])
+expired_keys = metrics.Counter('kvs_expired_keys_total', 'Expired keys reclaimed, by whether a read or the background sweep found them.', ['by'])
+alive_view_refreshes = metrics.Counter('kvs_alive_view_refreshes_total', 'Times we copied the heartbeat alive set after it changed.')
+metrics.Gauge('kvs_delivery_buffer_messages', 'Messages received but not yet delivered.', lambda: len(delivery_buffer))
+metrics.Gauge('kvs_store_keys', 'Keys in the store.', lambda: len(store))
+metrics.Gauge('kvs_store_bytes', 'Size of the keys and values in the store.', lambda: store.size)
+metrics.Gauge('kvs_store_expiring_keys', 'Keys in the store put with a ttl.', lambda: len(store.expiries))
+metrics.Gauge('kvs_store_memory_bytes', 'Memory taken by the values kept encoded, with their keys, when STORE_MEMORY_BUDGET is set.', lambda: store.stats().get('memory_bytes', 0))
+metrics.Gauge('kvs_store_spilled_keys', 'Keys whose value was spilled to disk, when STORE_MEMORY_BUDGET is set.', lambda: store.stats().get('disk_keys', 0))
 
 # Global shard variables loaded during startup().
 SHARD_COUNT = None
+shard_view_version = 0 # Bumped by every reshard.
+shard_ring = None
 shard_view_universe = None
 shard_view_universe_no_port = None
 shard_view_alive = None
 
-def create_shard_view(replicas_view, num_shards):
-    shard_view = [set() for _ in range(num_shards)] # List of SHARD_COUNT lists within it, where list i holds servers in ith shard.
-    deterministic_view = sorted(replicas_view)
-    for i, address in enumerate(deterministic_view):
-        shard_view[i % num_shards].add(address)
+MINIMUM_SERVERS_THRESHOLD = 2
+
+def create_shard_view(replicas_view, num_shards, previous=None):
+    """
+    Splits the view into num_shards shards whose sizes differ by at most
+    one.  Given the previous shard view, servers stay in their shard where
+    they can: only the servers of removed shards, servers new to the view,
+    and as few others as it takes to even out the sizes change shard, so a
+    reshard moves as few servers' keys as it can.
+
+    Returns:
+        list: The set of servers of each shard.
+
+    Raises:
+        FaultToleranceError: If there are no shards, or too few servers to
+                             give every shard MINIMUM_SERVERS_THRESHOLD.
+    """
+    if num_shards < 1 or len(replicas_view) < MINIMUM_SERVERS_THRESHOLD * num_shards:
+        raise FaultToleranceError
+
+    shard_view = [set(shard).intersection(replicas_view) for shard in (previous or [])[:num_shards]]
+    shard_view += [set() for _ in range(num_shards - len(shard_view))] # List of SHARD_COUNT lists within it, where list i holds servers in ith shard.
+
+    # The largest shards keep one server more than the others, if they don't divide evenly.
+    base, extra = divmod(len(replicas_view), num_shards)
+    by_size = sorted(range(num_shards), key=lambda i: (-len(shard_view[i]), i))
+    sizes = {shard_id: base + (rank < extra) for rank, shard_id in enumerate(by_size)}
+
+    placed = set().union(*shard_view)
+    unplaced = sorted(set(replicas_view).difference(placed))
+    for shard_id, shard in enumerate(shard_view):
+        for address in sorted(shard)[sizes[shard_id]:]:
+            shard.remove(address)
+            unplaced.append(address)
+    for address in unplaced:
+        shard_id = max(range(num_shards), key=lambda i: (sizes[i] - len(shard_view[i]), -i))
+        shard_view[shard_id].add(address)
 
     if not are_shards_fault_tolerant(shard_view):
         raise FaultToleranceError
@@ -64,7 +144,6 @@ def are_shards_fault_tolerant(shard_view):
     return all([is_shard_fault_tolerant(s) for s in shard_view])
 
 def is_shard_fault_tolerant(shard):
-    MINIMUM_SERVERS_THRESHOLD = 2
     return len(shard) >= MINIMUM_SERVERS_THRESHOLD
 
 class ShardError(Exception):
@@ -83,6 +162,9 @@ class ShardNoResponse(ShardError):
     pass
 
 
+def key_to_shard_id(key):
+    return shard_ring.get_shard_id(key)
+
 def get_my_id():
     shard_id = -1
     for i, shard in enumerate(shard_view_universe):
@@ -91,13 +173,33 @@ def get_my_id():
             break
     return shard_id
 
+def recover_state():
+    """
+    Restores the store, vector clock and delivery buffer we persisted before
+    restarting, so we only need to catch up on what we missed since.
+    """
+    recovered = store.recover()
+    if recovered is not None:
+        vector_clock.update(recovered['vector_clock'])
+        encoded_clock.changed()
+        for message in recovered['delivery_buffer']:
+            delivery_buffer.add(message)
+        delivery_buffer.prune(vector_clock)
+    op_log.reset(vector_clock)
+
+    store.start(lambda: {'vector_clock': dict(vector_clock), 'delivery_buffer': delivery_buffer.to_list()})
+
 def startup():
     global SHARD_COUNT
+    global shard_ring
+    global shard_view_version
     global shard_view_universe
     global shard_view_universe_no_port
 
-    update_replicas_view_universe_file()
-    update_vector_clock_file()
+    recover_state()
+
+    heartbeat.start(lambda: replicas_view_universe, clock_metadata)
+    heartbeat.add_listener(lambda alive: causal_waiters.changed())
 
     add_replica_fs = broadcast_add_replica()
 
@@ -108,17 +210,25 @@ def startup():
         # Pull shard state from another replica.
         pulled_shard_view = False
         for address in replicas_view_universe.difference({my_address}):
-            response = requests.get('http://' + address + route_shard())
-            if response.status_code == 200:
+            response = unicast(address, lambda a: 'http://' + a + route_shard()).response
+            if response is not None and response.status_code == 200:
                 shard_view_universe = [set(shard) for shard in response.json()['shard_view_universe']]
+                shard_view_version = response.json().get('version', 0)
                 SHARD_COUNT = len(shard_view_universe)
                 pulled_shard_view = True
                 break
         if not pulled_shard_view:
             raise ShardNoResponse
 
+    shard_ring = HashRing(SHARD_COUNT)
     shard_view_universe_no_port = [{x.split(":")[0] for x in shard} for shard in shard_view_universe]
 
+    update_replication_peers()
+    threading.Thread(target=run_anti_entropy, daemon=True).start()
+    threading.Thread(target=run_expiry, daemon=True).start()
+    if remote_cache.enabled:
+        invalidation_feed.start()
+
     # Give us two pulses before we start doing anything.
     # First pulse to guarantee a heartbeat was attempted, second pulse for insurance.
     sleep(heartbeat.INTERVAL * 2)
@@ -130,77 +240,180 @@ def route(r=''):
 def route_shard(r=''):
     return '/key-value-store-shard' + r
 
-def partition_store():
-    shard_to_partition_map = defaultdict(dict)
-    for k, v in store.items():
-        shard_id = int_sha256(k) % SHARD_COUNT
-        shard_to_partition_map[shard_id][k] = v
-    return dict(shard_to_partition_map)
+def partition_keys(previous_ring, previous_shard_id, previous_universe):
+    """
+    Collects the keys in our store that are no longer owned by our shard.
+
+    A key is only sent if its owning shard changed.  Keys whose owner didn't
+    change are already held by the rest of their shard, so if we changed
+    shards ourselves, we drop ours without sending them, unless none of the
+    shard's members stayed in it.
+
+    Returns:
+        (dict, list): Maps shard id to the keys to send to that shard, and
+                      the keys to drop.
+    """
+    my_id = get_my_id()
+    moved_shards = previous_shard_id != my_id
+    stayed = [
+        shard_id < len(previous_universe) and bool(shard.intersection(previous_universe[shard_id]).difference({my_address}))
+        for shard_id, shard in enumerate(shard_view_universe)
+    ]
+
+    shard_to_keys_map = defaultdict(list)
+    dropped = []
+    for k in store:
+        shard_id = key_to_shard_id(k)
+        if shard_id == my_id:
+            continue
+        if shard_id != previous_ring.get_shard_id(k):
+            shard_to_keys_map[shard_id].append(k)
+        elif moved_shards:
+            (dropped if stayed[shard_id] else shard_to_keys_map[shard_id]).append(k)
+    return dict(shard_to_keys_map), dropped
+
+def migration_items(keys):
+    records = [store.record(k) for k in keys]
+    return [record for record in records if record is not None]
+
+def migration_drop(keys):
+    for k in keys:
+        try:
+            del store[k]
+        except KeyError:
+            pass
+
+def alive_shard_members(shard_id):
+    update_replicas_view_alive()
+    return sorted(shard_view_alive[shard_id].difference({my_address}))
+
+def send_migration_chunk(addresses, body):
+    fs = multicast(
+        addresses,
+        lambda a: 'http://' + a + route_shard('/migrate'),
+        http_method=HTTPMethods.PUT,
+        data=body,
+        headers={'Content-Type': 'application/json'},
+        timeout=10
+    )
+    unicast_responses = [f.result() for f in fs]
+    return [ur.address for ur in unicast_responses if ur.response is not None and ur.response.status_code == 200]
 
+migration = Migration(migration_items, migration_drop, alive_shard_members, send_migration_chunk)
 
-@app.route(route('/union-store'), methods=['PUT'])
-def union_store():
+@app.route(route_shard('/migrate'), methods=['PUT'])
+def migrate_put():
     json_data = request.get_json()
-    store.update(json_data['partition'])
+    with vector_clock_lock:
+        items = migration.accept(json_data['version'], request.remote_addr, json_data['items'], json_data['done'])
+        if items is None:
+            return jsonify({
+                'message': 'Shard view version mismatch'
+            }), 409
+        for record in items:
+            with key_locks.for_key(record[0]):
+                store.apply(record)
     return jsonify({
         'message': 'Updated store successfully'
     }), 200
 
 
+@app.route(route_shard('/reshard-status'), methods=['GET'])
+def reshard_status_get():
+    return jsonify(migration.status()), 200
+
+
 @app.route(route_shard('/reshard'), methods=['PUT'])
 def reshard():
+    global SHARD_COUNT
+    global shard_ring
     global shard_view_universe
+    global shard_view_universe_no_port
+    global shard_view_version
 
     json_data = request.get_json()
 
     incoming_addr = request.remote_addr
     if incoming_addr not in replicas_view_no_port: # From client.
-        shard_count = json_data['shard-count']
+        shard_count = (json_data or {}).get('shard-count')
+        if not isinstance(shard_count, int) or isinstance(shard_count, bool) or shard_count < 1:
+            return jsonify({
+                'message': 'Shard count must be a positive integer!'
+            }), 400
 
         try:
-            shard_view_universe = create_shard_view(replicas_view_universe, shard_count)
+            new_shard_view_universe = create_shard_view(replicas_view_universe, shard_count, shard_view_universe)
         except FaultToleranceError:
             return jsonify({
                 'message': 'Not enough nodes to provide fault-tolerance with the given shard count!'
             }), 400
 
+        # Everyone in the view, including us, applies the new view as a replica.
         multicast(
             replicas_view_universe,
             lambda a: 'http://' + a + route_shard('/reshard'),
             http_method=HTTPMethods.PUT,
-            data=json.dumps({'shard_view_universe': [list(s) for s in shard_view_universe]}),
+            data=json.dumps({
+                'shard_view_universe': [list(s) for s in new_shard_view_universe],
+                'version': shard_view_version + 1
+            }),
             headers={'Content-Type': 'application/json'},
             timeout=3
         )
-    else: # From replica.
-        shard_view_universe = [set(s) for s in json_data['shard_view_universe']]
-
-    global SHARD_COUNT
-    SHARD_COUNT = len(shard_view_universe)
+        return jsonify({
+            'message': 'Resharding done successfully'
+        }), 200
 
+    # From replica.
     global vector_clock
-    vector_clock = {address: 0 for address in replicas_view_no_port}
-
-    # Copies all data in store to partitions to be sent out to other shards
-    partitions = partition_store()
-
-    # Clears its own delivery buffer and store
-    global delivery_buffer
-    delivery_buffer = []
-    global store
-    store = {}
-
-    sleep(2) # Give time for servers doing resharding to also clear their store.
-
-    for shard_id, partition in partitions.items():
-        multicast(
-            shard_view_universe[shard_id],
-            lambda a: 'http://' + a + route('/union-store'), # Create endpoint to extend store with another store in one request.
-            http_method=HTTPMethods.PUT,
-            data=json.dumps({'partition': partition}),
-            headers={'Content-Type': 'application/json'},
-            timeout=3
-        )
+    with view_lock, vector_clock_lock, commits.drained():
+        previous_ring = shard_ring
+        previous_shard_id = get_my_id()
+        previous_universe = shard_view_universe
+
+        # Writes some member of our shard may not have, which clearing the
+        # log and the buffer would lose: the ones our peers haven't all
+        # acknowledged are sent again with the migration, and the buffered
+        # ones are applied now, their versions settling any conflicts.
+        unreplicated = {entry['key'] for entry in replication_log.unacked()}
+        flush_delivery_buffer()
+
+        shard_view_version = json_data['version']
+        shard_view_universe = [set(s) for s in json_data['shard_view_universe']]
+        shard_view_universe_no_port = [{x.split(":")[0] for x in shard} for shard in shard_view_universe]
+        update_replicas_view_alive()
+        update_shard_view_alive()
+
+        SHARD_COUNT = len(shard_view_universe)
+        shard_ring = HashRing(SHARD_COUNT)
+
+        vector_clock = {address: 0 for address in replicas_view_no_port}
+        encoded_clock.changed()
+        store.log_vector_clock(vector_clock)
+        op_log.reset(vector_clock)
+        causal_waiters.changed()
+        replication_log.clear()
+        update_replication_peers()
+
+        remote_cache.clear() # Keys moved, and cached reads are tagged with the old clocks.
+
+    # Streams the keys that change owner to their new shards in the background.
+    # We keep serving them until they're handed off.
+    outgoing, dropped = partition_keys(previous_ring, previous_shard_id, previous_universe)
+    for key in sorted(unreplicated):
+        keys = outgoing.setdefault(key_to_shard_id(key), [])
+        if key not in keys:
+            keys.append(key)
+    migration_drop(set(dropped).difference(unreplicated)) # The unreplicated ones go once their chunk is acknowledged.
+    others = lambda: sorted(replicas_view_alive.difference({my_address}))
+    migration.start(
+        shard_view_version,
+        previous_ring,
+        outgoing,
+        others,
+        {a.split(':')[0] for a in others()},
+        get_my_id()
+    )
 
     return jsonify({
         'message': 'Resharding done successfully'
@@ -211,7 +424,9 @@ def reshard():
 def shards_get():
     serializable = [list(shard) for shard in shard_view_universe]
     return jsonify({
-        'shard_view_universe': serializable
+        'shard_view_universe': serializable,
+        'version': shard_view_version,
+        'vnodes': shard_ring.vnodes
     }), 200
 
 
@@ -225,6 +440,36 @@ def shard_ids_get():
     }), 200
 
 
+@app.before_request
+def start_timer():
+    g.started = monotonic()
+
+
+@app.after_request
+def record_latency(response):
+    rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    request_latency.observe(monotonic() - g.started, rule, request.method, str(response.status_code))
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_get():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/stats', methods=['GET'])
+def stats_get():
+    return jsonify({
+        'connection_pool': pool_stats(),
+        'replica_selector': selector.stats(),
+        'hedged_reads': hedger.stats(),
+        'remote_cache': remote_cache.stats(),
+        'membership': heartbeat.stats(),
+        'delivery_buffer': delivery_buffer.stats(vector_clock),
+        'store': store.stats()
+    }), 200
+
+
 @app.route('/get_shard_view', methods=['GET'])
 def tmp():
     update_replicas_view_alive()
@@ -270,9 +515,8 @@ def members_id_get(shard_id):
 def shard_key_get(shard_id):
     shard_id = int(shard_id)
     shard = sorted(shard_view_universe[shard_id])
-    server = random.randrange(len(shard))
-    response = requests.get('http://' + shard[server] + route())
-    if response.status_code == 200:
+    response = unicast(selector.choose(shard), lambda a: 'http://' + a + route()).response
+    if response is not None and response.status_code == 200:
         store_with_deliveries = response.json()
         store_ = store_with_deliveries['store']
         return jsonify({
@@ -284,6 +528,8 @@ def shard_key_get(shard_id):
 
 @app.route(route_shard('/add-member/<shard_id>'), methods=['PUT'])
 def shard_add_member(shard_id):
+    global shard_view_universe
+    global shard_view_universe_no_port
     shard_id = int(shard_id)
 
     json_data = request.get_json()
@@ -304,7 +550,11 @@ def shard_add_member(shard_id):
                 'message': f'Discarded: {new_member} is already a member of another shard'
             }), 201
 
-    shard_view_universe[shard_id].add(new_member)
+    with view_lock:
+        shard_view_universe = [shard.union({new_member}) if i == shard_id else shard for i, shard in enumerate(shard_view_universe)]
+        shard_view_universe_no_port = [{x.split(":")[0] for x in shard} for shard in shard_view_universe]
+        update_shard_view_alive()
+    update_replication_peers()
 
     # Forward this request to everyone.
     multicast(
@@ -321,19 +571,181 @@ def shard_add_member(shard_id):
     }), 200
 
 
-def pull_state(ip):
+def catch_up(address):
+    """
+    Asks a member of our shard for the operations we're missing and
+    delivers them, or installs its snapshot if it no longer has them all.
+    """
+    if not catch_up_lock.acquire(blocking=False):
+        return
+    try:
+        response = unicast(
+            address,
+            lambda a: 'http://' + a + route('-catchup'),
+            http_method=HTTPMethods.POST,
+            timeout=CATCHUP_TIMEOUT,
+            data=json.dumps({'vector_clock': dict(vector_clock)}),
+            headers={'Content-Type': 'application/json'},
+            stream=True
+        ).response
+        if response is None or response.status_code != 200:
+            return
+
+        lines = (json.loads(line) for line in response.iter_lines() if line)
+        header = next(lines)
+        if header['mode'] == 'operations':
+            for entry in lines:
+                receive_update(HTTPMethods[entry['op']], entry['key'], entry['data'], clock.decode(entry['vc']), entry['origin'])
+        else:
+            install_snapshot(header, lines)
+    finally:
+        catch_up_lock.release()
+
+def install_snapshot(header, chunks):
     global vector_clock
-    global delivery_buffer
-    global store
 
-    response = requests.get('http://' + ip + route(), timeout=3)
-    if response is None and response.status_code == 200:
-        store_with_deliveries = response.json()
-        store = store_with_deliveries['store']
-        delivery_buffer = store_with_deliveries['delivery_buffer']
-        vector_clock = store_with_deliveries['vector_clock']
+    snapshot = []
+    for chunk in chunks:
+        snapshot.extend(chunk['items'])
+
+    with vector_clock_lock, commits.drained():
+        with key_locks.all():
+            store.replace(snapshot)
+            vector_clock = header['vector_clock']
+            encoded_clock.changed()
+            store.log_vector_clock(vector_clock)
+            op_log.reset(vector_clock)
+            causal_waiters.changed()
+            delivery_buffer.clear()
+            for message in header['delivery_buffer']:
+                buffer_message(message)
+            delivery_buffer.prune(vector_clock)
+    deliver_from_buffer() # Takes the lock of each key it delivers, which aren't reentrant.
+
+def fetch_merkle(address, endpoint, body):
+    response = unicast(
+        address,
+        lambda a: 'http://' + a + route('-merkle' + endpoint),
+        http_method=HTTPMethods.POST,
+        timeout=3,
+        data=json.dumps(body),
+        headers={'Content-Type': 'application/json'}
+    ).response
+    if response is None or response.status_code != 200:
+        return None
+    return response.json()
+
+def anti_entropy(address):
+    """
+    Compares our Merkle tree with a member of our shard's, level by level,
+    descending only into the ranges whose hashes differ, then repairs the
+    keys of the differing leaves.
+
+    Replicas are compared whatever their vector clocks say, so concurrent
+    ones, which diverged across a partition, are repaired too.  Keys and
+    tombstones the peer has a newer version of than ours are repaired,
+    unless they expired, and the peer does the same with ours when it
+    compares with us.  If the peer's clock is ahead of ours, we also catch
+    up from it, which delivers the writes we missed in order.
+    """
+    version = shard_view_version
+    nodes = [0]
+    for level in range(store.tree.depth + 1):
+        remote = fetch_merkle(address, '', {'level': level, 'nodes': nodes})
+        if remote is None:
+            return
+        if level == 0:
+            peer_clocks[address.split(':')[0]] = (remote.get('shard_view_version', 0), remote['vector_clock'])
+            if remote.get('shard_view_version', 0) != version:
+                return # Replicas of different shard views don't hold the same keys.
+            my_vec = dict(vector_clock)
+            if remote['vector_clock'] != my_vec and all(remote['vector_clock'].get(a, 0) >= entry for a, entry in my_vec.items()):
+                get_executor().submit(catch_up, address)
+
+        local_hashes = store.tree.hashes(level, nodes)
+        differing = [n for n, h, local_h in zip(nodes, remote['hashes'], local_hashes) if h != local_h]
+        if not differing:
+            return
+        if level == store.tree.depth:
+            break
+        nodes = [child for n in differing for child in (2 * n, 2 * n + 1)]
+
+    remote = fetch_merkle(address, '-leaves', {'leaves': differing})
+    if remote is None or remote.get('shard_view_version', 0) != version:
         return
 
+    now = time()
+    with vector_clock_lock:
+        if shard_view_version != version:
+            return
+        delivered = tombstone_delivered()
+        repaired = 0
+        for record in remote['items']:
+            if len(record) > 3 and record[3] <= now:
+                continue
+            if len(record) == 2 and delivered(record[1]): # We already collected it.
+                continue
+            with key_locks.for_key(record[0]):
+                if store.apply(record):
+                    repaired += 1
+    app.logger.info(f'Anti-entropy with {address}: {len(differing)} leaves differ, repaired {repaired} keys')
+
+def tombstone_delivered():
+    """
+    Returns:
+        function: Whether every member of our shard delivered the delete of
+                  a tombstone's version, as far as the vector clocks they
+                  last showed us in anti-entropy go.  Tombstones of earlier
+                  shard views are kept until the handoff is over, as chunks
+                  of the reshard may still bring back their keys.
+    """
+    my_id = get_my_id()
+    members = shard_view_universe_no_port[my_id].difference({my_address_no_port}) if my_id != -1 else set()
+    clocks = [peer_clocks.get(member) for member in members]
+    version = shard_view_version
+    handing_off = migration.handing_off()
+
+    def delivered(tombstone):
+        _, origin, tombstone_version, entry = tombstone
+        if tombstone_version < version:
+            return not handing_off
+        return all(c is not None and c[0] == version and c[1].get(origin, 0) >= entry for c in clocks)
+    return delivered
+
+def run_anti_entropy():
+    while True:
+        sleep(ANTI_ENTROPY_INTERVAL * random.uniform(0.5, 1.5))
+
+        update_replicas_view_alive()
+        my_id = get_my_id()
+        if my_id == -1:
+            continue
+        peers = sorted(shard_view_alive[my_id].difference({my_address}))
+        if peers:
+            anti_entropy(random.choice(peers))
+        collected = store.collect_tombstones(tombstone_delivered())
+        if collected:
+            app.logger.info(f'Collected {collected} tombstones')
+
+def reclaim_expired():
+    """
+    Reclaims the keys whose ttl passed, TTL_SWEEP_BATCH at a time, taking
+    each one's lock only while removing it so requests aren't held up.
+    """
+    while True:
+        keys = store.expired(time(), TTL_SWEEP_BATCH)
+        for key in keys:
+            with key_locks.for_key(key):
+                if store.reclaim(key):
+                    expired_keys.inc('sweep')
+        if len(keys) < TTL_SWEEP_BATCH:
+            return
+
+def run_expiry():
+    while True:
+        sleep(TTL_SWEEP_INTERVAL)
+        reclaim_expired()
+
 def broadcast_add_replica():
     return multicast(
         replicas_view_universe,
@@ -365,88 +777,102 @@ def determine_port():
 
     return port
 
-def update_replicas_view_universe_file():
-    with open(replicas_view_universe_filename, 'w') as f:
-        json.dump(sorted(replicas_view_universe), f)
-
-def update_vector_clock_file():
-    with open(vector_clock_filename, 'w') as f:
-        json.dump(vector_clock, f)
-
 def update_shard_view_alive():
     global shard_view_alive
     shard_view_alive = [{x for x in shard if x in replicas_view_alive} for shard in shard_view_universe]
 
 def update_replicas_view_alive():
     global replicas_view_alive
-    while True:
-        try:
-            modified_since_read = os.path.getmtime(replicas_view_alive_filename) >= replicas_view_alive_last_read
-            if not modified_since_read:
-                return
-            with open(replicas_view_alive_filename, 'r') as f:
-                replicas_view_alive = set(json.load(f))
-        except (FileNotFoundError, IOError, json.decoder.JSONDecodeError):
-            #replicas_view_alive = set()
-            sleep(heartbeat.INTERVAL)
-        break
+    global replicas_view_alive_version
+    if heartbeat.alive_version == replicas_view_alive_version:
+        return
+    replicas_view_alive, replicas_view_alive_version = heartbeat.get_alive()
+    alive_view_refreshes.inc()
     replicas_view_alive.add(my_address)
     update_shard_view_alive()
 
-def add_replica_alive(new_address):
-    global replicas_view_alive
-    try:
-        with open(replicas_view_alive_filename, 'r+') as f:
-            replicas_view_alive = set(json.load(f)) # Update current alive set.
-            replicas_view_alive.add(my_address)
-            replicas_view_alive.add(new_address)
-
-            f.truncate(0)
-            f.seek(0)
-            json.dump(list(replicas_view_alive), f) # Add replica.
-    except (FileNotFoundError, IOError):
-        with open(replicas_view_alive_filename, 'w') as f:
-            replicas_view_alive = {my_address, new_address}
-            json.dump(list(replicas_view_alive), f)
+def send_replication_batch(address, entries):
+    response = unicast(
+        address,
+        lambda a: 'http://' + a + route('-replicate'),
+        http_method=HTTPMethods.PUT,
+        timeout=3,
+        data=json.dumps({'entries': entries}),
+        headers={'Content-Type': 'application/json'}
+    ).response
+    return response is not None and response.status_code == 200
 
-def send_update_put(key, message):
-    vector_clock[my_address_no_port] += 1
-    update_vector_clock_file()
-    headers = {'VC': json.dumps(vector_clock), 'Content-Type': 'application/json'}
+replication_log = ReplicationLog(send_replication_batch)
 
+def update_replication_peers():
     my_id = get_my_id()
     if my_id == -1:
-        return
+        replication_log.set_peers(set())
+    else:
+        replication_log.set_peers(shard_view_universe[my_id].difference({my_address}))
 
-    multicast(
-            shard_view_universe[my_id],
-            lambda address: 'http://' + address + route('/' + key),
-            http_method=HTTPMethods.PUT,
-            timeout=3,
-            data=json.dumps(message),
-            headers=headers
-            )
+def send_update(http_method, key, message=None):
+    """
+    Stamps a client write with our next vector clock entry and appends it
+    to the replication log, which sends it to the rest of our shard in the
+    background.
+
+    Returns:
+        int: The write's replication log offset, None if we have no shard.
+    """
+    advance_vector_clock(my_address_no_port)
+
+    if get_my_id() == -1:
+        return None
+
+    entry = {
+        'vc': clock_metadata(),
+        'op': http_method.name,
+        'key': key,
+        'data': message
+    }
+    op_log.append(my_address_no_port, dict(entry, vc=clock.decode(entry['vc'])))
+    return replication_log.append(entry)
+
+def send_update_put(key, message):
+    return send_update(HTTPMethods.PUT, key, message)
 
 def send_update_delete(key):
-    vector_clock[my_address_no_port] += 1
-    update_vector_clock_file()
-    headers = {'VC': json.dumps(vector_clock), 'Content-Type': 'application/json'}
+    return send_update(HTTPMethods.DELETE, key)
 
-    my_id = get_my_id()
-    if my_id == -1:
-        return
+def replication_acks_required(offset):
+    """
+    Returns:
+        int: How many replicas REPLICATION_ACK requires to acknowledge the
+             write at offset, None if we don't wait for any.  Replicas that
+             are down aren't waited for.
+    """
+    if offset is None or REPLICATION_ACK == 'local':
+        return None
 
-    multicast(
-            shard_view_universe[my_id],
-            lambda address: 'http://' + address + route('/' + key),
-            http_method=HTTPMethods.DELETE,
-            timeout=3,
-            headers=headers
-    )
+    update_replicas_view_alive()
+    alive_peers = shard_view_alive[get_my_id()].difference({my_address})
+    return 1 if REPLICATION_ACK == 'one' else len(alive_peers)
 
-def format_response(message, does_exist=None, error=None, value=None, replaced=None):
-    metadata = json.dumps(vector_clock, sort_keys=True)
-    res = {'message': message, 'causal-metadata' : metadata, 'version' : metadata, 'shard-id': str(get_my_id())}
+def replication_waited(offset, count, seconds, acked):
+    replication_wait.observe(seconds, 'acked' if acked else 'timed_out')
+    if not acked:
+        app.logger.warning(f'Write {offset} not acknowledged by {count} replicas in time')
+
+def wait_for_replication(offset):
+    """
+    Blocks until as many replicas as REPLICATION_ACK requires acknowledged
+    the write at offset.
+    """
+    count = replication_acks_required(offset)
+    if count is None:
+        return
+    start = monotonic()
+    acked = replication_log.wait_for_acks(offset, count, REPLICATION_ACK_TIMEOUT)
+    replication_waited(offset, count, monotonic() - start, acked)
+
+def format_result(message, does_exist=None, error=None, value=None, replaced=None):
+    res = {'message': message, 'shard-id': str(get_my_id())}
 
     if does_exist is not None:
         res['doesExist'] = does_exist
@@ -460,20 +886,102 @@ def format_response(message, does_exist=None, error=None, value=None, replaced=N
     if replaced is not None:
         res['replaced'] = replaced
 
-    return jsonify(res)
+    return res
 
-def can_be_delivered_client(incoming_vec):
+def clock_metadata():
+    """
+    Returns:
+        str: Our shard's entries of our vector clock, encoded.
+    """
+    my_id = get_my_id() if shard_view_universe is not None else -1 # Heartbeats start before we know our shard.
+    return encoded_clock.get(vector_clock, shard_view_universe_no_port[my_id] if my_id != -1 else None)
+
+def with_metadata(res):
+    metadata = clock_metadata()
+    return dict(res, **{'causal-metadata': metadata, 'version': metadata})
+
+def format_response(message, does_exist=None, error=None, value=None, replaced=None):
+    return jsonify(with_metadata(format_result(message, does_exist, error, value, replaced)))
+
+def respond(result):
+    res, status = result
+    return jsonify(with_metadata(res)), status
+
+def stamped_entry(address):
+    # The last clock entry of address we stamped a write with, committed or
+    # not.  Caller holds vector_clock_lock.
+    return vector_clock[address] + commits.pending(address)
+
+def advance_vector_clock(address):
+    vector_clock[address] += 1
+    encoded_clock.changed()
+    store.log_clock(address, vector_clock[address])
+    causal_waiters.advanced(address)
+
+def wait_for_causal_metadata(json_data):
+    """
+    Blocks until we delivered every write the client's causal metadata
+    depends on, or until CAUSAL_WAIT_TIMEOUT.  We're woken up as soon as the
+    clock entries we're missing advance.
+
+    Returns:
+        bool: False if we timed out first.
+    """
+    incoming_vec = causal_dependencies(json_data)
+    if incoming_vec is None:
+        return True
+    start = monotonic()
+    delivered = causal_waiters.wait(lambda: first_missing_dependency(incoming_vec), CAUSAL_WAIT_TIMEOUT)
+    causal_wait.observe(monotonic() - start, 'delivered' if delivered else 'timed_out')
+    return delivered
+
+def causal_dependencies(json_data):
+    """
+    Returns:
+        dict: The vector clock in the client's causal metadata, None if it
+              didn't send any.
+    """
+    has_metadata = json_data is not None and 'causal-metadata' in json_data and json_data['causal-metadata'] != ''
+    if not has_metadata:
+        return None
+    return clock.decode(json_data['causal-metadata'])
+
+def stale_shard_map(headers):
+    """
+    Clients routing keys themselves send the version of the shard map they
+    routed with.  If it's older than ours, we ask them to refresh it rather
+    than serve the request: their key may have moved, and vector clocks
+    restart with every shard view, so their causal metadata is meaningless.
+
+    Returns:
+        tuple: The result to answer with, or None to serve the request.
+    """
+    version = headers.get(SHARD_VIEW_VERSION_HEADER)
+    if version is None or not version.isdigit() or int(version) >= shard_view_version:
+        return None
+    res = format_result('Stale shard map', error=f'Shard map version {version} is older than {shard_view_version}')
+    return dict(res, **{'shard-view-version': shard_view_version}), STALE_SHARD_MAP
+
+def first_missing_dependency(incoming_vec):
+    """
+    Returns:
+        str: The address of an alive member of our shard whose writes we
+             haven't all delivered yet, None if we delivered them all.
+    """
     update_replicas_view_alive()
 
     my_id = get_my_id()
     if my_id == -1:
-        return False
+        return NO_SHARD
 
     for x in shard_view_alive[my_id]:
         cur_addr = x.split(":")[0]
-        if vector_clock[cur_addr] < incoming_vec[cur_addr]:
-            return False
-    return True
+        if vector_clock[cur_addr] < incoming_vec.get(cur_addr, 0):
+            return cur_addr
+    return None
+
+def can_be_delivered_client(incoming_vec):
+    return first_missing_dependency(incoming_vec) is None
 
 def can_be_delivered(incoming_vec, incoming_addr):
     update_replicas_view_alive()
@@ -486,75 +994,365 @@ def can_be_delivered(incoming_vec, incoming_addr):
         cur_addr = x.split(":")[0]
         if cur_addr == incoming_addr:
             continue
-        if vector_clock[cur_addr] < incoming_vec[cur_addr]:
+        if vector_clock[cur_addr] < incoming_vec.get(cur_addr, 0):
             return False
-    if incoming_vec[incoming_addr] == vector_clock[incoming_addr] + 1:
+    if incoming_vec.get(incoming_addr, 0) == vector_clock[incoming_addr] + 1:
         return True
     return False
 
+def attempt_get_message(key):
+    with key_locks.for_key(key):
+        try:
+            return format_result('Retrieved successfully', does_exist=True, value=store[key]), 200
+        except KeyError:
+            if store.reclaim(key):
+                expired_keys.inc('read')
+    return format_result('Error in GET', error='Key does not exist', does_exist=False), 404
+
+def superseded(key, json_data):
+    """
+    Returns:
+        bool: Whether we have a newer version of key than the write with
+              json_data, which concurrent writes on other replicas may have
+              delivered first.  Writes from before versions always apply.
+    """
+    version = json_data.get(VERSION_FIELD) if isinstance(json_data, dict) else None
+    current = store.version(key)
+    return version is not None and current is not None and current >= version
+
+def key_error(key):
+    """
+    Returns:
+        str: Why key can't be stored, None if it can.
+    """
+    if not isinstance(key, str) or key == '':
+        return INVALID_KEY
+    if len(key) > MAX_KEY_LENGTH:
+        return 'Key is too long'
+    return None
+
+def write_error(http_method, key, json_data):
+    """
+    Returns:
+        tuple: The result rejecting a client write we can't apply, None if
+               we can.  Deletes of keys that are too long just don't find
+               them.
+    """
+    error_message = 'Error in ' + http_method.name
+    if http_method == HTTPMethods.PUT:
+        if not isinstance(json_data, dict) or 'value' not in json_data:
+            return format_result(error_message, error='Value is missing'), 400
+        error = key_error(key)
+        if error is not None:
+            return format_result(error_message, error=error), 400
+        if invalid_ttl(json_data):
+            return format_result(error_message, error=INVALID_TTL), 400
+    elif not isinstance(key, str) or key == '':
+        return format_result(error_message, error=INVALID_KEY), 400
+    return None
+
 def attempt_deliver_put_message(key, json_data):
-    if 'value' not in json_data:
-        return format_response('Error in PUT', error='Value is missing'), 400
+    if not isinstance(json_data, dict) or 'value' not in json_data:
+        return format_result('Error in PUT', error='Value is missing'), 400
     value = json_data['value']
 
+    error = key_error(key)
+    if error is not None:
+        return format_result('Error in PUT', error=error), 400
     key_exists = key in store
-    if not key_exists and len(key) > 50:
-        return format_response('Error in PUT', error='Key is too long'), 400
-    store[key] = value
+    migration.note_write(key)
+    if superseded(key, json_data):
+        return format_result('Discarded'), 200
+    store.put(key, value, json_data.get('expires'), json_data.get(VERSION_FIELD, VERSION_ZERO))
 
     if key_exists:
-        return format_response('Updated successfully', replaced=True), 200
-    return format_response('Added successfully', replaced=False), 201
-
-def attempt_deliver_delete_message(key):
-    if key in store:
+        return format_result('Updated successfully', replaced=True), 200
+    return format_result('Added successfully', replaced=False), 201
+
+def attempt_deliver_delete_message(key, json_data=None):
+    if not isinstance(key, str) or key == '':
+        return format_result('Error in DELETE', error=INVALID_KEY), 400
+    migration.note_write(key) # Even if we don't have it yet, so the reshard doesn't bring it back.
+    if superseded(key, json_data):
+        return format_result('Discarded'), 200
+    key_exists = key in store
+    if isinstance(json_data, dict) and VERSION_FIELD in json_data:
+        store.delete(key, json_data[VERSION_FIELD]) # Leaves a tombstone, even if we didn't have it.
+    elif key_exists:
         del store[key]
-        return format_response('Deleted successfully', does_exist=True), 200
-    return format_response('Error in DELETE', does_exist=False, error='Key does not exist'), 404
+    if key_exists:
+        return format_result('Deleted successfully', does_exist=True), 200
+    return format_result('Error in DELETE', does_exist=False, error='Key does not exist'), 404
+
+def invalid_ttl(json_data):
+    ttl = json_data.get('ttl') if isinstance(json_data, dict) else None
+    if ttl is None:
+        return False
+    return isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or not 0 < ttl < math.inf
+
+def with_expiry(json_data):
+    """
+    Replaces a PUT's ttl with the time the key expires, which is replicated
+    with the write, so every replica expires it at the same time (as far as
+    their clocks agree).  Clients can't set the expiry directly.
+    """
+    if not isinstance(json_data, dict) or not ('ttl' in json_data or 'expires' in json_data):
+        return json_data
+    ttl = json_data.get('ttl')
+    json_data = {k: v for k, v in json_data.items() if k not in ('ttl', 'expires')}
+    if ttl is not None:
+        json_data['expires'] = time() + ttl
+    return json_data
+
+def next_version():
+    """
+    Returns:
+        list: The version of the client write we stamp next, [time, origin,
+              shard view version, clock entry].  It's past every version we
+              stored, so the write wins over whatever the client could have
+              read here.  Caller holds vector_clock_lock, and took the
+              write's ticket.
+    """
+    return [max(time(), store.latest + VERSION_RESOLUTION), my_address_no_port, shard_view_version, stamped_entry(my_address_no_port)]
+
+def apply_client_write(http_method, key, json_data=None):
+    """
+    Stamps a client write with a version, applies it, then advances our
+    clock entry and appends it to the replication log.  Like deliver(), the
+    store logs the write before the clock entry that claims it, so a crash
+    in between never recovers a clock ahead of the data, nor one a peer got
+    the write for.
+
+    Only stamping and logging hold vector_clock_lock.  The write is applied
+    under its key's lock only, taken when it's stamped, so writes of a key
+    apply in the order they're stamped, and writes of other keys apply in
+    parallel.  commits logs them in the order they were stamped.
+
+    Writes we can't apply are rejected before they're stamped, so they're
+    never replicated.
+
+    Returns:
+        tuple: The write's replication log offset, and its result.
+    """
+    error = write_error(http_method, key, json_data)
+    if error is not None:
+        return None, error
+    if http_method == HTTPMethods.PUT:
+        json_data = with_expiry(json_data)
+    key_lock = key_locks.for_key(key)
+    with vector_clock_lock:
+        commits.admit()
+        ticket = commits.stamp(my_address_no_port)
+        key_lock.acquire()
+        json_data = dict(json_data if isinstance(json_data, dict) else {}, **{VERSION_FIELD: next_version()})
+    try:
+        if http_method == HTTPMethods.PUT:
+            out = attempt_deliver_put_message(key, json_data)
+        else:
+            out = attempt_deliver_delete_message(key, json_data)
+    finally:
+        key_lock.release()
+        with vector_clock_lock, commits.commit(ticket):
+            offset = send_update(http_method, key, json_data)
+    if remote_cache.enabled:
+        invalidation_feed.add(key)
+    return offset, out
+
+def apply_write(http_method, key, json_data):
+    if not isinstance(key, str):
+        return format_result('Error in ' + http_method.name, error=INVALID_KEY), 400
+    with key_locks.for_key(key):
+        if http_method == HTTPMethods.PUT:
+            return attempt_deliver_put_message(key, json_data)
+        return attempt_deliver_delete_message(key, json_data)
+
+def deliver(ticket, http_method, key, json_data, incoming_vec, incoming_addr):
+    # Apply the write under its key's lock only, then advance our clock, in
+    # the order writes were stamped, so a crash in between never persists
+    # the entry without the write.  A write we can't apply still advances
+    # it, so it doesn't hold back the sender's writes after it.
+    try:
+        return apply_write(http_method, key, json_data)
+    finally:
+        with vector_clock_lock, commits.commit(ticket):
+            advance_vector_clock(incoming_addr)
+            op_log.append(incoming_addr, {'vc': incoming_vec, 'op': http_method.name, 'key': key, 'data': json_data})
+
+def receive_update(http_method, key, json_data, incoming_vec, incoming_addr):
+    """
+    Delivers a write replicated by another member of our shard, or caches it
+    in the delivery buffer if it's out of order.
+    """
+    with vector_clock_lock:
+        commits.admit()
+        if incoming_vec.get(incoming_addr, 0) <= stamped_entry(incoming_addr):
+            # Already delivered, or being delivered, the sender retried after losing our response.
+            return format_result('Discarded'), 200
+
+        if not can_be_delivered(incoming_vec, incoming_addr):
+            buffer_message([incoming_vec, [http_method.name, incoming_addr, key, json_data]])
+            return format_result('Cached successfully'), 200
+        ticket = commits.stamp(incoming_addr)
+
+    out = deliver(ticket, http_method, key, json_data, incoming_vec, incoming_addr)
+    # deliver all messages in buffer
+    deliver_from_buffer()
+    return out
+
+def buffer_message(message):
+    delivery_buffer.add(message)
+    store.log_buffered(message)
+
+def flush_delivery_buffer():
+    # Applies every buffered write regardless of causal order, without
+    # advancing the clock, and empties the buffer.  Caller holds vector_clock_lock.
+    for _, meta_data in delivery_buffer.to_list():
+        http_method, key = HTTPMethods[meta_data[0]], meta_data[2]
+        json_data = meta_data[3] if len(meta_data) > 3 else None
+        apply_write(http_method, key, json_data)
+    delivery_buffer.clear()
 
 def deliver_from_buffer():
-    for item in delivery_buffer:
-        incoming_vec = item[0]
-        meta_data = item[1]
-        incoming_addr = meta_data[1]
-        if can_be_delivered(incoming_vec, incoming_addr):
+    # Only the next message of each sender can be deliverable.  Deliver
+    # those one at a time, until none is left.  A sender's message being
+    # delivered by another thread isn't committed yet, so the one after it
+    # isn't deliverable, and that thread delivers it.
+    while True:
+        with vector_clock_lock:
+            commits.admit()
+            for incoming_addr in delivery_buffer.senders():
+                next_entry = stamped_entry(incoming_addr) + 1
+                item = delivery_buffer.get(incoming_addr, next_entry)
+                if item is not None and can_be_delivered(item[0], incoming_addr):
+                    break
+            else:
+                return
+
             # deliver message here and remove from buffer
-            if meta_data[0] == 'PUT':
-                attempt_deliver_put_message(meta_data[2], meta_data[3])
-                delivery_buffer.remove(item)
-                vector_clock[incoming_addr] += 1
-                update_vector_clock_file()
-            elif meta_data[0] == 'DELETE':
-                attempt_deliver_delete_message(meta_data[2])
-                delivery_buffer.remove(item)
-                vector_clock[incoming_addr] += 1
-                update_vector_clock_file()
-            # call deliver_from_buffer() again
-            deliver_from_buffer()
-            return
+            meta_data = delivery_buffer.pop(incoming_addr, next_entry)[1]
+            ticket = commits.stamp(incoming_addr)
+        json_data = meta_data[3] if len(meta_data) > 3 else None # Deletes buffered before versions had no data.
+        deliver(ticket, HTTPMethods[meta_data[0]], meta_data[2], json_data, item[0], incoming_addr)
+
+def forward_get(shard_id, key):
+    """
+    Forwards a GET to the key's shard, unless we cached an answer that
+    satisfies the request's causal metadata.
+    """
+    cached = cached_remote_read(shard_id, key, request.get_json(silent=True))
+    if cached is not None:
+        key_requests.inc('GET', 'cached')
+        return cached.body, cached.status, {'Content-Type': 'application/json'}
+
+    key_requests.inc('GET', 'forwarded')
+    started = remote_cache.begin()
+    forwarded = forward_request(shard_id, key, HTTPMethods.GET)
+    cache_remote_read(shard_id, key, started, forwarded[0], forwarded[1])
+    return forwarded
+
+def cached_remote_read(shard_id, key, json_data):
+    """
+    Returns:
+        CachedRead: Our cached answer to a GET of another shard's key, if it
+                    satisfies the request's causal metadata, else None.
+    """
+    if not remote_cache.enabled:
+        return None
+    return remote_cache.get(key, shard_id, causal_dependencies(json_data), shard_view_universe_no_port[shard_id])
+
+def cache_remote_read(shard_id, key, started, body, status):
+    if not remote_cache.enabled or status not in (200, 404):
+        return
+    try:
+        answer_vector_clock = clock.decode(json.loads(body)['causal-metadata'])
+    except (ValueError, KeyError, TypeError):
+        return
+    remote_cache.put(key, shard_id, body, status, answer_vector_clock, started)
+
+def send_invalidations(keys):
+    my_id = get_my_id()
+    if my_id == -1:
+        return
+    multicast(
+        sorted(replicas_view_alive.difference(shard_view_universe[my_id])),
+        lambda a: 'http://' + a + route('-invalidate'),
+        http_method=HTTPMethods.POST,
+        data=json.dumps({'keys': keys}),
+        headers={'Content-Type': 'application/json'}
+    )
+
+invalidation_feed = InvalidationFeed(send_invalidations) # Our keys' writes, for the other shards' caches.
+
+def valid_read(response):
+    # Replicas answer 503 if they timed out waiting for the read's causal dependencies.
+    return response is not None and response.status_code < 500
+
+def forward_request(shard_id, key, http_method, handoff=False):
+    shard = sorted(shard_view_alive[shard_id])
+    if (len(shard) == 0):
+        return '', 418
+
+    headers = dict(request.headers)
+    if handoff:
+        headers[HANDOFF_HEADER] = '1'
+    data = request.get_data()
+
+    def send(address):
+        return unicast(
+            address,
+            lambda a: 'http://' + a + route('/' + key),
+            http_method=http_method,
+            data=data,
+            headers=headers
+        ).response
+
+    if HEDGE_READS and http_method == HTTPMethods.GET:
+        response = hedger.send(shard_id, shard, send, valid_read)
+    else:
+        response = send(selector.choose(shard))
+
+    if response is None:
+        raise ShardNoResponse
+    return (response.text, response.status_code, response.headers.items())
 
 @app.route(route(), methods=['GET'])
 def store_get():
-    resp = {'store': store, 'delivery_buffer': delivery_buffer, 'vector_clock': vector_clock}
-    return jsonify(resp), 200
+    with vector_clock_lock, key_locks.all():
+        resp = {'store': store.to_dict(), 'delivery_buffer': delivery_buffer.to_list(), 'vector_clock': vector_clock}
+        return jsonify(resp), 200
 
 
 @app.route(route('/<key>'), methods=['GET'])
 def kvs_get(key):
     update_replicas_view_alive()
 
-    hashed_id = int_sha256(key) % SHARD_COUNT
-    if hashed_id != get_my_id():
-        shard = sorted(shard_view_alive[hashed_id])
-        if (len(shard) == 0):
-            return '', 418
-        server = random.randrange(len(shard))
-        response = requests.get('http://' + shard[server] + route('/' + key))
-        return (response.text, response.status_code, response.headers.items())
+    if HANDOFF_HEADER in request.headers:
+        # The key's new owner doesn't have it yet, and we still do.
+        key_requests.inc('GET', 'handoff')
+        return respond(attempt_get_message(key))
 
-    if key in store:
-        return format_response('Retrieved successfully', does_exist=True, value=store[key]), 200
-    return format_response('Error in GET', error='Key does not exist', does_exist=False), 404
+    stale = stale_shard_map(request.headers)
+    if stale is not None:
+        return respond(stale)
+
+    hashed_id = key_to_shard_id(key)
+    my_id = get_my_id()
+    if hashed_id != my_id:
+        return forward_get(hashed_id, key)
+
+    key_requests.inc('GET', 'local')
+    if not wait_for_causal_metadata(request.get_json(silent=True)):
+        return format_response('Error in GET', error=CAUSAL_WAIT_TIMED_OUT), 503
+
+    previous_shard_id = migration.previous_shard_id(key)
+    if key not in store and previous_shard_id not in (None, my_id):
+        try:
+            forwarded = forward_request(previous_shard_id, key, HTTPMethods.GET, handoff=True)
+            if forwarded[1] != 404 or key not in store:
+                return forwarded
+        except ShardNoResponse:
+            pass
+    return respond(attempt_get_message(key))
 
 
 @app.route(route('/<key>'), methods=['PUT'])
@@ -564,88 +1362,271 @@ def kvs_put(key):
 
     update_replicas_view_alive()
 
-    hashed_id = int_sha256(key) % SHARD_COUNT
+    stale = stale_shard_map(request.headers)
+    if stale is not None:
+        return respond(stale)
+
+    hashed_id = key_to_shard_id(key)
     my_id = get_my_id()
     if hashed_id != my_id:
-        shard = sorted(shard_view_alive[hashed_id])
-        if (len(shard) == 0):
-            return '', 418
-        server = random.randrange(len(shard))
-        response = requests.put('http://' + shard[server] + route('/' + key), headers=request.headers, data=request.get_data())
-        return (response.text, response.status_code, response.headers.items())
+        key_requests.inc('PUT', 'forwarded')
+        return forward_request(hashed_id, key, HTTPMethods.PUT)
 
     # Check here if message from fellow servers
     if incoming_addr == my_address_no_port:
         # Ignore messages sent from itself
         return format_response('Discarded'), 200
     elif incoming_addr not in shard_view_universe_no_port[my_id]:
-        # Check for causal metadata
-        has_metadata = json_data is not None and 'causal-metadata' in json_data and json_data['causal-metadata'] != ''
-        if has_metadata:
-            while not can_be_delivered_client(json.loads(json_data['causal-metadata'])):
-                sleep(5)
-        # Forward message here
-        send_update_put(key, json_data)
-        return attempt_deliver_put_message(key, json_data)
+        key_requests.inc('PUT', 'local')
+        if not wait_for_causal_metadata(json_data):
+            return format_response('Error in PUT', error=CAUSAL_WAIT_TIMED_OUT), 503
+        offset, out = apply_client_write(HTTPMethods.PUT, key, json_data)
+        wait_for_replication(offset)
+        return respond(out)
     else:
         # Check vector clock here. If out of order, cache
-        incoming_vec = json.loads(request.headers.get('VC'))
-        if can_be_delivered(incoming_vec, incoming_addr):
-            # deliver message
-            vector_clock[incoming_addr] += 1
-            update_vector_clock_file()
-            out = attempt_deliver_put_message(key, json_data)
-            # deliver all messages in buffer
-            deliver_from_buffer()
-            return out
-        else:
-            delivery_buffer.append([incoming_vec, ['PUT', incoming_addr, key, json_data]])
-            return format_response('Cached successfully'), 200
+        incoming_vec = clock.decode(request.headers.get('VC'))
+        key_requests.inc('PUT', 'replicated')
+        return respond(receive_update(HTTPMethods.PUT, key, json_data, incoming_vec, incoming_addr))
 
 
 @app.route(route('/<key>'), methods=['DELETE'])
 def kvs_delete(key):
     update_replicas_view_alive()
 
-    hashed_id = int_sha256(key) % SHARD_COUNT
+    stale = stale_shard_map(request.headers)
+    if stale is not None:
+        return respond(stale)
+
+    hashed_id = key_to_shard_id(key)
     my_id = get_my_id()
     if hashed_id != my_id:
-        shard = sorted(shard_view_alive[hashed_id])
-        if (len(shard) == 0):
-            return '', 418
-        server = random.randrange(len(shard))
-        response = requests.delete('http://' + shard[server] + route('/' + key), headers=request.headers, data=request.get_data())
-        return (response.text, response.status_code, response.headers.items())
+        key_requests.inc('DELETE', 'forwarded')
+        return forward_request(hashed_id, key, HTTPMethods.DELETE)
 
     # Check here if message from fellow server
     incoming_addr = request.remote_addr
-    json_data = request.get_json()
+    json_data = request.get_json(silent=True) # Deletes may have no body.
     if incoming_addr == my_address_no_port:
         # Ignore messages sent from itself
         return format_response('Discarded'), 200
     elif incoming_addr not in shard_view_universe_no_port[my_id]: # Not from my shard.
-        # Check for causal metadata
-        has_metadata = json_data is not None and 'causal-metadata' in json_data and json_data['causal-metadata'] != ''
-        if has_metadata:
-            while not can_be_delivered_client(json.loads(json_data['causal-metadata'])):
-                sleep(5)
-        # Forward message here
-        send_update_delete(key)
-        return attempt_deliver_delete_message(key)
+        key_requests.inc('DELETE', 'local')
+        if not wait_for_causal_metadata(json_data):
+            return format_response('Error in DELETE', error=CAUSAL_WAIT_TIMED_OUT), 503
+        offset, out = apply_client_write(HTTPMethods.DELETE, key, json_data)
+        wait_for_replication(offset)
+        return respond(out)
     else:
         # Check vector clock here. If out of order, cache
-        incoming_vec = json.loads(request.headers.get('VC'))
-        if can_be_delivered(incoming_vec, incoming_addr):
-            # deliver message
-            vector_clock[incoming_addr] += 1
-            update_vector_clock_file()
-            out = attempt_deliver_delete_message(key)
-            # deliver all messages in buffer
-            deliver_from_buffer()
-            return out
+        incoming_vec = clock.decode(request.headers.get('VC'))
+        key_requests.inc('DELETE', 'replicated')
+        return respond(receive_update(HTTPMethods.DELETE, key, json_data, incoming_vec, incoming_addr))
+
+
+@app.route(route('-replicate'), methods=['PUT'])
+def replicate_put():
+    incoming_addr = request.remote_addr
+    if incoming_addr not in replicas_view_no_port:
+        return jsonify(UNAUTHED_REPLICA_ORIGIN), 401
+
+    for entry in request.get_json()['entries']:
+        try:
+            http_method = HTTPMethods[entry['op']]
+            incoming_vec = clock.decode(entry['vc'])
+        except (KeyError, TypeError, ValueError, AttributeError):
+            app.logger.warning(f'Skipped malformed replicated entry from {incoming_addr}: {entry!r}')
+            continue
+        if http_method not in (HTTPMethods.PUT, HTTPMethods.DELETE):
+            app.logger.warning(f'Skipped replicated {http_method.name} from {incoming_addr}')
+            continue
+        key_requests.inc(http_method.name, 'replicated')
+        receive_update(http_method, entry.get('key'), entry.get('data'), incoming_vec, incoming_addr)
+    return jsonify({'message': 'Replicated successfully'}), 200
+
+
+@app.route(route('-catchup'), methods=['POST'])
+def catchup_post():
+    """
+    Streams what a lagging member of our shard is missing, one JSON object
+    per line.  The first line says whether the rest are operations to
+    deliver or, if our operation log no longer has them all, chunks of our
+    store to install along with the header's vector clock and delivery
+    buffer.
+    """
+    incoming_addr = request.remote_addr
+    if incoming_addr not in replicas_view_no_port:
+        return jsonify(UNAUTHED_REPLICA_ORIGIN), 401
+    incoming_vec = request.get_json()['vector_clock']
+
+    with vector_clock_lock, key_locks.all():
+        operations = op_log.missing(incoming_vec)
+        if operations is None:
+            items = store.export()
+            header = {'mode': 'snapshot', 'vector_clock': dict(vector_clock), 'delivery_buffer': delivery_buffer.to_list()}
+        else:
+            header = {'mode': 'operations', 'count': len(operations)}
+
+    def stream():
+        yield json.dumps(header) + '\n'
+        if operations is not None:
+            for operation in operations:
+                yield json.dumps(operation) + '\n'
+        else:
+            for i in range(0, len(items), CATCHUP_CHUNK_SIZE):
+                yield json.dumps({'items': items[i:i + CATCHUP_CHUNK_SIZE]}) + '\n'
+
+    return Response(stream(), mimetype='application/x-ndjson')
+
+
+@app.route(route('-merkle'), methods=['POST'])
+def merkle_post():
+    json_data = request.get_json()
+    with vector_clock_lock, key_locks.all():
+        return jsonify({
+            'vector_clock': vector_clock,
+            'shard_view_version': shard_view_version,
+            'hashes': store.tree.hashes(json_data['level'], json_data['nodes'])
+        }), 200
+
+@app.route(route('-merkle-leaves'), methods=['POST'])
+def merkle_leaves_post():
+    with vector_clock_lock, key_locks.all():
+        keys = store.tree.leaf_keys(request.get_json()['leaves'])
+        return jsonify({
+            'vector_clock': vector_clock,
+            'shard_view_version': shard_view_version,
+            'items': [record for record in map(store.record, keys) if record is not None]
+        }), 200
+
+
+def merge_vector_clocks(a, b):
+    return {address: max(a.get(address, 0), b.get(address, 0)) for address in set(a).union(b)}
+
+def execute_batch(operations, json_data):
+    """
+    Executes operations on keys owned by our shard, in order.
+
+    Returns:
+        list: The result of each operation, with its status code.
+    """
+    if not wait_for_causal_metadata(json_data):
+        error = format_result('Error in batch', error=CAUSAL_WAIT_TIMED_OUT)
+        return [dict(error, key=operation['key'], status=503) for operation in operations]
+
+    results = []
+    offset = None
+    for operation in operations:
+        key = operation['key']
+        http_method = HTTPMethods[operation['op']]
+        if http_method == HTTPMethods.GET:
+            res, status = attempt_get_message(key)
         else:
-            delivery_buffer.append([incoming_vec, ['DELETE', incoming_addr, key]])
-            return format_response('Cached successfully'), 200
+            message = {k: operation[k] for k in ('value', 'ttl') if k in operation} if http_method == HTTPMethods.PUT else None
+            write_offset, (res, status) = apply_client_write(http_method, key, message)
+            offset = offset if write_offset is None else write_offset # Rejected writes aren't logged.
+        results.append(dict(res, key=key, status=status))
+
+    # The log is sent in order, so acknowledging the last write acknowledges them all.
+    wait_for_replication(offset)
+    return results
+
+def forward_batch(shard_id, operations, json_data):
+    shard = sorted(shard_view_alive[shard_id])
+    if (len(shard) == 0):
+        return None
+
+    response = unicast(
+        selector.choose(shard),
+        lambda a: 'http://' + a + route('-batch'),
+        http_method=HTTPMethods.POST,
+        data=json.dumps({
+            'operations': operations,
+            'causal-metadata': json_data.get('causal-metadata', ''),
+            'forwarded': True
+        }),
+        headers={'Content-Type': 'application/json'}
+    ).response
+    if response is None or response.status_code != 200:
+        return None
+    return response.json()
+
+
+@app.route(route('-invalidate'), methods=['POST'])
+def invalidate_post():
+    remote_cache.invalidate(request.get_json()['keys'])
+    return jsonify({'message': 'Invalidated'}), 200
+
+
+@app.route(route('-batch'), methods=['POST'])
+def batch_post():
+    json_data = request.get_json()
+    operations = json_data.get('operations') if isinstance(json_data, dict) else None
+    if not isinstance(operations, list):
+        return jsonify({
+            'error': 'Operations are missing',
+            'message': 'Error in batch'
+        }), 400
+
+    update_replicas_view_alive()
+
+    # Group the operations by owning shard, remembering where their results go.
+    my_id = get_my_id()
+    results = [None] * len(operations)
+    shard_to_indexes = defaultdict(list)
+    for i, operation in enumerate(operations):
+        is_valid = isinstance(operation, dict) and operation.get('op') in ('GET', 'PUT', 'DELETE') and 'key' in operation
+        if not is_valid:
+            results[i] = dict(format_result('Error in batch', error='Invalid operation'), status=400)
+            continue
+        error = key_error(operation['key'])
+        if error is not None:
+            key = operation['key'] if isinstance(operation['key'], str) else None
+            results[i] = dict(format_result('Error in batch', error=error), key=key, status=400)
+            continue
+
+        shard_id = key_to_shard_id(operation['key'])
+        if shard_id != my_id and json_data.get('forwarded', False):
+            # Our shard views disagree, don't forward it again.
+            results[i] = dict(format_result('Error in batch', error='Key belongs to another shard'), key=operation['key'], status=421)
+            continue
+        shard_to_indexes[shard_id].append(i)
+
+    # Send every other shard its operations in one request, in parallel with our own.
+    shard_to_future = {}
+    for shard_id, indexes in shard_to_indexes.items():
+        if shard_id != my_id:
+            shard_to_future[shard_id] = get_executor().submit(
+                forward_batch,
+                shard_id,
+                [operations[i] for i in indexes],
+                json_data
+            )
+
+    if my_id in shard_to_indexes:
+        local_results = execute_batch([operations[i] for i in shard_to_indexes[my_id]], json_data)
+        for i, res in zip(shard_to_indexes[my_id], local_results):
+            results[i] = res
+
+    merged_vector_clock = dict(vector_clock)
+    for shard_id, future in shard_to_future.items():
+        shard_response = future.result()
+        indexes = shard_to_indexes[shard_id]
+        if shard_response is None:
+            for i in indexes:
+                results[i] = dict(format_result('Error in batch', error='Shard is unavailable'), key=operations[i]['key'], status=503)
+            continue
+        for i, res in zip(indexes, shard_response['results']):
+            results[i] = res
+        merged_vector_clock = merge_vector_clocks(merged_vector_clock, clock.decode(shard_response['causal-metadata']))
+
+    metadata = clock.encode(merged_vector_clock)
+    return jsonify({
+        'message': 'Batch executed successfully',
+        'results': results,
+        'causal-metadata': metadata,
+        'version': metadata
+    }), 200
 
 
 @app.route(route('-view'), methods=['GET'])
@@ -662,6 +1643,8 @@ def view_get():
 
 @app.route(route('-view'), methods=['PUT'])
 def view_put():
+    global replicas_view_no_port
+    global replicas_view_universe
     #if not is_replica(request.remote_addr):
     #    return jsonify(UNAUTHED_REPLICA_ORIGIN), 401
 
@@ -675,27 +1658,13 @@ def view_put():
     else:
         if target not in replicas_view_universe:
             target_no_port = target.split(':')[0]
-            vector_clock[target_no_port] = 0
-            update_vector_clock_file()
-            replicas_view_no_port.add(target_no_port)
-            replicas_view_universe.add(target)
-            update_replicas_view_universe_file()
-
-        replicas_view_alive.add(target)
-
-        while True:
-            try:
-                with open(replicas_view_alive_filename, 'r+') as f:
-                    previous_alive = set(json.load(f))
-                    if target not in previous_alive:
-                        current_alive = previous_alive.union({target})
-                        f.truncate(0)
-                        f.seek(0)
-                        json.dump(list(current_alive), f)
-            except (FileNotFoundError, IOError):
-                sleep(heartbeat.INTERVAL)
-            break
+            with view_lock, vector_clock_lock:
+                vector_clock.setdefault(target_no_port, 0)
+                replicas_view_no_port = replicas_view_no_port.union({target_no_port})
+                replicas_view_universe = replicas_view_universe.union({target})
 
+        heartbeat.set_alive(target, True)
+        update_replicas_view_alive()
 
         return jsonify({
             'message': 'Replica added successfully to the view'}
@@ -723,9 +1692,13 @@ def view_delete():
         }), 404
 
 
-@app.route(heartbeat.ENDPOINT, methods=['GET'])
+@app.route(heartbeat.ENDPOINT, methods=['GET', 'POST'])
 def heartbeat_get():
-    incoming_vec = json.loads(request.headers.get('VC'))
+    body = {'status': 'OK'}
+    if request.method == 'POST':
+        body.update(heartbeat.receive(request.get_json(silent=True)))
+
+    incoming_vec = clock.decode(request.headers.get('VC'))
     incoming_addr = request.remote_addr
 
     incoming_addr_with_port = None
@@ -736,21 +1709,26 @@ def heartbeat_get():
 
     sender_is_replica = incoming_addr_with_port is not None
     if not sender_is_replica:
-        return jsonify({'status': 'OK'}), 200
+        return jsonify(body), 200
 
     previous_vecs = previously_received_vector_clocks[incoming_addr]
     steady_state = all([incoming_vec == previous_vec for previous_vec in previous_vecs])
     my_id = get_my_id()
-    if steady_state and my_id != -1 and incoming_addr in shard_view_universe[my_id]:
+    if steady_state and my_id != -1 and incoming_addr in shard_view_universe_no_port[my_id]:
         if not can_be_delivered_client(incoming_vec):
-            pull_state(incoming_addr_with_port)
+            get_executor().submit(catch_up, incoming_addr_with_port)
 
     # Double ended queue.  Dequeue last VC from the beginning if at capacity.  Enqueue incoming VC to the end.
     if (len(previously_received_vector_clocks[incoming_addr]) > previously_received_vector_clocks_CAPACITY):
         del previously_received_vector_clocks[incoming_addr][0]
     previously_received_vector_clocks[incoming_addr].append(incoming_vec)
 
-    return jsonify({'status': 'OK'}), 200
+    return jsonify(body), 200
+
+
+@app.route(heartbeat.PROBE_ENDPOINT, methods=['POST'])
+def heartbeat_probe_post():
+    return jsonify(heartbeat.probe_for(request.get_json())), 200
 
 
 if __name__ == '__main__':
@@ -0,0 +1,109 @@
+from contextlib import contextmanager
+import os
+import threading
+
+
+KEY_LOCK_STRIPES = int(os.environ.get('KEY_LOCK_STRIPES', 64)) # Locks the key space is split over.
+
+
+class StripedLock:
+    """
+    A fixed set of locks over the key space, each guarding every key that
+    hashes to it, so operations on different keys rarely wait on each other
+    while we keep a constant number of locks.
+
+    Key locks are always taken after the state lock (vector clock, delivery
+    buffer and replication log) when both are needed, never before, and
+    all() takes the stripes in order, so they can't deadlock.
+    """
+
+    def __init__(self, stripes=KEY_LOCK_STRIPES):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    def for_key(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+    @contextmanager
+    def all(self):
+        """
+        Holds every stripe, for operations that need a consistent view of
+        the whole store.
+        """
+        for lock in self.locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(self.locks):
+                lock.release()
+
+
+class CommitQueue:
+    """
+    Commits writes in the order they were stamped, though they're applied
+    outside the state lock, under their key's lock only, so writes of
+    different keys apply in parallel.
+
+    A write takes a ticket with the state lock held, when it's stamped,
+    applies, then commits with the state lock held again, once every write
+    stamped before it committed.  The entries of each address stamped and
+    not committed yet are counted, so writes stamped next know theirs.
+
+    Args:
+        lock: The state lock, which every method expects the caller to hold.
+    """
+
+    def __init__(self, lock):
+        self.cond = threading.Condition(lock)
+        self.next = 0 # Ticket of the next write stamped.
+        self.committed = 0 # Tickets committed, in order.
+        self.addresses = {} # Ticket to the address of the clock entry its write advances.
+        self.draining = 0 # Callers of drained() waiting for the tickets to commit.
+
+    def admit(self):
+        """
+        Waits until writes may be stamped, while drained() holds them back.
+        """
+        self.cond.wait_for(lambda: not self.draining)
+
+    def stamp(self, address):
+        """
+        Returns:
+            int: The ticket of a write that advances address's clock entry,
+                 to commit, whatever happens to the write.
+        """
+        ticket = self.next
+        self.next += 1
+        self.addresses[ticket] = address
+        return ticket
+
+    def pending(self, address):
+        return sum(1 for a in self.addresses.values() if a == address)
+
+    @contextmanager
+    def commit(self, ticket):
+        """
+        Waits until every write stamped before ticket committed, then
+        commits it when the block exits.
+        """
+        self.cond.wait_for(lambda: self.committed == ticket)
+        try:
+            yield
+        finally:
+            del self.addresses[ticket]
+            self.committed += 1
+            self.cond.notify_all()
+
+    @contextmanager
+    def drained(self):
+        """
+        Holds back new writes until the ones in flight committed, for
+        operations that replace the vector clock.
+        """
+        self.draining += 1
+        try:
+            self.cond.wait_for(lambda: self.committed == self.next)
+            yield
+        finally:
+            self.draining -= 1
+            self.cond.notify_all()
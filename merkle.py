@@ -0,0 +1,70 @@
+from hashring import int_sha256
+import json
+import os
+
+
+MERKLE_DEPTH = int(os.environ.get('MERKLE_DEPTH', 10)) # The tree has 2 ** MERKLE_DEPTH leaves.
+
+
+def item_hash(record):
+    return int_sha256(json.dumps(record))
+
+
+class MerkleTree:
+    """
+    Hash tree over the keys of a store, split into 2 ** depth leaves by key
+    hash range.
+
+    A node's hash is the XOR of the hashes of the record of every key in its
+    range, as StorageEngine.record() returns it: its version and value, with
+    its expiry if it has one, or only its version if it's a tombstone.  A
+    write only updates the depth + 1 nodes on its leaf's path, and two
+    stores differ in a range exactly when their hashes for it do (barring
+    collisions).  Nodes are
+    numbered by level, the root being node 0 of level 0 and the children of
+    node n being nodes 2n and 2n + 1 of the next level.  Every node must use
+    the same depth.
+    """
+
+    def __init__(self, depth=MERKLE_DEPTH):
+        self.depth = depth
+        self.nodes = [0] * (2 << depth) # Heap order: node n of level l is at (1 << l) + n.
+        self.keys = [set() for _ in range(1 << depth)] # Leaf to its keys.
+
+    def leaf(self, key):
+        return int_sha256(key) >> (256 - self.depth)
+
+    def toggle(self, record):
+        # Adds record to its leaf's path if absent, removes it if present.
+        h = item_hash(record)
+        i = (1 << self.depth) + self.leaf(record[0])
+        while i >= 1:
+            self.nodes[i] ^= h
+            i //= 2
+
+    def add(self, record):
+        self.toggle(record)
+        self.keys[self.leaf(record[0])].add(record[0])
+
+    def remove(self, record):
+        self.toggle(record)
+        self.keys[self.leaf(record[0])].discard(record[0])
+
+    def clear(self):
+        self.nodes = [0] * (2 << self.depth)
+        self.keys = [set() for _ in range(1 << self.depth)]
+
+    def rebuild(self, records):
+        self.clear()
+        for record in records:
+            self.add(record)
+
+    def hashes(self, level, nodes):
+        """
+        Returns:
+            list: The hex hashes of the given nodes of a level.
+        """
+        return [format(self.nodes[(1 << level) + n], 'x') for n in nodes]
+
+    def leaf_keys(self, leaves):
+        return [key for leaf in leaves for key in list(self.keys[leaf])]
@@ -0,0 +1,176 @@
+from bisect import bisect_left
+import math
+import threading
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # Seconds.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8' # Prometheus text exposition format.
+
+# Every thread records into its own dict, which only it writes to, so
+# recording takes no lock.  Scrapes read and add up the dicts of every thread.
+local = threading.local()
+shards = [] # (thread, values) of every thread that recorded something.
+retired = {} # Values recorded by threads that exited since.
+shards_lock = threading.Lock() # Taken once per thread, and by scrapes.
+
+registry = [] # Every metric, in the order they're exported.
+
+
+def thread_values():
+    values = getattr(local, 'values', None)
+    if values is None:
+        values = local.values = {}
+        with shards_lock:
+            shards.append((threading.current_thread(), values))
+    return values
+
+
+def merge(into, values):
+    for key, value in values:
+        if isinstance(value, list):
+            total = into.get(key)
+            if total is None:
+                into[key] = list(value)
+            else:
+                for i, v in enumerate(value):
+                    total[i] += v
+        else:
+            into[key] = into.get(key, 0) + value
+
+
+def collect():
+    """
+    Returns:
+        dict: Maps (metric name, label values) to the total of every thread.
+    """
+    with shards_lock:
+        for shard in [s for s in shards if not s[0].is_alive()]:
+            merge(retired, list(shard[1].items()))
+            shards.remove(shard)
+        # Copying a dict holds the GIL, so its owner can't change it midway.
+        copies = [list(values.items()) for _, values in shards]
+        totals = {}
+        merge(totals, list(retired.items()))
+    for values in copies:
+        merge(totals, values)
+    return totals
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=None):
+    pairs = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        registry.append(self)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+
+    def samples(self, totals):
+        return [(labels, value) for (name, labels), value in totals.items() if name == self.name]
+
+
+class Counter(Metric):
+    """
+    A count that only goes up, per combination of label values.
+    """
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        values = thread_values()
+        key = (self.name, label_values)
+        values[key] = values.get(key, 0) + amount
+
+    def render(self, totals):
+        lines = self.header()
+        for label_values, value in sorted(self.samples(totals)):
+            lines.append(f'{self.name}{format_labels(self.labels, label_values)} {format_value(value)}')
+        return lines
+
+
+class Histogram(Metric):
+    """
+    Counts of observations per bucket, and their sum, per combination of
+    label values.  Each thread keeps non cumulative bucket counts, which
+    scrapes add up.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        values = thread_values()
+        key = (self.name, label_values)
+        counts = values.get(key)
+        if counts is None:
+            counts = values[key] = [0] * (len(self.buckets) + 2) # A count per bucket, one past the last, and the sum.
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self, totals):
+        lines = self.header()
+        for label_values, counts in sorted(self.samples(totals)):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = format_labels(self.labels, label_values, ('le', format_value(bound)))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {format_value(counts[-1])}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Gauge(Metric):
+    """
+    A value read when scraped.
+
+    Args:
+        function (function): Returns the value, or a dict of label values
+                             (tuples) to values.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, documentation, function, labels=()):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def render(self, totals):
+        lines = self.header()
+        value = self.function()
+        samples = sorted(value.items()) if isinstance(value, dict) else [((), value)]
+        for label_values, v in samples:
+            lines.append(f'{self.name}{format_labels(self.labels, label_values)} {format_value(v)}')
+        return lines
+
+
+def render():
+    """
+    Returns:
+        str: Every metric, in the Prometheus text exposition format.
+    """
+    totals = collect()
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render(totals))
+    return '\n'.join(lines) + '\n'
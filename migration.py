@@ -0,0 +1,228 @@
+import json
+import logging
+import os
+import threading
+import time
+
+
+CHUNK_KEYS = int(os.environ.get('MIGRATION_CHUNK_KEYS', 500)) # Keys sent to a shard in one request.
+RATE_LIMIT = float(os.environ.get('MIGRATION_RATE_LIMIT', 10 * 1024 * 1024)) # Bytes per second sent while migrating, 0 for no limit.
+RETRY_INTERVAL = 0.5 # Seconds before resending a chunk to an unresponsive or not yet resharded server, doubling on every attempt.
+MAX_RETRY_INTERVAL = 10
+
+logger = logging.getLogger(__name__)
+
+
+class Migration:
+    """
+    Streams the keys that changed shards in a reshard to their new owners.
+
+    Keys are sent in chunks of CHUNK_KEYS to every alive member of their new
+    shard, throttled to RATE_LIMIT bytes per second, and only dropped from
+    our store once every one of them acknowledged.  Servers that haven't
+    applied the new shard view yet reject chunks of it, and we retry with
+    backoff until they take it, or a newer reshard takes over.  Until the
+    handoff is done, a new owner that doesn't have a key asks its previous
+    owner, which still serves it, and chunks never overwrite keys written
+    since the reshard.
+
+    Once every chunk is acknowledged, every server tells every other that
+    it's done.  The handoff ends when we heard from every server alive when
+    we resharded that's still alive.
+
+    Args:
+        get_items (function): Returns the records of the given keys still
+                              in our store, as StorageEngine.record() does.
+        drop (function): Removes the given keys from our store.
+        shard_members (function): Returns the alive members of a shard.
+        send_chunk (function): Called as send_chunk(addresses, body), returns
+                               the addresses that acknowledged it.
+    """
+
+    def __init__(self, get_items, drop, shard_members, send_chunk, chunk_keys=CHUNK_KEYS, rate_limit=RATE_LIMIT):
+        self.get_items = get_items
+        self.drop = drop
+        self.shard_members = shard_members
+        self.send_chunk = send_chunk
+        self.chunk_keys = chunk_keys
+        self.rate_limit = rate_limit
+
+        self.version = 0 # Shard view version we're migrating to.
+        self.previous_ring = None # Set while the handoff is in progress.
+        self.written = set() # Keys written since the reshard, which chunks mustn't overwrite.
+        self.expected_senders = set()
+        self.done_senders = set()
+        self.all_members = lambda: []
+        self.keep_shard = None
+        self.sending = False
+        self.lock = threading.Lock()
+
+        self.keys_total = 0
+        self.keys_moved = 0
+        self.bytes_moved = 0
+        self.started_at = None
+
+    def start(self, version, previous_ring, outgoing, all_members, expected_senders, keep_shard=None):
+        """
+        Starts migrating to a new shard view.
+
+        Args:
+            version (int): The new shard view's version.
+            previous_ring (HashRing): The ring before the reshard.
+            outgoing (dict): Maps shard id to the keys to send to that shard.
+            all_members (function): Returns every alive server but us, to
+                                    tell once we're done sending.
+            expected_senders (set): Addresses, without port, of the servers
+                                    whose keys we wait for.
+            keep_shard (int): Our own shard, whose keys in outgoing are
+                              sent to its other alive members, if any, and
+                              kept.
+        """
+        with self.lock:
+            self.version = version
+            self.keep_shard = keep_shard
+            self.previous_ring = previous_ring
+            self.written = set()
+            self.expected_senders = set(expected_senders)
+            self.done_senders = set()
+            self.all_members = all_members
+            self.sending = True
+
+            self.keys_total = sum(len(keys) for keys in outgoing.values())
+            self.keys_moved = 0
+            self.bytes_moved = 0
+            self.started_at = time.time()
+
+        threading.Thread(target=self.run, args=(version, outgoing, all_members), daemon=True).start()
+
+    def run(self, version, outgoing, all_members):
+        for shard_id, keys in sorted(outgoing.items()):
+            for i in range(0, len(keys), self.chunk_keys):
+                if not self.send(version, shard_id, keys[i:i + self.chunk_keys]):
+                    return # A newer reshard took over.
+
+        body = json.dumps({'version': version, 'done': True, 'items': []})
+        if self.deliver(version, all_members, body) is None:
+            return
+        with self.lock:
+            if version == self.version:
+                self.sending = False
+        self.maybe_finish()
+
+    def deliver(self, version, get_addresses, body, require_ack=True):
+        """
+        Sends body to every alive address, retrying the ones that didn't
+        acknowledge it until they all did, and, with require_ack, at least
+        one is alive.
+
+        Returns:
+            set: The addresses that acknowledged it, or None if a newer
+                 reshard took over first.
+        """
+        acked = set()
+        interval = RETRY_INTERVAL
+        while version == self.version:
+            pending = set(get_addresses()).difference(acked)
+            if (acked or not require_ack) and not pending:
+                return acked
+            if pending:
+                acked.update(self.send_chunk(sorted(pending), body))
+                if not set(get_addresses()).difference(acked):
+                    continue
+            logger.warning(f'Migration chunk not acknowledged by {sorted(pending) or "any server"}, retrying in {interval}s')
+            time.sleep(interval)
+            interval = min(interval * 2, MAX_RETRY_INTERVAL)
+        return None
+
+    def send(self, version, shard_id, keys):
+        # Returns False if a newer reshard took over before every member acknowledged.
+        items = self.get_items(keys)
+        body = json.dumps({'version': version, 'done': False, 'items': items})
+        acked = self.deliver(version, lambda: self.shard_members(shard_id), body, require_ack=shard_id != self.keep_shard)
+        if acked is None:
+            return False
+        if shard_id != self.keep_shard:
+            self.drop([item[0] for item in items])
+
+        with self.lock:
+            self.keys_moved += len(keys)
+            self.bytes_moved += len(body) * len(acked)
+            elapsed = time.time() - self.started_at
+        if self.rate_limit > 0:
+            time.sleep(max(0, self.bytes_moved / self.rate_limit - elapsed))
+        return True
+
+    def maybe_finish(self):
+        if self.previous_ring is None or self.sending:
+            return
+        alive = {a.split(':')[0] for a in self.all_members()} # Servers that died won't tell us they're done.
+        with self.lock:
+            if self.previous_ring is None or self.sending:
+                return
+            if self.expected_senders.intersection(alive).issubset(self.done_senders):
+                self.previous_ring = None
+                self.written = set()
+
+    def handing_off(self):
+        """
+        Returns:
+            bool: Whether keys of the last reshard may still arrive.
+        """
+        self.maybe_finish()
+        return self.previous_ring is not None
+
+    def accept(self, version, sender, items, done):
+        """
+        Filters a received chunk down to the keys to store.  Caller holds the
+        lock writes are applied under.
+
+        Returns:
+            list: The records to store, or None if the chunk is for another
+                  shard view version.
+        """
+        with self.lock:
+            if version != self.version:
+                return None
+            if done:
+                self.done_senders.add(sender)
+            items = [record for record in items if record[0] not in self.written]
+        self.maybe_finish()
+        return items
+
+    def note_write(self, key):
+        """
+        Records a write, so chunks of older values don't overwrite it.
+        """
+        if self.previous_ring is not None:
+            self.written.add(key)
+
+    def previous_shard_id(self, key):
+        """
+        Returns:
+            int: The shard that owned key before the reshard, if we're still
+                 handing off and the key wasn't written since, else None.
+        """
+        self.maybe_finish()
+        previous_ring = self.previous_ring
+        if previous_ring is None or key in self.written:
+            return None
+        return previous_ring.get_shard_id(key)
+
+    def status(self):
+        with self.lock:
+            if self.started_at is None:
+                return {'state': 'idle', 'version': self.version}
+            elapsed = time.time() - self.started_at
+            rate = self.keys_moved / elapsed if elapsed > 0 else 0
+            remaining = self.keys_total - self.keys_moved
+            return {
+                'state': 'migrating' if self.sending else ('handing off' if self.previous_ring is not None else 'done'),
+                'version': self.version,
+                'keys_total': self.keys_total,
+                'keys_moved': self.keys_moved,
+                'bytes_moved': self.bytes_moved,
+                'elapsed': elapsed,
+                'eta': remaining / rate if self.sending and rate > 0 else (0 if not self.sending else None),
+                'senders_done': sorted(self.done_senders),
+                'senders_expected': sorted(self.expected_senders)
+            }
@@ -1,53 +1,239 @@
-from collections import namedtuple
+from collections import Counter, namedtuple
 from enum import Enum
+from requests.adapters import HTTPAdapter
+from selector import selector
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.util.retry import Retry
 import concurrent.futures
+import metrics
+import os
 import random
 import requests
+import threading
 import time
 
 UnicastResponse = namedtuple('UnicastResponse', ['uri', 'address', 'response'])
 HTTPMethods = Enum('HTTPMethods', 'GET POST PUT DELETE')
+Jitter = namedtuple('Jitter', ['delay', 'drop']) # Seconds to wait before sending, and whether to drop the send.
 
+POOL_MAXSIZE = int(os.environ.get('POOL_MAXSIZE', 10)) # Connections kept open per peer.
+POOL_RETRIES = int(os.environ.get('POOL_RETRIES', 2)) # Retries for failed connection attempts.
+POOL_BACKOFF = float(os.environ.get('POOL_BACKOFF', 0.1)) # Seconds, doubled after every retry.
+POOL_KEEP_ALIVE = os.environ.get('POOL_KEEP_ALIVE', '1') != '0'
+POOL_SOURCE_ADDRESS = os.environ.get('POOL_SOURCE_ADDRESS') # IP to connect to peers from, for nodes sharing a host.
+MULTICAST_WORKERS = int(os.environ.get('MULTICAST_WORKERS', 32)) # Threads shared by every multicast.
+FAULT_INJECTION_DELAY = float(os.environ.get('FAULT_INJECTION_DELAY', 0)) # Max seconds of injected delay.
+FAULT_INJECTION_DROP_RATE = float(os.environ.get('FAULT_INJECTION_DROP_RATE', 0)) # Chance of dropping a send.
 
-def inject_jitter():
-    time.sleep(random.random())
+sessions = {} # Peer address to its pooled session.
+sessions_lock = threading.Lock()
+requests_sent = Counter() # Peer address to requests sent.
+connections_opened = Counter() # Peer address to TCP connections opened.
+peer_latency = metrics.Histogram('kvs_peer_request_seconds', 'Latency of requests to other nodes that were answered, by peer.', ['peer'])
+peer_failures = metrics.Counter('kvs_peer_request_failures_total', 'Requests to other nodes that timed out or failed to connect, by peer.', ['peer'])
+stats_lock = threading.Lock()
+executor = None
+executor_lock = threading.Lock()
 
 
-def unicast(address, address_to_uri, http_method=HTTPMethods.GET, timeout=None, data=None, headers=None):
-    inject_jitter()
+class CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        super().connect()
+        with stats_lock:
+            connections_opened[f'{self.host}:{self.port}'] += 1
 
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CountingHTTPConnection
+
+
+def new_session():
+    # Only connection attempts are retried.  A request that reached the peer
+    # is never resent, so replicated writes aren't applied twice.
+    retry = Retry(
+        total=POOL_RETRIES,
+        connect=POOL_RETRIES,
+        read=0,
+        status=0,
+        backoff_factor=POOL_BACKOFF,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+    adapter.poolmanager.pool_classes_by_scheme = {'http': CountingHTTPConnectionPool}
+    if POOL_SOURCE_ADDRESS:
+        # Peers tell nodes apart by the address requests come from.
+        adapter.poolmanager.connection_pool_kw['source_address'] = (POOL_SOURCE_ADDRESS, 0)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    if not POOL_KEEP_ALIVE:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def get_session(address):
+    """
+    Returns the pooled session used for all traffic to a peer, creating it
+    on first use.  Sessions keep their connections open between requests,
+    so we only pay the TCP handshake once per pooled connection.
+
+    Returns:
+        requests.Session: The peer's session.
+    """
+    session = sessions.get(address)
+    if session is None:
+        with sessions_lock:
+            session = sessions.get(address)
+            if session is None:
+                session = new_session()
+                sessions[address] = session
+    return session
+
+
+def pool_stats():
+    """
+    Summarises connection reuse per peer.  A hit is a request sent over an
+    already open connection, a miss is a request that had to open one.
+
+    Returns:
+        dict: Maps peer address to its request, hit and miss counts.
+    """
+    stats = {}
+    with stats_lock:
+        for address, num_requests in requests_sent.items():
+            misses = min(connections_opened[address], num_requests)
+            stats[address] = {
+                'requests': num_requests,
+                'hits': num_requests - misses,
+                'misses': misses
+            }
+    return stats
+
+
+def no_jitter(address):
+    return Jitter(0, False)
+
+
+def bounded_jitter(max_delay):
+    """
+    Jitter policy delaying each send by up to max_delay seconds.
+    """
+    def policy(address):
+        return Jitter(random.uniform(0, max_delay), False)
+    return policy
+
+
+def fault_injection(max_delay, drop_rate, seed=None):
+    """
+    Jitter policy for tests: delays each send by up to max_delay seconds and
+    drops it with probability drop_rate, as if the peer were unreachable.
+    Pass a seed to make the injected faults reproducible.
+    """
+    rng = random.Random(seed)
+    def policy(address):
+        return Jitter(rng.uniform(0, max_delay), rng.random() < drop_rate)
+    return policy
+
+
+if FAULT_INJECTION_DELAY > 0 or FAULT_INJECTION_DROP_RATE > 0:
+    data_path_jitter = fault_injection(FAULT_INJECTION_DELAY, FAULT_INJECTION_DROP_RATE)
+else:
+    data_path_jitter = no_jitter
+
+
+def set_jitter_policy(policy):
+    """
+    Sets the jitter policy used by sends that don't pass their own.
+    """
+    global data_path_jitter
+    data_path_jitter = policy
+
+
+def get_executor():
+    global executor
+    if executor is None:
+        with executor_lock:
+            if executor is None:
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=MULTICAST_WORKERS)
+    return executor
+
+
+def unicast(address, address_to_uri, http_method=HTTPMethods.GET, timeout=None, data=None, headers=None, jitter=None, stream=False):
     uri = address_to_uri(address)
 
+    delay, drop = (jitter or data_path_jitter)(address)
+    if delay > 0:
+        time.sleep(delay)
+    if drop:
+        return UnicastResponse(uri, address, None)
+
+    with stats_lock:
+        requests_sent[address] += 1
+
+    selector.started(address)
+    start = time.monotonic()
+    resp = None
     try:
-        if http_method == HTTPMethods.GET:
-            resp = requests.get(uri, timeout=timeout, headers=headers)
-        elif http_method == HTTPMethods.PUT:
-            resp = requests.put(uri, timeout=timeout, data=data, headers=headers)
-        elif http_method == HTTPMethods.POST:
-            resp = requests.post(uri, timeout=timeout, data=data, headers=headers)
-        elif http_method == HTTPMethods.DELETE:
-            resp = requests.delete(uri, timeout=timeout, data=data, headers=headers)
-        else:
-            resp = None
-    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
-        resp = None
+        resp = transport(address, http_method, uri, timeout=timeout, data=data, headers=headers, stream=stream)
+    finally:
+        # Other errors than the transport's are raised, but still leave the
+        # peer in flight no longer, and count as a failure.
+        finished(address, time.monotonic() - start, resp)
 
     return UnicastResponse(uri, address, resp)
 
 
-def multicast(addresses, address_to_uri, http_method=HTTPMethods.GET, timeout=None, data=None, headers=None):
+def http_transport(address, http_method, uri, timeout=None, data=None, headers=None, stream=False):
+    """
+    Sends a request over the peer's pooled session.
+
+    Returns:
+        requests.Response: The peer's response, None if it timed out or we
+                           couldn't connect.
+    """
+    try:
+        return get_session(address).request(http_method.name, uri, timeout=timeout, data=data, headers=headers, stream=stream)
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+        return None
+
+
+transport = http_transport # Sends every request of unicast().  The simulator (sim.py) replaces it.
+
+
+def finished(address, latency, resp):
+    """
+    Records how a request to a peer went, for the replica selector and the
+    metrics.  resp is None if the peer didn't answer.
+    """
+    selector.finished(address, latency, resp is not None and resp.status_code < 500)
+    if resp is None:
+        peer_failures.inc(address)
+    else:
+        peer_latency.observe(latency, address)
+
+
+def multicast(addresses, address_to_uri, http_method=HTTPMethods.GET, timeout=None, data=None, headers=None, jitter=None, wait=True):
+    """
+    Sends the same request to every address on the shared executor.
+
+    Returns:
+        list: The futures of each UnicastResponse.  If wait is True, they
+              have all completed by the time we return.
+    """
     fs = []
-    max_workers = min(len(addresses), 10)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        for address in addresses:
-            unicast_response_future = executor.submit(
-                unicast,
-                address,
-                address_to_uri,
-                http_method=http_method,
-                timeout=timeout,
-                data=data,
-                headers=headers
-            )
-            fs.append(unicast_response_future)
+    for address in addresses:
+        unicast_response_future = get_executor().submit(
+            unicast,
+            address,
+            address_to_uri,
+            http_method=http_method,
+            timeout=timeout,
+            data=data,
+            headers=headers,
+            jitter=jitter
+        )
+        fs.append(unicast_response_future)
+    if wait and fs:
+        concurrent.futures.wait(fs)
     return fs
@@ -0,0 +1,57 @@
+from collections import defaultdict, deque
+import os
+import threading
+
+
+MAX_ENTRIES = int(os.environ.get('OPLOG_MAX_ENTRIES', 100000)) # Delivered operations kept for lagging replicas.
+
+
+class OpLog:
+    """
+    Bounded log of the operations this node delivered, from every member of
+    its shard, kept so lagging replicas can catch up on what they missed.
+
+    Operations are the replication log entries, {'vc', 'op', 'key', 'data'},
+    plus the 'origin' address that stamped them.  Each origin's operations
+    are delivered in clock entry order, so a replica whose clock entry for
+    an origin is at least the last entry we dropped for it can be sent every
+    operation it's missing.  Otherwise it needs a full snapshot.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+
+        self.entries = deque() # Operations in delivery order.
+        self.truncated = defaultdict(int) # Origin to the last of its clock entries we no longer have.
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def append(self, origin, entry):
+        with self.lock:
+            self.entries.append(dict(entry, origin=origin))
+            if len(self.entries) > self.max_entries:
+                dropped = self.entries.popleft()
+                self.truncated[dropped['origin']] = dropped['vc'][dropped['origin']]
+
+    def reset(self, vector_clock):
+        """
+        Forgets every operation, after our clock was restored or replaced
+        without going through the log.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.truncated = defaultdict(int, vector_clock)
+
+    def missing(self, vector_clock):
+        """
+        Returns:
+            list: The operations a replica at vector_clock is missing, in
+                  delivery order, or None if some were already dropped.
+        """
+        with self.lock:
+            for origin, entry in self.truncated.items():
+                if vector_clock.get(origin, 0) < entry:
+                    return None
+            return [entry for entry in self.entries if entry['vc'][entry['origin']] > vector_clock.get(entry['origin'], 0)]
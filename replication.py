@@ -0,0 +1,255 @@
+import logging
+import metrics
+import os
+import threading
+import time
+
+
+MAX_BATCH = int(os.environ.get('REPLICATION_MAX_BATCH', 64)) # Entries sent to a peer in one request.
+LINGER = float(os.environ.get('REPLICATION_LINGER', 0.002)) # Seconds to wait for a batch to fill up.
+MAX_ENTRIES = int(os.environ.get('REPLICATION_MAX_ENTRIES', 100000)) # Entries kept for lagging peers.
+RETRY_INTERVAL = 0.5 # Seconds between attempts to reach an unresponsive peer.
+
+logger = logging.getLogger(__name__)
+
+batch_latency = metrics.Histogram('kvs_replication_batch_seconds', 'Time to send a batch of writes to a shard member until it acknowledged it, by peer.', ['peer'])
+batch_failures = metrics.Counter('kvs_replication_failures_total', 'Batches of writes a shard member did not acknowledge, by peer.', ['peer'])
+entries_sent = metrics.Counter('kvs_replication_entries_total', 'Writes a shard member acknowledged, by peer.', ['peer'])
+
+
+class ReplicationLog:
+    """
+    Ordered log of the writes this node accepted from clients, streamed to
+    the other members of its shard.
+
+    Each peer has its own sender thread.  The sender waits up to LINGER
+    seconds for a batch to fill, then sends every pending entry (up to
+    MAX_BATCH) to the peer in a single request.  Entries stay in the log
+    until every peer acknowledged them, or until the log grows past
+    MAX_ENTRIES, in which case the oldest are dropped and lagging peers have
+    to catch up through the heartbeat.  A dropped entry doesn't count as
+    acknowledged by the peers that missed it, so writes waiting for their
+    acknowledgements fail rather than succeed.
+
+    Args:
+        send_batch (function): Called as send_batch(peer, entries), returns
+                               True if the peer acknowledged the entries.
+    """
+
+    def __init__(self, send_batch, max_batch=MAX_BATCH, linger=LINGER, max_entries=MAX_ENTRIES):
+        self.send_batch = send_batch
+        self.max_batch = max_batch
+        self.linger = linger
+        self.max_entries = max_entries
+
+        self.entries = []
+        self.start = 0 # Offset of entries[0].
+        self.cursors = {} # Peer to the offset of the next entry to send it.
+        self.lost = {} # Peer to the [start, end) offsets of entries dropped before it acknowledged them, oldest first.
+        self.senders = {} # Peer to its sender thread.
+        self.generation = 0 # Bumped by clear(), so in-flight batches of old entries are ignored.
+        self.waiters = [] # [offset, count, wake] of the writes awaited without a thread.
+        self.cond = threading.Condition()
+
+    @property
+    def end(self):
+        return self.start + len(self.entries)
+
+    def set_peers(self, peers):
+        """
+        Sets the peers we replicate to.  New peers only receive entries
+        appended from now on.
+        """
+        with self.cond:
+            for peer in set(self.cursors).difference(peers):
+                del self.cursors[peer]
+                self.lost.pop(peer, None)
+            for peer in set(peers).difference(self.cursors):
+                self.cursors[peer] = self.end
+                if peer not in self.senders or not self.senders[peer].is_alive():
+                    self.senders[peer] = threading.Thread(target=self.run, args=(peer,), daemon=True)
+                    self.senders[peer].start()
+            self.trim()
+            self.cond.notify_all()
+            self.wake_waiters()
+
+    def append(self, entry):
+        """
+        Appends an entry to be sent to every peer.
+
+        Returns:
+            int: The entry's offset, to wait for its acknowledgements.
+        """
+        with self.cond:
+            offset = self.end
+            self.entries.append(entry)
+            if len(self.entries) > self.max_entries:
+                self.start += len(self.entries) - self.max_entries
+                del self.entries[:len(self.entries) - self.max_entries]
+                self.skip_dropped()
+            self.cond.notify_all()
+            self.wake_waiters()
+        return offset
+
+    def unacked(self):
+        """
+        Returns:
+            list: The entries some peer hasn't acknowledged yet, oldest first.
+        """
+        with self.cond:
+            acked = max(min(self.cursors.values(), default=self.end), self.start)
+            return self.entries[acked - self.start:]
+
+    def clear(self):
+        with self.cond:
+            self.generation += 1
+            self.start = self.end
+            self.entries = []
+            self.skip_dropped()
+            self.cond.notify_all()
+            self.wake_waiters()
+
+    @property
+    def horizon(self):
+        # Offset before which we no longer remember which peers lost entries.
+        return self.start - self.max_entries
+
+    def skip_dropped(self):
+        # Moves the peers that hadn't acknowledged the dropped entries past
+        # them, remembering they lost them.  Caller holds the lock.
+        for peer, cursor in self.cursors.items():
+            ranges = self.lost.setdefault(peer, [])
+            if cursor < self.start:
+                if ranges and ranges[-1][1] == cursor:
+                    ranges[-1][1] = self.start
+                else:
+                    ranges.append([cursor, self.start])
+                self.cursors[peer] = self.start
+            while ranges and ranges[0][1] <= self.horizon:
+                ranges.pop(0)
+            if not ranges:
+                del self.lost[peer]
+
+    def lost_entry(self, peer, offset):
+        return any(start <= offset < end for start, end in self.lost.get(peer, ()))
+
+    def acks(self, offset):
+        return sum(1 for peer, cursor in self.cursors.items() if cursor > offset and not self.lost_entry(peer, offset))
+
+    def acked(self, offset, count):
+        """
+        Returns:
+            bool: Whether count peers acknowledged the entry at offset, None
+                  if that's still undecided.  False once too many peers lost
+                  it, or if it's too old to tell.  Caller holds the lock.
+        """
+        count = min(count, len(self.cursors))
+        if offset < self.horizon:
+            return count == 0
+        if self.acks(offset) >= count:
+            return True
+        missed = sum(1 for peer in self.cursors if self.lost_entry(peer, offset))
+        if len(self.cursors) - missed < count:
+            return False
+        return None
+
+    def wait_for_acks(self, offset, count, timeout):
+        """
+        Blocks until count peers acknowledged the entry at offset.
+
+        Returns:
+            bool: False if we timed out first, or the entry was dropped
+                  before enough peers acknowledged it.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.acked(offset, count) is not None, timeout=timeout)
+            return self.acked(offset, count) is True
+
+    def add_waiter(self, offset, count, wake):
+        """
+        Calls wake(acked) once count peers acknowledged the entry at offset,
+        with True, or once it was dropped before they did, with False.  It's
+        called from the thread that decided it, or right away.  For callers
+        that can't block, like the event loop.
+
+        Returns:
+            list: The waiter, to remove if the caller stops waiting.
+        """
+        waiter = [offset, count, wake]
+        with self.cond:
+            self.waiters.append(waiter)
+            self.wake_waiters()
+        return waiter
+
+    def remove_waiter(self, waiter):
+        with self.cond:
+            self.waiters = [w for w in self.waiters if w is not waiter]
+
+    def wake_waiters(self):
+        # Caller holds the lock.
+        waiting = []
+        for waiter in self.waiters:
+            offset, count, wake = waiter
+            acked = self.acked(offset, count)
+            if acked is not None:
+                wake(acked)
+            else:
+                waiting.append(waiter)
+        self.waiters = waiting
+
+    def trim(self):
+        # Drops the entries every peer acknowledged.
+        acked = min(self.cursors.values(), default=self.end)
+        if acked > self.start:
+            del self.entries[:acked - self.start]
+            self.start = acked
+
+    def pending(self, peer):
+        return peer in self.cursors and self.cursors[peer] < self.end
+
+    def flush(self, peer):
+        """
+        Sends the next batch of pending entries to a peer.
+
+        Returns:
+            bool: False if the peer didn't acknowledge the batch.
+        """
+        with self.cond:
+            if not self.pending(peer):
+                return True
+            if self.end - self.cursors[peer] < self.max_batch:
+                self.cond.wait_for(
+                    lambda: not self.pending(peer) or self.end - self.cursors[peer] >= self.max_batch,
+                    timeout=self.linger
+                )
+                if not self.pending(peer):
+                    return True
+            cursor = self.cursors[peer]
+            generation = self.generation
+            batch = self.entries[cursor - self.start:cursor - self.start + self.max_batch]
+
+        start = time.monotonic()
+        ok = self.send_batch(peer, batch)
+        if ok:
+            batch_latency.observe(time.monotonic() - start, peer)
+            entries_sent.inc(peer, amount=len(batch))
+        else:
+            batch_failures.inc(peer)
+
+        with self.cond:
+            if ok and generation == self.generation and self.cursors.get(peer) == cursor:
+                self.cursors[peer] = cursor + len(batch)
+                self.trim()
+                self.cond.notify_all()
+                self.wake_waiters()
+        return ok
+
+    def run(self, peer):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: peer not in self.cursors or self.pending(peer))
+                if peer not in self.cursors:
+                    return
+            if not self.flush(peer):
+                logger.warning(f'Replication to {peer} failed, retrying in {RETRY_INTERVAL}s')
+                time.sleep(RETRY_INTERVAL)
@@ -0,0 +1,109 @@
+import os
+import random
+import threading
+import time
+
+EWMA_ALPHA = float(os.environ.get('SELECTOR_EWMA_ALPHA', 0.3)) # Weight of the latest latency sample.
+EJECT_AFTER_FAILURES = int(os.environ.get('SELECTOR_EJECT_AFTER_FAILURES', 3)) # Consecutive failures before ejecting a peer.
+EJECT_DURATION = float(os.environ.get('SELECTOR_EJECT_DURATION', 5)) # Seconds a peer is first ejected for.
+MAX_EJECT_DURATION = 60 # Repeated ejections double the duration, up to this.
+
+
+class PeerStats:
+    def __init__(self):
+        self.latency = None # EWMA of response latency, in seconds.
+        self.in_flight = 0
+        self.failures = 0 # Consecutive failed requests.
+        self.ejections = 0 # Consecutive ejections, reset by a success.
+        self.ejected_until = 0
+
+
+class ReplicaSelector:
+    """
+    Picks which replica of a shard to send a request to.
+
+    Every request sent through network.unicast reports its latency and
+    whether it failed.  We keep an EWMA of each peer's latency and count its
+    requests in flight, and pick the better of two random replicas, scored
+    by latency times requests in flight, which avoids slow peers without
+    herding every request onto the fastest one.  Peers that failed
+    EJECT_AFTER_FAILURES times in a row are skipped for EJECT_DURATION
+    seconds, doubled for every ejection in a row.
+    """
+
+    def __init__(self, alpha=EWMA_ALPHA, eject_after=EJECT_AFTER_FAILURES, eject_duration=EJECT_DURATION):
+        self.alpha = alpha
+        self.eject_after = eject_after
+        self.eject_duration = eject_duration
+        self.peers = {}
+        self.lock = threading.Lock()
+
+    def _peer(self, address):
+        peer = self.peers.get(address)
+        if peer is None:
+            peer = self.peers[address] = PeerStats()
+        return peer
+
+    def started(self, address):
+        with self.lock:
+            self._peer(address).in_flight += 1
+
+    def finished(self, address, latency, ok):
+        with self.lock:
+            peer = self._peer(address)
+            peer.in_flight -= 1
+            if ok:
+                peer.latency = latency if peer.latency is None else self.alpha * latency + (1 - self.alpha) * peer.latency
+                peer.failures = 0
+                peer.ejections = 0
+                peer.ejected_until = 0 # Heartbeats still reach ejected peers, and tell us when they're back.
+                return
+
+            peer.failures += 1
+            if peer.failures >= self.eject_after:
+                duration = min(self.eject_duration * 2 ** peer.ejections, MAX_EJECT_DURATION)
+                peer.ejected_until = time.monotonic() + duration
+                peer.ejections += 1
+                peer.failures = 0
+
+    def cancelled(self, address):
+        # Says nothing about the peer, but it's no longer in flight.
+        with self.lock:
+            self._peer(address).in_flight -= 1
+
+    def _score(self, address):
+        peer = self.peers.get(address)
+        if peer is None or peer.latency is None:
+            return 0 # Try peers we know nothing about.
+        return peer.latency * (peer.in_flight + 1)
+
+    def choose(self, addresses):
+        """
+        Returns:
+            str: The replica to send a request to, out of a non empty
+                 sequence of addresses.
+        """
+        now = time.monotonic()
+        with self.lock:
+            candidates = [a for a in addresses if a not in self.peers or self.peers[a].ejected_until <= now]
+            if not candidates: # Better to try an ejected replica than none.
+                candidates = list(addresses)
+            if len(candidates) == 1:
+                return candidates[0]
+            a, b = random.sample(candidates, 2)
+            return a if self._score(a) <= self._score(b) else b
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                address: {
+                    'latency': peer.latency,
+                    'in_flight': peer.in_flight,
+                    'ejected_for': max(0, peer.ejected_until - now)
+                }
+                for address, peer in self.peers.items()
+            }
+
+
+selector = ReplicaSelector()
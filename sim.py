@@ -0,0 +1,1569 @@
+from collections import namedtuple
+from functools import partial
+from urllib.parse import urlsplit
+import argparse
+import concurrent.futures
+import heapq
+import importlib
+import json
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+
+from requests.structures import CaseInsensitiveDict
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+import requests
+
+from bench import merge_metadata, percentiles
+from hashring import HashRing
+
+# Simulates a cluster inside one process, in virtual time:
+#
+#     python sim.py --nodes 100 --shards 10 --scenario reshard --seed 1
+#
+# Every node gets its own copy of the repo's modules, imported with os, time,
+# threading, random and concurrent.futures replaced by simulated versions,
+# and network.transport replaced by a simulated network.  Only one simulated
+# thread runs at a time, picked by a seeded random generator, and when none
+# can run the clock jumps to the next timer, so a run with the same seed
+# (and PYTHONHASHSEED) always interleaves the same way, however long it
+# would take on a real cluster.
+
+NODE_MODULES = (
+    'view', 'metrics', 'selector', 'network', 'hashring', 'merkle', 'clock', 'client', 'cache', 'causal',
+    'delivery', 'hedge', 'locks', 'migration', 'oplog', 'replication', 'ttl', 'tiered', 'storage', 'heartbeat', 'kvs'
+) # Imported afresh for every node, as their state lives in module globals.
+NODE_ENV = {'STORAGE_ENGINE': 'memory'} # Set for every node, before any overrides.
+PORT = 8080
+CLIENT_IP = '192.0.2.1' # Outside every view, so nodes treat its requests as a client's.
+SIM_EPOCH = 1600000000 # What time.time() returns at virtual time 0.
+MAX_WAIT = 60 # Virtual seconds a request without a timeout waits for an answer that never comes.
+MAX_RUN = 3600 # Virtual seconds Simulation.call() runs for before giving up.
+MEMBERSHIP_TIMEOUT = 60 # Virtual seconds for started nodes to find each other alive.
+MAX_IDLE_CARRIERS = 256 # Real threads kept waiting to run new simulated threads.
+POLL_INTERVAL = 0.1 # Virtual seconds between checks of conditions that look at every node.
+LATENCY = 0.0005 # Virtual seconds a message takes one way, plus up to JITTER.
+JITTER = 0.0005
+RETRANSMIT_TIMEOUT = 0.2 # Virtual seconds before a lost packet is sent again, Linux's minimum.
+CONTENDED_KEYS = 4 # Keys every client of the locks scenario writes to.
+LOCK_PREEMPTION = 0.2 # Chance a thread of the locks scenario is preempted before taking a lock.
+LOCK_ROUND = 1 / 128 # Virtual seconds between the locks scenario's rounds.  A power of two, so every client's round starts at exactly the same time.
+
+logger = logging.getLogger(__name__)
+
+
+class SimulationExit(BaseException):
+    """
+    Raised in simulated threads to unwind them when the simulation shuts
+    down.  Not an Exception, so the nodes' error handling doesn't catch it.
+    """
+
+
+class NodeKilled(SimulationExit):
+    """
+    Raised in the simulated threads of a node that was killed.
+    """
+
+
+class Deadlock(Exception):
+    pass
+
+
+class Scheduler:
+    """
+    Runs simulated threads one at a time, in virtual time.
+
+    Simulated threads run on real threads, but each waits on its own
+    semaphore until resumed.  Threads block by calling wait(), which parks
+    them until another thread wakes them or their timeout passes, and picks
+    the next thread to run itself, so a switch takes a single handoff.  The
+    driver, the thread running the simulation, waits meanwhile until the
+    condition it runs the simulation until holds.
+
+    Args:
+        seed (int): Seeds the choice of which ready thread runs next.
+    """
+
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+        self.now = 0.0
+        self.ready = [] # Threads that can run, in the order they became ready.
+        self.timers = [] # Heap of (time, sequence, thread, token), to wake threads waiting with a timeout.
+        self.sequence = 0
+        self.threads = {} # Real thread ident to the simulated thread it runs.
+        self.carriers = [] # Real threads waiting for a simulated thread to run.
+        self.until = lambda: True # The driver's condition.
+        self.deadline = 0
+        self.checking = False # Set while checking the driver's condition, which runs as if outside the simulation.
+        self.stopped = threading.Semaphore(0) # Released when the driver's condition holds.
+        self.switches = 0
+        self.closed = False
+        self.preemption = 0.0 # Chance a thread lets another run before taking a free lock.
+
+    def current(self):
+        """
+        Returns:
+            SimThread: The running simulated thread, None outside the simulation.
+        """
+        if self.checking:
+            return None
+        return self.threads.get(threading.get_ident())
+
+    def run(self, until, timeout):
+        """
+        Runs simulated threads until until() holds, nothing can run, or
+        timeout virtual seconds pass.
+        """
+        self.until = until
+        self.deadline = self.now + timeout
+        self.dispatch()
+        self.stopped.acquire()
+
+    def stop(self):
+        if self.now > self.deadline:
+            return True
+        self.checking = True
+        try:
+            return self.until()
+        finally:
+            self.checking = False
+
+    def dispatch(self, me=None):
+        """
+        Resumes the next ready thread, moving the clock to the next timer
+        while none is, or the driver if its condition holds.  Called by the
+        thread giving up running.
+
+        Returns:
+            bool: True if the next thread is me, which just keeps running.
+        """
+        while not self.stop():
+            if self.ready:
+                thread = self.ready.pop(self.rng.randrange(len(self.ready)))
+                self.switches += 1
+                if thread is me:
+                    return True
+                thread.resume.release()
+                return False
+            if not self.timers or self.timers[0][0] > self.deadline:
+                break
+            self.now = max(self.now, self.timers[0][0])
+            while self.timers and self.timers[0][0] <= self.now:
+                _, _, thread, token = heapq.heappop(self.timers)
+                if thread.token == token: # Otherwise it was woken before its timeout.
+                    self.make_ready(thread)
+        self.stopped.release()
+        return False
+
+    def preempt(self):
+        """
+        With probability preemption, lets another ready thread run before
+        the running one goes on, as if it were preempted.  Threads otherwise
+        only switch when one blocks, so code between two locks always runs
+        at once, however it would interleave on a real node.
+        """
+        thread = self.current()
+        if thread is None or not self.preemption or self.rng.random() >= self.preemption:
+            return
+        thread.check()
+        self.make_ready(thread)
+        if not self.dispatch(thread):
+            thread.resume.acquire()
+        thread.check()
+
+    def make_ready(self, thread):
+        thread.token += 1
+        thread.blocked = False
+        self.ready.append(thread)
+
+    def wait(self, waitlists=(), timeout=None):
+        """
+        Blocks the running thread until it's woken or timeout virtual seconds
+        pass.  It's added to every list in waitlists meanwhile, for whoever
+        wakes it to find it.
+
+        Returns:
+            bool: True if it was woken, False if it timed out.
+        """
+        thread = self.current()
+        if thread is None:
+            raise RuntimeError('Only simulated threads can block, use Simulation.call()')
+        thread.check()
+        thread.token += 1
+        thread.blocked = True
+        thread.woken = False
+        for waitlist in waitlists:
+            waitlist.append(thread)
+        if timeout is not None:
+            self.sequence += 1
+            heapq.heappush(self.timers, (self.now + max(timeout, 0), self.sequence, thread, thread.token))
+        try:
+            if not self.dispatch(thread):
+                thread.resume.acquire()
+            thread.check()
+        finally:
+            for waitlist in waitlists:
+                if thread in waitlist:
+                    waitlist.remove(thread)
+        return thread.woken
+
+    def wake(self, thread):
+        """
+        Returns:
+            bool: False if the thread wasn't blocked, having timed out already.
+        """
+        if not thread.blocked:
+            return False
+        thread.woken = True
+        self.make_ready(thread)
+        return True
+
+    def sleep(self, seconds):
+        self.wait((), max(seconds, 0))
+
+    def start(self, thread):
+        """
+        Readies a new thread, on an idle carrier if there is one.
+        """
+        if self.carriers:
+            carrier = self.carriers.pop()
+            carrier.thread = thread
+            carrier.assigned.release()
+        else:
+            Carrier(self, thread)
+        self.ready.append(thread)
+
+    def kill(self, node):
+        """
+        Readies every blocked thread of a node, so they raise NodeKilled.
+        """
+        for thread in list(self.threads.values()):
+            if thread.node is node and thread.blocked:
+                self.make_ready(thread)
+
+    def close(self):
+        """
+        Unwinds every simulated thread.
+        """
+        self.closed = True
+        for thread in list(self.threads.values()):
+            if thread.blocked:
+                self.make_ready(thread)
+        self.run(lambda: not self.ready, MAX_RUN)
+
+
+class Carrier:
+    """
+    A real thread running simulated threads, one after the other, as
+    starting a real thread for every simulated one would be slower.
+    """
+
+    def __init__(self, scheduler, thread):
+        self.scheduler = scheduler
+        self.thread = thread
+        self.assigned = threading.Semaphore(0)
+        self.retired = False
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while not self.retired:
+            self.thread.bootstrap(self)
+            if not self.retired:
+                self.assigned.acquire()
+
+
+class SimThread:
+    """
+    Stands in for threading.Thread.  Threads belong to the node of the thread
+    that started them, unless given one.
+    """
+    count = 0
+
+    def __init__(self, scheduler, group=None, target=None, name=None, args=(), kwargs=None, *, daemon=None, node=None):
+        SimThread.count += 1
+        current = scheduler.current()
+        self.scheduler = scheduler
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.name = name or f'SimThread-{SimThread.count}'
+        self.daemon = daemon
+        self.node = node if node is not None else (current.node if current is not None else None)
+        self.resume = threading.Semaphore(0)
+        self.locals = {} # SimLocal to this thread's attributes of it.
+        self.token = 0
+        self.blocked = False
+        self.woken = False
+        self.started = False
+        self.finished = False
+        self.joiners = []
+
+    def check(self):
+        if self.scheduler.closed:
+            raise SimulationExit
+        if self.node is not None and not self.node.alive:
+            raise NodeKilled
+
+    def start(self):
+        self.started = True
+        self.scheduler.start(self)
+
+    def bootstrap(self, carrier):
+        ident = threading.get_ident()
+        self.scheduler.threads[ident] = self
+        self.resume.acquire()
+        try:
+            self.check()
+            self.run()
+        except SimulationExit:
+            pass
+        except BaseException:
+            logger.exception(f'Exception in simulated thread {self.name}')
+        finally:
+            self.finished = True
+            for thread in self.joiners:
+                self.scheduler.wake(thread)
+            del self.scheduler.threads[ident]
+            if len(self.scheduler.carriers) < MAX_IDLE_CARRIERS:
+                self.scheduler.carriers.append(carrier)
+            else:
+                carrier.retired = True # Switches slow down with every real thread.
+            self.scheduler.dispatch()
+
+    def run(self):
+        if self.target is not None:
+            self.target(*self.args, **self.kwargs)
+
+    def join(self, timeout=None):
+        if not self.finished:
+            self.scheduler.wait([self.joiners], timeout)
+
+    def is_alive(self):
+        return self.started and not self.finished
+
+
+class SimLocal:
+    """
+    Stands in for threading.local, as carriers run many simulated threads.
+    """
+
+    def __init__(self, scheduler):
+        object.__setattr__(self, '_scheduler', scheduler)
+        object.__setattr__(self, '_outside', threading.local())
+
+    def _values(self):
+        thread = self._scheduler.current()
+        if thread is None:
+            return self._outside.__dict__
+        return thread.locals.setdefault(self, {})
+
+    def __getattr__(self, name):
+        try:
+            return self._values()[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        self._values()[name] = value
+
+    def __delattr__(self, name):
+        try:
+            del self._values()[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+class SimLock:
+    """
+    Stands in for threading.Lock, handing the lock to waiters in turn.
+    Outside the simulation it can only be taken while free.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.owner = None
+        self.waiters = []
+
+    def acquire(self, blocking=True, timeout=-1):
+        thread = self.scheduler.current() or threading.get_ident()
+        if self.owner is None and not isinstance(thread, int):
+            self.scheduler.preempt()
+        if self.owner is None:
+            self.owner = thread
+            return True
+        if not blocking:
+            return False
+        if isinstance(thread, int):
+            raise Deadlock('A lock taken inside the simulation was taken outside of it')
+        return self.scheduler.wait([self.waiters], None if timeout < 0 else timeout) and self.owner is thread
+
+    def release(self):
+        if self.owner is None:
+            raise RuntimeError('release unlocked lock')
+        self.owner = None
+        while self.waiters:
+            thread = self.waiters.pop(0)
+            if self.scheduler.wake(thread):
+                self.owner = thread
+                return
+
+    def locked(self):
+        return self.owner is not None
+
+    def _release_save(self):
+        self.release()
+
+    def _acquire_restore(self, state):
+        self.acquire()
+
+    def _is_owned(self):
+        return self.owner is not None and self.owner == (self.scheduler.current() or threading.get_ident())
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class SimRLock(SimLock):
+    """
+    Stands in for threading.RLock.
+    """
+
+    def __init__(self, scheduler):
+        super().__init__(scheduler)
+        self.count = 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._is_owned():
+            self.count += 1
+            return True
+        if super().acquire(blocking, timeout):
+            self.count = 1
+            return True
+        return False
+
+    __enter__ = acquire
+
+    def release(self):
+        if not self._is_owned():
+            raise RuntimeError('cannot release un-acquired lock')
+        self.count -= 1
+        if not self.count:
+            super().release()
+
+    def _release_save(self):
+        count, self.count = self.count, 1
+        self.release()
+        return count
+
+    def _acquire_restore(self, count):
+        self.acquire()
+        self.count = count
+
+
+class SimCondition:
+    """
+    Stands in for threading.Condition.
+    """
+
+    def __init__(self, scheduler, lock=None):
+        self.scheduler = scheduler
+        self.lock = lock if lock is not None else SimRLock(scheduler)
+        self.waiters = []
+
+    def __enter__(self):
+        return self.lock.__enter__()
+
+    def __exit__(self, *args):
+        return self.lock.__exit__(*args)
+
+    def acquire(self, *args):
+        return self.lock.acquire(*args)
+
+    def release(self):
+        self.lock.release()
+
+    def wait(self, timeout=None):
+        state = self.lock._release_save()
+        try:
+            return self.scheduler.wait([self.waiters], timeout)
+        finally:
+            self.lock._acquire_restore(state)
+
+    def wait_for(self, predicate, timeout=None):
+        deadline = None if timeout is None else self.scheduler.now + timeout
+        result = predicate()
+        while not result:
+            remaining = None if deadline is None else deadline - self.scheduler.now
+            if remaining is not None and remaining <= 0:
+                break
+            self.wait(remaining)
+            result = predicate()
+        return result
+
+    def notify(self, n=1):
+        woken = 0
+        while self.waiters and woken < n:
+            if self.scheduler.wake(self.waiters.pop(0)):
+                woken += 1
+
+    def notify_all(self):
+        self.notify(len(self.waiters))
+
+
+class SimEvent:
+    """
+    Stands in for threading.Event.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.flag = False
+        self.waiters = []
+
+    def is_set(self):
+        return self.flag
+
+    def set(self):
+        self.flag = True
+        waiters, self.waiters = self.waiters, []
+        for thread in waiters:
+            self.scheduler.wake(thread)
+
+    def clear(self):
+        self.flag = False
+
+    def wait(self, timeout=None):
+        if not self.flag:
+            self.scheduler.wait([self.waiters], timeout)
+        return self.flag
+
+
+class SimFuture:
+    """
+    Stands in for concurrent.futures.Future.  Futures hash by creation
+    order rather than by address, so iterating over sets of them is
+    deterministic.
+    """
+    count = 0
+
+    def __init__(self, scheduler):
+        SimFuture.count += 1
+        self.number = SimFuture.count
+        self.scheduler = scheduler
+        self.state = 'pending'
+        self._result = None
+        self._exception = None
+        self.waiters = []
+        self.callbacks = []
+
+    def __hash__(self):
+        return self.number
+
+    def cancel(self):
+        if self.state in ('running', 'finished'):
+            return False
+        self.finish('cancelled')
+        return True
+
+    def cancelled(self):
+        return self.state == 'cancelled'
+
+    def running(self):
+        return self.state == 'running'
+
+    def done(self):
+        return self.state in ('cancelled', 'finished')
+
+    def set_running_or_notify_cancel(self):
+        if self.state == 'cancelled':
+            return False
+        self.state = 'running'
+        return True
+
+    def set_result(self, result):
+        self._result = result
+        self.finish('finished')
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self.finish('finished')
+
+    def finish(self, state):
+        self.state = state
+        waiters, self.waiters = self.waiters, []
+        for thread in waiters:
+            self.scheduler.wake(thread)
+        for callback in self.callbacks:
+            callback(self)
+
+    def add_done_callback(self, fn):
+        if self.done():
+            fn(self)
+        else:
+            self.callbacks.append(fn)
+
+    def exception(self, timeout=None):
+        if not self.done():
+            self.scheduler.wait([self.waiters], timeout)
+        if self.state == 'cancelled':
+            raise concurrent.futures.CancelledError
+        if not self.done():
+            raise concurrent.futures.TimeoutError
+        return self._exception
+
+    def result(self, timeout=None):
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+
+class SimExecutor:
+    """
+    Stands in for concurrent.futures.ThreadPoolExecutor, running every task
+    on a thread of its own, since simulated threads are cheap to start.
+    """
+
+    def __init__(self, scheduler, max_workers=None, thread_name_prefix='', *args, **kwargs):
+        self.scheduler = scheduler
+        self.thread_name_prefix = thread_name_prefix
+
+    def submit(self, fn, *args, **kwargs):
+        future = SimFuture(self.scheduler)
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                result = fn(*args, **kwargs)
+            except SimulationExit:
+                raise
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+        SimThread(self.scheduler, target=run, name=self.thread_name_prefix or None).start()
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+
+DoneAndNotDoneFutures = namedtuple('DoneAndNotDoneFutures', 'done not_done')
+
+
+def wait_futures(scheduler, fs, timeout=None, return_when=concurrent.futures.ALL_COMPLETED):
+    fs = list(fs)
+    deadline = None if timeout is None else scheduler.now + timeout
+    while True:
+        done = {f for f in fs if f.done()}
+        not_done = {f for f in fs if not f.done()}
+        if not not_done or (return_when == concurrent.futures.FIRST_COMPLETED and done):
+            break
+        if return_when == concurrent.futures.FIRST_EXCEPTION and any(f._exception is not None for f in done):
+            break
+        remaining = None if deadline is None else deadline - scheduler.now
+        if remaining is not None and remaining <= 0:
+            break
+        scheduler.wait([f.waiters for f in fs if not f.done()], remaining)
+    return DoneAndNotDoneFutures(done, not_done)
+
+
+def as_completed(scheduler, fs, timeout=None):
+    pending = list(fs)
+    total = len(pending)
+    deadline = None if timeout is None else scheduler.now + timeout
+    while pending:
+        done = [f for f in pending if f.done()]
+        for f in done:
+            pending.remove(f)
+            yield f
+        if not pending or done:
+            continue
+        remaining = None if deadline is None else deadline - scheduler.now
+        if remaining is not None and remaining <= 0:
+            raise concurrent.futures.TimeoutError(f'{len(pending)} (of {total}) futures unfinished')
+        scheduler.wait([f.waiters for f in pending], remaining)
+
+
+class Shim:
+    """
+    A module whose attributes are taken from a dict, then from the real module.
+    """
+
+    def __init__(self, real, **attributes):
+        self.__dict__.update(attributes)
+        self.__real = real
+
+    def __getattr__(self, name):
+        return getattr(self.__real, name)
+
+
+def simulated_modules(scheduler, seed, env):
+    """
+    Returns:
+        dict: Module name to the module a node imports in its place, with
+              env added to its environment.
+    """
+    futures = Shim(
+        concurrent.futures,
+        ThreadPoolExecutor=partial(SimExecutor, scheduler),
+        Future=partial(SimFuture, scheduler),
+        wait=partial(wait_futures, scheduler),
+        as_completed=partial(as_completed, scheduler)
+    )
+    rng = random.Random(seed)
+    return {
+        'os': Shim(os, environ=dict(os.environ, **env)),
+        'time': Shim(
+            time,
+            monotonic=lambda: scheduler.now,
+            perf_counter=lambda: scheduler.now,
+            time=lambda: SIM_EPOCH + scheduler.now,
+            sleep=scheduler.sleep
+        ),
+        'threading': Shim(
+            threading,
+            Thread=partial(SimThread, scheduler),
+            Lock=partial(SimLock, scheduler),
+            RLock=partial(SimRLock, scheduler),
+            Condition=partial(SimCondition, scheduler),
+            Event=partial(SimEvent, scheduler),
+            local=partial(SimLocal, scheduler),
+            current_thread=lambda: scheduler.current() or threading.current_thread()
+        ),
+        'random': Shim(random, **{name: getattr(rng, name) for name in dir(rng) if not name.startswith('_')}),
+        'concurrent': Shim(sys.modules['concurrent'], futures=futures),
+        'concurrent.futures': futures
+    }
+
+
+def import_node_modules(replacements):
+    """
+    Imports a fresh copy of the repo's modules, with replacements for some
+    of the modules they import.
+
+    Returns:
+        dict: Module name to the node's copy.
+    """
+    names = NODE_MODULES + tuple(replacements)
+    saved = {name: sys.modules.pop(name) for name in names if name in sys.modules}
+    try:
+        sys.modules.update(replacements)
+        importlib.import_module('kvs')
+        return {name: sys.modules[name] for name in NODE_MODULES}
+    finally:
+        for name in names:
+            sys.modules.pop(name, None)
+        sys.modules.update(saved)
+
+
+def response_from_wsgi(uri, app_iter, status, headers):
+    response = requests.Response()
+    response.status_code = int(status.split(' ', 1)[0])
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = b''.join(app_iter)
+    response._content_consumed = True
+    response.encoding = 'utf-8'
+    response.url = uri
+    return response
+
+
+class Node:
+    """
+    A node of the simulated cluster: its own copy of the repo's modules.
+    Killing and restarting one replaces it with a new Node.
+    """
+
+    def __init__(self, simulation, address, incarnation=0):
+        self.address = address
+        self.ip = address.split(':')[0]
+        self.alive = True
+        self.listening = SimEvent(simulation.scheduler) # Set once startup() returns, like a WSGI server's worker.
+        env = dict(simulation.env, SOCKET_ADDRESS=address, VIEW=','.join(simulation.addresses))
+        if simulation.shard_count is not None:
+            env['SHARD_COUNT'] = str(simulation.shard_count)
+        self.modules = import_node_modules(simulated_modules(simulation.scheduler, f'{simulation.seed}/{address}/{incarnation}', env))
+        self.kvs = self.modules['kvs']
+        self.modules['network'].transport = partial(simulation.send, self.ip)
+        quiet_logs()
+
+    def start(self):
+        self.kvs.startup()
+        self.listening.set()
+
+    def handle(self, source_ip, method, uri, data, headers):
+        """
+        Runs a request through the node's Flask app.
+
+        Returns:
+            requests.Response: Its response.
+        """
+        parts = urlsplit(uri)
+        builder = EnvironBuilder(
+            path=parts.path,
+            query_string=parts.query,
+            method=method,
+            data=data,
+            headers=headers,
+            environ_base={'REMOTE_ADDR': source_ip}
+        )
+        try:
+            environ = builder.get_environ()
+        finally:
+            builder.close()
+        app_iter, status, response_headers = run_wsgi_app(self.kvs.app, environ, buffered=True)
+        try:
+            return response_from_wsgi(uri, app_iter, status, response_headers)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+class Network:
+    """
+    Delivers messages after LATENCY plus up to JITTER virtual seconds, and
+    none between the groups of a partition.  Addresses in no group reach
+    every other.  As requests go over TCP, a lost packet isn't a lost
+    message but one retransmitted after a timeout, doubled every time it's
+    lost again.
+    """
+
+    def __init__(self, seed=0, latency=LATENCY, jitter=JITTER, loss=0.0):
+        self.rng = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.groups = {} # IP to its partition group.
+        self.sent = 0
+        self.dropped = 0
+        self.retransmitted = 0
+
+    def delay(self):
+        delay = self.latency + self.rng.uniform(0, self.jitter)
+        timeout = RETRANSMIT_TIMEOUT
+        while self.loss and self.rng.random() < self.loss:
+            self.retransmitted += 1
+            delay += timeout
+            timeout *= 2
+        return delay
+
+    def partition(self, *groups):
+        self.groups = {address.split(':')[0]: i for i, group in enumerate(groups) for address in group}
+
+    def heal(self):
+        self.groups = {}
+
+    def delivers(self, source_ip, target_ip):
+        a, b = self.groups.get(source_ip), self.groups.get(target_ip)
+        return a is None or b is None or a == b
+
+
+def node_address(i):
+    return f'10.0.{i // 250}.{i % 250 + 1}:{PORT}'
+
+
+class Simulation:
+    """
+    A simulated cluster of nodes, with every node in the view.
+
+    Args:
+        nodes (int): Nodes in the view.
+        shard_count (int): Shards to start with.
+        seed (int): Seeds scheduling, the network and the nodes' random modules.
+        env (dict): Environment variables set for every node.
+    """
+
+    def __init__(self, nodes=6, shard_count=2, seed=0, latency=LATENCY, jitter=JITTER, loss=0.0, env=None):
+        self.seed = seed
+        self.shard_count = shard_count
+        self.addresses = [node_address(i) for i in range(nodes)]
+        self.env = dict(NODE_ENV, **(env or {}))
+        self.scheduler = Scheduler(seed)
+        self.network = Network(seed, latency, jitter, loss)
+        self.rng = random.Random(seed)
+        self.nodes = {}
+        self.incarnations = {address: 0 for address in self.addresses}
+
+        # Load third party modules for real first, so only the repo's
+        # modules see the replacements.
+        environ = dict(os.environ, **self.env, SOCKET_ADDRESS=self.addresses[0], VIEW=','.join(self.addresses))
+        import_node_modules({'os': Shim(os, environ=environ)})
+
+    def spawn(self, fn, *args, node=None):
+        thread = SimThread(self.scheduler, target=fn, args=args, node=node)
+        thread.start()
+        return thread
+
+    def run_until(self, condition, timeout=MAX_RUN, interval=None):
+        """
+        Runs the simulation until condition() holds, for at most timeout
+        virtual seconds.  It's checked whenever a thread blocks, or every
+        interval virtual seconds for conditions too slow for that.
+
+        Returns:
+            bool: Whether condition() holds.
+        """
+        if interval is None:
+            self.scheduler.run(condition, timeout)
+            return condition()
+        deadline = self.scheduler.now + timeout
+        while not condition():
+            if self.scheduler.now >= deadline:
+                return False
+            self.run_for(min(interval, deadline - self.scheduler.now))
+        return True
+
+    def run_for(self, seconds):
+        """
+        Runs the simulation until seconds virtual seconds passed.
+        """
+        timer = self.spawn(self.scheduler.sleep, seconds)
+        self.run_until(lambda: timer.finished, seconds + 1)
+
+    def call(self, fn, *args, timeout=MAX_RUN):
+        """
+        Runs fn in a simulated thread of its own, running the simulation
+        until it returns.
+
+        Returns:
+            The value fn returned.  Raises what it raised.
+        """
+        outcome = {}
+        def run():
+            try:
+                outcome['result'] = fn(*args)
+            except Exception as e:
+                outcome['exception'] = e
+        thread = self.spawn(run)
+        if not self.run_until(lambda: thread.finished, timeout):
+            raise Deadlock(f'{getattr(fn, "__name__", fn)} did not return within {timeout} virtual seconds')
+        if 'exception' in outcome:
+            raise outcome['exception']
+        return outcome.get('result')
+
+    def start(self):
+        """
+        Starts every node at once, as if their processes started together.
+        """
+        for address in self.addresses:
+            self.nodes[address] = Node(self, address)
+        threads = [self.spawn(node.start, node=node) for node in self.nodes.values()]
+        if not self.run_until(lambda: all(t.finished for t in threads)):
+            raise Deadlock('Nodes did not start')
+        everyone = set(self.addresses)
+        if not self.run_until(lambda: all(n.modules['heartbeat'].alive == everyone for n in self.nodes.values()), MEMBERSHIP_TIMEOUT, POLL_INTERVAL):
+            raise Deadlock('Nodes did not all find each other alive')
+
+    def kill(self, address):
+        """
+        Kills a node.  Its threads stop the next time they block.
+        """
+        node = self.nodes.pop(address)
+        node.alive = False
+        self.scheduler.kill(node)
+
+    def restart(self, address):
+        """
+        Starts a killed node again.  Its memory storage engine restarts empty.
+        """
+        self.incarnations[address] += 1
+        node = self.nodes[address] = Node(self, address, self.incarnations[address])
+        thread = self.spawn(node.start, node=node)
+        if not self.run_until(lambda: thread.finished):
+            raise Deadlock(f'{address} did not restart')
+
+    def send(self, source_ip, address, http_method, uri, timeout=None, data=None, headers=None, stream=False):
+        """
+        The nodes' network.transport.  Runs on the sender's simulated thread,
+        serving the request on a thread of the receiving node.
+
+        Returns:
+            requests.Response: The response, None if the request timed out or
+                               the node is down.
+        """
+        self.network.sent += 1
+        node = self.nodes.get(address)
+        wait = timeout if timeout is not None else MAX_WAIT
+        if isinstance(wait, tuple):
+            wait = sum(wait) # Connect and read timeouts.
+        if node is None:
+            self.scheduler.sleep(2 * self.network.delay()) # Connection refused.
+            return None
+        if not self.network.delivers(source_ip, node.ip):
+            self.network.dropped += 1
+            self.scheduler.sleep(wait)
+            return None
+        started = self.scheduler.now
+        if not node.listening.wait(wait):
+            return None # Still starting up: the connection waits to be accepted until we time out.
+        wait -= self.scheduler.now - started
+
+        future = SimFuture(self.scheduler)
+        method = getattr(http_method, 'name', http_method)
+        def serve():
+            self.scheduler.sleep(self.network.delay())
+            response = node.handle(source_ip, method, uri, data, headers)
+            self.scheduler.sleep(self.network.delay())
+            if self.network.delivers(node.ip, source_ip):
+                future.set_result(response)
+            else:
+                self.network.dropped += 1
+        SimThread(self.scheduler, target=serve, node=node).start()
+        try:
+            return future.result(wait)
+        except concurrent.futures.TimeoutError:
+            return None
+
+    def request(self, method, key, value=None, metadata='', address=None, timeout=10):
+        """
+        Sends a key request as a client would, from a simulated thread.
+
+        Returns:
+            (int, dict): The response's status and body, (None, None) if it
+                         timed out.
+        """
+        address = address or self.rng.choice(self.addresses)
+        body = {'causal-metadata': metadata}
+        if value is not None:
+            body['value'] = value
+        response = self.send(
+            CLIENT_IP,
+            address,
+            method,
+            f'http://{address}/key-value-store/{key}',
+            timeout=timeout,
+            data=json.dumps(body),
+            headers={'Content-Type': 'application/json'}
+        )
+        if response is None:
+            return None, None
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, {}
+
+    def reshard(self, shard_count, address=None):
+        """
+        Returns:
+            int: The status of the reshard request.
+        """
+        address = address or self.addresses[0]
+        def reshard():
+            response = self.send(
+                CLIENT_IP,
+                address,
+                'PUT',
+                f'http://{address}/key-value-store-shard/reshard',
+                timeout=30,
+                data=json.dumps({'shard-count': shard_count}),
+                headers={'Content-Type': 'application/json'}
+            )
+            return None if response is None else response.status_code
+        return self.call(reshard)
+
+    def migrations_done(self, version):
+        return all(
+            node.kvs.shard_view_version >= version and node.kvs.migration.status()['state'] in ('idle', 'done')
+            for node in self.nodes.values()
+        )
+
+    def divergence(self):
+        """
+        Compares the stores and vector clocks of the alive members of each
+        shard, as seen by the first alive node.
+
+        Returns:
+            list: A description of every difference.
+        """
+        nodes = list(self.nodes.values())
+        differences = []
+        for shard_id, members in enumerate(nodes[0].kvs.shard_view_universe.copy()):
+            alive = [self.nodes[a] for a in sorted(members) if a in self.nodes]
+            if not alive:
+                continue
+            first = alive[0]
+            expected = (first.kvs.store.to_dict(), dict(first.kvs.vector_clock))
+            for node in alive[1:]:
+                data, vector_clock = node.kvs.store.to_dict(), dict(node.kvs.vector_clock)
+                if data != expected[0]:
+                    keys = set(data).symmetric_difference(expected[0]) | {k for k in data if data.get(k) != expected[0].get(k)}
+                    differences.append(f'shard {shard_id}: {node.address} and {first.address} differ on {len(keys)} keys')
+                if vector_clock != expected[1]:
+                    differences.append(f'shard {shard_id}: {node.address} and {first.address} have different vector clocks')
+        return differences
+
+    def converged(self):
+        try:
+            return not self.divergence()
+        except Deadlock:
+            return False # A node is midway through changing its store.
+
+    def close(self):
+        self.scheduler.close()
+
+
+def quiet_logs():
+    # Killed nodes and partitions make the nodes log plenty of expected errors.
+    logging.getLogger('kvs').setLevel(logging.CRITICAL)
+    heartbeat = logging.getLogger('heartbeat')
+    if not heartbeat.handlers:
+        heartbeat.addHandler(logging.NullHandler()) # Otherwise heartbeat.start() adds one.
+    for name in ('heartbeat', 'migration', 'replication', 'storage', 'werkzeug'):
+        logging.getLogger(name).setLevel(logging.ERROR)
+
+
+class Clients:
+    """
+    Simulated clients sending GETs and PUTs to random nodes, each carrying
+    the causal metadata of its previous responses.  Every client writes keys
+    of its own, and checks it reads its own writes back.
+    """
+
+    def __init__(self, simulation, clients=8, keys=100, reads=0.5, addresses=None):
+        self.simulation = simulation
+        self.addresses = addresses or simulation.addresses
+        self.rng = random.Random(simulation.seed)
+        self.clients = clients
+        self.keys = keys
+        self.reads = reads
+        self.latencies = []
+        self.statuses = {}
+        self.violations = []
+        self.written = {} # Last value written to each key, None if we don't know whether it was.
+        self.running = False
+
+    def run_client(self, client):
+        metadata = ''
+        while self.running:
+            key = f'c{client}k{self.rng.randrange(self.keys)}'
+            start = self.simulation.scheduler.now
+            if self.rng.random() < self.reads:
+                status, body = self.simulation.request('GET', key, metadata=metadata, address=self.rng.choice(self.addresses))
+                if status == 200 and self.written.get(key) is not None and body.get('value') != self.written[key]:
+                    self.violations.append(f'{key}: read {body.get("value")!r} after writing {self.written[key]!r}')
+                elif status == 404 and self.written.get(key) is not None:
+                    self.violations.append(f'{key}: not found after writing {self.written[key]!r}')
+            else:
+                value = f'{client}-{start:.6f}'
+                status, body = self.simulation.request('PUT', key, value, metadata=metadata, address=self.rng.choice(self.addresses))
+                # Unless acknowledged, the write may or may not have happened.
+                self.written[key] = value if status in (200, 201) else None
+            self.latencies.append(self.simulation.scheduler.now - start)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if body is not None:
+                metadata = merge_metadata(metadata, body.get('causal-metadata', ''))
+
+    def start(self):
+        self.running = True
+        for client in range(self.clients):
+            self.simulation.spawn(self.run_client, client)
+
+    def stop(self):
+        self.running = False
+
+    def results(self, seconds):
+        return {
+            'ops': len(self.latencies),
+            'throughput': len(self.latencies) / seconds if seconds else None,
+            'latency': percentiles(self.latencies),
+            'statuses': {str(k): v for k, v in sorted(self.statuses.items(), key=str)},
+            'violations': self.violations
+        }
+
+
+def run_workload(simulation, args):
+    clients = Clients(simulation, args.clients, args.keys, args.reads)
+    clients.start()
+    simulation.run_for(args.duration)
+    clients.stop()
+    return clients.results(args.duration)
+
+
+def run_reshard(simulation, args):
+    """
+    Writes keys, then reshards and times until every node finished moving
+    them.  Checks no key was lost, and that nodes only sent the keys whose
+    shard changed on the ring, as every node of a key's shard sends it,
+    rather than every key of the nodes that changed shard.
+    """
+    clients = Clients(simulation, args.clients, args.keys, 0.0)
+    clients.start()
+    simulation.run_for(args.duration)
+    clients.stop()
+    simulation.run_for(1) # Let replication settle.
+
+    nodes = list(simulation.nodes.values())
+    before = {}
+    for node in nodes:
+        before.update(node.kvs.store.to_dict())
+    held = {node.address: list(node.kvs.store) for node in nodes}
+    previous_ring = nodes[0].kvs.shard_ring
+    ring = HashRing(args.reshard_to, previous_ring.vnodes)
+
+    start = simulation.scheduler.now
+    status = simulation.reshard(args.reshard_to)
+    version = simulation.nodes[simulation.addresses[0]].kvs.shard_view_version
+    done = simulation.run_until(lambda: simulation.migrations_done(version), MAX_RUN, POLL_INTERVAL)
+    seconds = simulation.scheduler.now - start
+
+    after = {}
+    for node in nodes:
+        after.update(node.kvs.store.to_dict())
+    keys_moved = sum(n.kvs.migration.status().get('keys_moved', 0) for n in nodes)
+    # Keys whose shard changed, but not to the node's own new shard.
+    expected_moves = sum(
+        1 for node in nodes for key in held[node.address]
+        if ring.get_shard_id(key) not in (previous_ring.get_shard_id(key), node.kvs.get_my_id())
+    )
+    violations = [f'{key}: lost in the reshard' for key in sorted(set(before).difference(after))]
+    if keys_moved > expected_moves:
+        violations.append(f'{keys_moved} keys moved, only {expected_moves} changed shard')
+    return {
+        'status': status,
+        'shard_count': args.reshard_to,
+        'done': done,
+        'seconds': seconds,
+        'keys': len(before),
+        'keys_moved': keys_moved,
+        'expected_moves': expected_moves,
+        'moved_per_key': keys_moved / len(before) if before else 0,
+        'violations': violations
+    }
+
+
+def run_catch_up(simulation, args):
+    """
+    Partitions a node away while clients write, then heals the partition and
+    times until its shard converges again.
+    """
+    victim = simulation.addresses[-1]
+    others = simulation.addresses[:-1]
+    simulation.network.partition([victim], others + [CLIENT_IP])
+    clients = Clients(simulation, args.clients, args.keys, 0.0, others)
+    clients.start()
+    simulation.run_for(args.duration)
+    clients.stop()
+    simulation.run_for(1)
+    start = simulation.scheduler.now
+    simulation.network.heal()
+    converged = simulation.run_until(simulation.converged, MAX_RUN, POLL_INTERVAL)
+    return {'node': victim, 'converged': converged, 'seconds': simulation.scheduler.now - start}
+
+
+def run_fuzz(simulation, args):
+    """
+    Runs clients while partitioning, killing and restarting nodes at random,
+    then heals everything and checks the shards converge.
+    """
+    rng = random.Random(args.seed)
+    clients = Clients(simulation, args.clients, args.keys, args.reads)
+    clients.start()
+    faults = []
+    killed = []
+    end = simulation.scheduler.now + args.duration
+    while simulation.scheduler.now < end:
+        simulation.run_for(min(rng.uniform(1, 5), end - simulation.scheduler.now))
+        fault = rng.choice(['partition', 'heal', 'kill', 'restart'])
+        if fault == 'partition':
+            nodes = rng.sample(simulation.addresses, rng.randint(1, max(1, len(simulation.addresses) // 2)))
+            simulation.network.partition(nodes, [a for a in simulation.addresses if a not in nodes] + [CLIENT_IP])
+        elif fault == 'heal':
+            simulation.network.heal()
+        elif fault == 'kill' and len(killed) < len(simulation.addresses) // 4:
+            killed.append(rng.choice([a for a in simulation.addresses if a not in killed]))
+            simulation.kill(killed[-1])
+        elif fault == 'restart' and killed:
+            simulation.restart(killed.pop(rng.randrange(len(killed))))
+        else:
+            continue
+        faults.append((round(simulation.scheduler.now, 3), fault))
+    clients.stop()
+    simulation.network.heal()
+    for address in killed:
+        simulation.restart(address)
+    converged = simulation.run_until(simulation.converged, MAX_RUN, POLL_INTERVAL)
+    results = clients.results(args.duration)
+    results.update({'faults': faults, 'converged': converged, 'divergence': simulation.divergence()})
+    return results
+
+
+def run_locks(simulation, args):
+    """
+    Sends PUTs, DELETEs and GETs of a few keys, shared by every client, to
+    every member of one shard at once, so writes to the same key and to keys
+    on the same lock stripe race each other.  Clients send in rounds, all at
+    once, over a network without jitter, so their requests arrive together,
+    and threads are preempted before taking locks, so whatever a lock
+    doesn't guard interleaves.  Checks no member ever applies a write over
+    a newer version of the key, a lost update the next write would hide.
+    Once replication settled, checks the members agree on the store and
+    vector clock, that each of them delivered every member's writes once
+    and in order, that every write it stamped was logged for replication,
+    and that each key holds the write with the newest version.
+    """
+    first = simulation.nodes[simulation.addresses[0]].kvs
+    members = sorted(first.shard_view_universe[0])
+    keys = [key for key in (f'k{i}' for i in range(10 * CONTENDED_KEYS)) if first.key_to_shard_id(key) == 0][:CONTENDED_KEYS]
+    rng = random.Random(args.seed)
+    latencies = []
+    statuses = {}
+    violations = []
+    running = True
+
+    def watch(address, store):
+        # Compares versions under the store's lock, which put and delete take again.
+        put, delete = store.put, store.delete
+        def check(method, key, version):
+            current = store.version(key)
+            if current is not None and current > version:
+                violations.append(f'{address}: {method} of {key} at {version} applied over {current}')
+        def checked_put(key, value, expires, version): # As kvs calls it.
+            with store.lock:
+                check('PUT', key, version)
+                put(key, value, expires, version)
+        def checked_delete(key, version):
+            with store.lock:
+                check('DELETE', key, version)
+                delete(key, version)
+        store.put, store.delete = checked_put, checked_delete
+
+    for address in members:
+        watch(address, simulation.nodes[address].kvs.store)
+
+    def run_client(client):
+        metadata = ''
+        while running:
+            now = simulation.scheduler.now
+            simulation.scheduler.sleep((math.floor(now / LOCK_ROUND) + 1) * LOCK_ROUND - now)
+            key, address = rng.choice(keys), rng.choice(members)
+            method = rng.choice(['GET', 'PUT', 'DELETE'])
+            start = simulation.scheduler.now
+            value = f'{client}-{start:.6f}' if method == 'PUT' else None
+            status, body = simulation.request(method, key, value, metadata=metadata, address=address)
+            latencies.append(simulation.scheduler.now - start)
+            statuses[status] = statuses.get(status, 0) + 1
+            if body is not None:
+                metadata = merge_metadata(metadata, body.get('causal-metadata', ''))
+
+    jitter, simulation.network.jitter = simulation.network.jitter, 0
+    simulation.scheduler.preemption = LOCK_PREEMPTION
+    for client in range(args.clients):
+        simulation.spawn(run_client, client)
+    simulation.run_for(args.duration)
+    running = False
+    simulation.scheduler.preemption = 0.0
+    simulation.network.jitter = jitter
+
+    # Only wait for replication, not anti-entropy, which would repair a lost
+    # update before we see it.
+    def replicated():
+        nodes = [simulation.nodes[a].kvs for a in members]
+        return all(not n.replication_log.unacked() and not n.delivery_buffer.to_list() for n in nodes) \
+            and all(dict(n.vector_clock) == dict(nodes[0].vector_clock) for n in nodes)
+    settled = simulation.run_until(replicated, MAX_RUN, POLL_INTERVAL)
+
+    violations += simulation.divergence()
+    if statuses.get(None):
+        violations.append(f'{statuses[None]} requests got no answer') # Deadlocked, likely.
+    for address in members:
+        kvs = simulation.nodes[address].kvs
+        me = kvs.my_address_no_port
+        operations = list(kvs.op_log.entries)
+        if kvs.replication_log.end != kvs.vector_clock[me]:
+            violations.append(f'{address}: logged {kvs.replication_log.end} writes for replication, stamped {kvs.vector_clock[me]}')
+        for origin in sorted({m.split(':')[0] for m in members}):
+            entries = [operation['vc'][origin] for operation in operations if operation['origin'] == origin]
+            if entries != list(range(1, kvs.vector_clock[origin] + 1)):
+                violations.append(f'{address}: delivered clock entries {entries[:10]}... of {origin}, up to {kvs.vector_clock[origin]}')
+
+        # Each key holds the write with the newest version, or nothing if it was a delete.
+        newest = {}
+        for operation in operations:
+            version = operation['data'][kvs.VERSION_FIELD]
+            if operation['key'] not in newest or version > newest[operation['key']][0]:
+                newest[operation['key']] = (version, operation)
+        data = kvs.store.to_dict()
+        for key, (version, operation) in sorted(newest.items()):
+            expected = operation['data']['value'] if operation['op'] == 'PUT' else None
+            if data.get(key) != expected or kvs.store.version(key) != version:
+                violations.append(f'{address}: {key} is {data.get(key)!r}, newest write is {operation["op"]} {expected!r}')
+
+    return {
+        'settled': settled,
+        'keys': keys,
+        'ops': len(latencies),
+        'latency': percentiles(latencies),
+        'statuses': {str(k): v for k, v in sorted(statuses.items(), key=str)},
+        'violations': violations
+    }
+
+
+def run_snapshot(simulation, args):
+    """
+    Installs a snapshot on a node whose delivery buffer holds a write that's
+    deliverable once the snapshot's vector clock is installed, as a member
+    of its shard would send it in catch_up().  Checks the install returns,
+    having delivered the write.
+    """
+    address = simulation.addresses[0]
+    kvs = simulation.nodes[address].kvs
+    peer = sorted(kvs.shard_view_universe[kvs.get_my_id()].difference({address}))[0].split(':')[0]
+    key = next(key for key in (f'k{i}' for i in range(100)) if kvs.key_to_shard_id(key) == kvs.get_my_id())
+
+    vector_clock = dict(kvs.vector_clock)
+    entry = dict(vector_clock, **{peer: vector_clock[peer] + 1})
+    version = [kvs.store.latest + 1, peer, kvs.shard_view_version, entry[peer]]
+    header = {
+        'mode': 'snapshot',
+        'vector_clock': vector_clock,
+        'delivery_buffer': [[entry, ['PUT', peer, key, {'value': 'buffered', kvs.VERSION_FIELD: version}]]]
+    }
+    chunks = [{'items': kvs.store.export()}]
+
+    violations = []
+    start = simulation.scheduler.now
+    try:
+        simulation.call(kvs.install_snapshot, header, iter(chunks), timeout=10)
+    except Deadlock as e:
+        violations.append(str(e))
+    else:
+        if kvs.store.get(key) != 'buffered':
+            violations.append(f'{key} is {kvs.store.get(key)!r}, the buffered write was not delivered')
+        if kvs.vector_clock[peer] != entry[peer] or kvs.delivery_buffer.to_list():
+            violations.append(f'clock entry of {peer} is {kvs.vector_clock[peer]}, buffer holds {kvs.delivery_buffer.to_list()}')
+    return {'node': address, 'seconds': simulation.scheduler.now - start, 'violations': violations}
+
+
+def run_parallel(simulation, args):
+    """
+    Holds a PUT of one key in the middle of applying it on a node, sends a
+    PUT of a key on another lock stripe to the same node, and checks it's
+    applied while the first one is still held.  Once the first is let go,
+    checks both succeeded, and were logged and advanced the clock in the
+    order they were stamped.
+    """
+    address = simulation.addresses[0]
+    kvs = simulation.nodes[address].kvs
+    me = kvs.my_address_no_port
+    owned = [key for key in (f'k{i}' for i in range(100)) if kvs.key_to_shard_id(key) == kvs.get_my_id()]
+    held = owned[0]
+    other = next(key for key in owned if kvs.key_locks.for_key(key) is not kvs.key_locks.for_key(held))
+
+    entered, release = SimEvent(simulation.scheduler), SimEvent(simulation.scheduler)
+    applied = []
+    put = kvs.store.put
+    def held_put(key, value, expires, version): # As kvs calls it.
+        if key == held:
+            entered.set()
+            release.wait()
+        put(key, value, expires, version)
+        applied.append(key)
+    kvs.store.put = held_put
+
+    statuses = {}
+    def send(key):
+        statuses[key] = simulation.request('PUT', key, key, address=address)[0]
+
+    violations = []
+    entry = kvs.vector_clock[me]
+    simulation.spawn(send, held)
+    simulation.run_until(entered.is_set, 10)
+    simulation.spawn(send, other)
+    parallel = simulation.run_until(lambda: other in applied, 10)
+    if not parallel:
+        violations.append(f'PUT of {other} was not applied while the PUT of {held} was')
+    release.set()
+    simulation.run_until(lambda: len(statuses) == 2, 30)
+    kvs.store.put = put
+
+    if statuses != {held: 201, other: 201}:
+        violations.append(f'PUTs answered {statuses}')
+    logged = [(operation['key'], operation['vc'][me]) for operation in list(kvs.op_log.entries)[-2:]]
+    if logged != [(held, entry + 1), (other, entry + 2)] or kvs.vector_clock[me] != entry + 2:
+        violations.append(f'logged {logged}, clock entry is {kvs.vector_clock[me]}, was {entry}')
+    for key, stamped in ((held, entry + 1), (other, entry + 2)):
+        if kvs.store.get(key) != key or kvs.store.version(key)[3] != stamped:
+            violations.append(f'{key} is {kvs.store.get(key)!r} at {kvs.store.version(key)}, stamped with entry {stamped}')
+    return {'node': address, 'keys': [held, other], 'parallel': parallel, 'statuses': statuses, 'violations': violations}
+
+
+SCENARIOS = {
+    'workload': run_workload,
+    'reshard': run_reshard,
+    'catch-up': run_catch_up,
+    'fuzz': run_fuzz,
+    'locks': run_locks,
+    'snapshot': run_snapshot,
+    'parallel': run_parallel
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Simulates a cluster in virtual time.')
+    parser.add_argument('--nodes', type=int, default=6)
+    parser.add_argument('--shards', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='workload')
+    parser.add_argument('--duration', type=float, default=10, help='Virtual seconds of client requests.')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--keys', type=int, default=100, help='Keys per client.')
+    parser.add_argument('--reads', type=float, default=0.5, help='Share of GETs.  The rest are PUTs.')
+    parser.add_argument('--latency', type=float, default=LATENCY, help='Virtual seconds a message takes one way.')
+    parser.add_argument('--jitter', type=float, default=JITTER)
+    parser.add_argument('--loss', type=float, default=0.0, help='Share of packets lost, each delaying its message by a retransmission.')
+    parser.add_argument('--reshard-to', type=int, help='Shard count to reshard to, by default one more.')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='Set for every node.')
+    parser.add_argument('--output', help='File to write the results to, as JSON.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    if os.environ.get('PYTHONHASHSEED') is None:
+        # Set iteration order depends on string hashes.
+        os.execve(sys.executable, [sys.executable] + sys.argv, dict(os.environ, PYTHONHASHSEED='0'))
+    args = parse_args(argv)
+    if args.reshard_to is None:
+        args.reshard_to = args.shards + 1
+
+    started = time.monotonic()
+    simulation = Simulation(
+        args.nodes, args.shards, args.seed, args.latency, args.jitter, args.loss,
+        env=dict(e.split('=', 1) for e in args.env)
+    )
+    simulation.start()
+    results = {'config': vars(args), 'startup': {'virtual_seconds': simulation.scheduler.now, 'seconds': time.monotonic() - started}}
+    try:
+        scenario_started, virtual_started = time.monotonic(), simulation.scheduler.now
+        results[args.scenario] = SCENARIOS[args.scenario](simulation, args)
+        results['virtual_seconds'] = simulation.scheduler.now - virtual_started
+        results['seconds'] = time.monotonic() - scenario_started
+        results['messages'] = simulation.network.sent
+        results['dropped'] = simulation.network.dropped
+        results['retransmitted'] = simulation.network.retransmitted
+        results['switches'] = simulation.scheduler.switches
+    finally:
+        simulation.close()
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    failed = results[args.scenario].get('violations') or results[args.scenario].get('divergence') \
+        or results[args.scenario].get('converged') is False or results[args.scenario].get('settled') is False
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,9 @@
 #!/bin/bash
 
-pipenv run python heartbeat.py > heartbeat.log 2>&1 &
-pipenv run python kvs.py
+if [ "$SERVER_MODE" = "asgi" ]; then
+    pipenv run uvicorn asgi:app --workers 1 --timeout-keep-alive 30 \
+        --host 0.0.0.0 --port "${SOCKET_ADDRESS##*:}"
+else
+    pipenv run gunicorn --workers 1 --worker-class gthread --threads 32 --keep-alive 30 \
+        --bind "0.0.0.0:${SOCKET_ADDRESS##*:}" wsgi:app
+fi
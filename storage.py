@@ -0,0 +1,526 @@
+from collections.abc import MutableMapping
+from merkle import MerkleTree
+from tiered import STORE_MEMORY_BUDGET, TieredDict
+from ttl import TimerWheel
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+
+STORAGE_ENGINE = os.environ.get('STORAGE_ENGINE', 'wal') # 'wal' or 'memory'.
+DATA_DIR = os.environ.get('DATA_DIR', '.data')
+WAL_FSYNC = os.environ.get('WAL_FSYNC', 'batch') # 'always', 'batch' or 'interval'.
+WAL_FSYNC_BATCH = int(os.environ.get('WAL_FSYNC_BATCH', 64)) # Records per fsync with the 'batch' policy.
+WAL_FSYNC_INTERVAL = float(os.environ.get('WAL_FSYNC_INTERVAL', 1)) # Seconds between fsyncs with the 'interval' policy.
+SNAPSHOT_INTERVAL = float(os.environ.get('SNAPSHOT_INTERVAL', 60)) # Seconds between snapshots.
+SNAPSHOT_MIN_RECORDS = int(os.environ.get('SNAPSHOT_MIN_RECORDS', 10000)) # Log records that trigger an early snapshot.
+SNAPSHOT_FILENAME = 'snapshot.json'
+SPILL_FILENAME = 'store.spill'
+WAL_FILENAME = 'wal.{}.log'
+VERSION_ZERO = [0, '', 0, 0] # Version of values written before keys had versions, older than any other.
+
+logger = logging.getLogger(__name__)
+
+
+def item_size(key, value):
+    # Characters rather than bytes, which would mean encoding every value.
+    return len(key) + (len(value) if isinstance(value, str) else len(json.dumps(value)))
+
+
+def write_snapshot(f, snapshot):
+    # Writes the store an item at a time, so a TieredDict's values aren't
+    # all decoded at once.
+    f.write('{"store": {')
+    for i, (key, value) in enumerate(snapshot['store'].items()):
+        f.write((', ' if i else '') + json.dumps(key) + ': ' + json.dumps(value))
+    f.write('}')
+    for name, value in snapshot.items():
+        if name != 'store':
+            f.write(', ' + json.dumps(name) + ': ' + json.dumps(value))
+    f.write('}')
+
+
+class StorageEngine(MutableMapping):
+    """
+    The key-value store of a node, kept in memory.
+
+    Besides the data, engines are told about every change of the vector
+    clock and the delivery buffer, so durable engines can persist them next
+    to the data.  This one forgets everything on restart.
+
+    Every key has the version of the write that last changed it, [time,
+    origin, shard view version, clock entry], and replicas settle conflicts
+    on the highest one.  Deleted keys leave a tombstone with the delete's
+    version, until the caller collects it, so an older value of the key
+    can't come back from another replica.
+
+    Every change is also applied to a Merkle tree of the data, which
+    replicas compare to find where their stores differ.
+
+    Keys put with an expiry read as missing once it passed.  They stay in
+    the data until reclaimed, either when read or when the timer wheel says
+    they're due.
+
+    With STORE_MEMORY_BUDGET set, the data is a TieredDict, which keeps the
+    values encoded and spills the least recently used ones to data_dir.
+    """
+
+    def __init__(self, data_dir=DATA_DIR):
+        self.data_dir = data_dir
+        self.data = TieredDict(os.path.join(data_dir, SPILL_FILENAME)) if STORE_MEMORY_BUDGET > 0 else {}
+        self.expiries = {} # Key to the time it expires, for keys put with a ttl.
+        self.versions = {} # Key to its version.
+        self.tombstones = {} # Deleted key to the version of its delete.
+        self.latest = 0 # Highest version time we stored.
+        self.wheel = TimerWheel(time.time()) # When each expiry is due.
+        self.size = 0 # Size of the keys and values, per item_size().
+        self.tree = MerkleTree()
+        self.lock = threading.RLock()
+
+    def append(self, record):
+        # Persists a change before it's applied.  Caller holds the lock.
+        pass
+
+    def is_expired(self, key, now=None):
+        expires = self.expiries.get(key)
+        return expires is not None and expires <= (time.time() if now is None else now)
+
+    def __getitem__(self, key):
+        if self.is_expired(key):
+            raise KeyError(key)
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def put(self, key, value, expires=None, version=VERSION_ZERO):
+        """
+        Stores value under key, until expires if given.  Putting a key
+        without an expiry keeps it until it's deleted.
+        """
+        with self.lock:
+            record = {'op': 'put', 'key': key, 'value': value, 'version': version}
+            if expires is not None:
+                record['expires'] = expires
+            self.append(record)
+            self.discard(key)
+            self.data[key] = value
+            self.versions[key] = version
+            self.size += item_size(key, value)
+            if expires is not None:
+                self.expiries[key] = expires
+                self.wheel.schedule(key, expires)
+            self.tree.add(self.as_record(key, value))
+            self.latest = max(self.latest, version[0])
+
+    def delete(self, key, version):
+        """
+        Deletes key, leaving a tombstone with the delete's version, even if
+        we didn't have the key.
+        """
+        with self.lock:
+            self.append({'op': 'tombstone', 'key': key, 'version': version})
+            self.discard(key)
+            self.tombstones[key] = version
+            self.tree.add([key, version])
+            self.latest = max(self.latest, version[0])
+
+    def discard(self, key):
+        # Removes key or its tombstone, without persisting it.  Caller holds the lock.
+        if key in self.data:
+            record = self.as_record(key, self.data.pop(key))
+            self.size -= item_size(key, record[2])
+            self.tree.remove(record)
+            self.versions.pop(key, None)
+            self.expiries.pop(key, None)
+        elif key in self.tombstones:
+            self.tree.remove([key, self.tombstones.pop(key)])
+
+    def __delitem__(self, key):
+        # Removes key without leaving a tombstone, for keys we hand off.
+        with self.lock:
+            if key not in self.data and key not in self.tombstones:
+                raise KeyError(key)
+            self.append({'op': 'delete', 'key': key})
+            self.discard(key)
+
+    def __contains__(self, key):
+        return key in self.data and not self.is_expired(key)
+
+    def __iter__(self):
+        return iter(list(self.data))
+
+    def __len__(self):
+        return len(self.data)
+
+    def items(self):
+        with self.lock:
+            now = time.time()
+            return [(key, value) for key, value in self.data.items() if not self.is_expired(key, now)]
+
+    def clear(self):
+        with self.lock:
+            self.append({'op': 'clear'})
+            self.data.clear()
+            self.expiries.clear()
+            self.versions.clear()
+            self.tombstones.clear()
+            self.wheel = TimerWheel(time.time())
+            self.size = 0
+            self.tree.clear()
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def version(self, key):
+        """
+        Returns:
+            list: The version of key's value or tombstone, None if we have
+                  neither.
+        """
+        with self.lock:
+            if key in self.data:
+                return self.versions.get(key, VERSION_ZERO)
+            return self.tombstones.get(key)
+
+    def record(self, key):
+        """
+        Returns:
+            list: [key, version, value], or [key, version, value, expires]
+                  if key was put with an expiry, [key, version] if it's a
+                  tombstone, None if it's missing or expired.
+        """
+        with self.lock:
+            if key in self.tombstones:
+                return [key, self.tombstones[key]]
+            if key not in self:
+                return None
+            return self.as_record(key, self.data[key])
+
+    def as_record(self, key, value):
+        if key in self.expiries:
+            return [key, self.versions.get(key, VERSION_ZERO), value, self.expiries[key]]
+        return [key, self.versions.get(key, VERSION_ZERO), value]
+
+    def export(self):
+        """
+        Returns:
+            list: The record() of every key that isn't expired, and of
+                  every tombstone.
+        """
+        with self.lock:
+            records = [self.as_record(key, value) for key, value in self.items()]
+            return records + [[key, version] for key, version in self.tombstones.items()]
+
+    def apply(self, record):
+        """
+        Stores a record from another replica, as record() returns it, unless
+        we have the same or a newer version of its key.
+
+        Returns:
+            bool: Whether it was stored.
+        """
+        key, version = record[0], record[1]
+        with self.lock:
+            current = self.version(key)
+            if current is not None and current >= version:
+                return False
+            if len(record) == 2:
+                self.delete(key, version)
+            else:
+                self.put(key, record[2], record[3] if len(record) > 3 else None, version)
+            return True
+
+    def replace(self, records):
+        """
+        Replaces the whole store with records, as returned by export(), when
+        pulling another replica's state.
+        """
+        with self.lock:
+            self.clear()
+            for record in records:
+                self.apply(record)
+
+    def collect_tombstones(self, delivered):
+        """
+        Drops the tombstones whose version delivered() is true of, once
+        every replica has deleted their key.  Nothing is persisted: replaying
+        the log brings them back, and they're collected again.
+
+        Returns:
+            int: How many were dropped.
+        """
+        with self.lock:
+            keys = [key for key, version in self.tombstones.items() if delivered(version)]
+            for key in keys:
+                self.discard(key)
+            return len(keys)
+
+    def expired(self, now, limit):
+        """
+        Returns:
+            list: Up to limit keys whose expiry passed by now, which the timer
+                  wheel hadn't returned yet.
+        """
+        with self.lock:
+            keys = []
+            while len(keys) < limit:
+                due = self.wheel.pop_due(now, limit - len(keys))
+                if not due:
+                    break
+                # Skip keys deleted or put again since they were scheduled.
+                keys.extend(key for key, expires in due if self.expiries.get(key) == expires)
+            return keys
+
+    def reclaim(self, key):
+        """
+        Removes key if it expired.  Nothing is persisted: replaying the log
+        puts it back with the same expiry, and it's reclaimed again.
+
+        Returns:
+            bool: Whether key was removed.
+        """
+        if not self.is_expired(key):
+            return False
+        with self.lock:
+            if not self.is_expired(key):
+                return False
+            self.discard(key)
+            return True
+
+    def log_clock(self, address, entry):
+        """
+        Records that address's vector clock entry advanced to entry.
+        """
+        with self.lock:
+            self.append({'op': 'clock', 'address': address, 'entry': entry})
+
+    def log_vector_clock(self, vector_clock):
+        """
+        Records that the whole vector clock was replaced, which also empties
+        the delivery buffer.
+        """
+        with self.lock:
+            self.append({'op': 'vector_clock', 'vector_clock': vector_clock})
+
+    def log_buffered(self, message):
+        """
+        Records a message added to the delivery buffer.
+        """
+        with self.lock:
+            self.append({'op': 'buffer', 'message': message})
+
+    def recover(self):
+        """
+        Returns:
+            dict: The vector clock and delivery buffer persisted with the
+                  data, None if nothing was persisted.
+        """
+        return None
+
+    def stats(self):
+        """
+        Returns:
+            dict: How many keys the store has and their size, with the
+                  memory and hit rate of the TieredDict, if any.
+        """
+        stats = {'keys': len(self.data), 'size': self.size, 'expiring_keys': len(self.expiries), 'tombstones': len(self.tombstones)}
+        if isinstance(self.data, TieredDict):
+            stats.update(self.data.stats())
+        return stats
+
+    def start(self, get_state):
+        """
+        Starts background work.
+
+        Args:
+            get_state (function): Returns the current vector clock and
+                                  delivery buffer, as recover() does.
+        """
+        pass
+
+
+class WALStorageEngine(StorageEngine):
+    """
+    Keeps the store in memory and appends every change to a write-ahead
+    log before applying it.
+
+    Every SNAPSHOT_INTERVAL seconds, or sooner once the log has
+    SNAPSHOT_MIN_RECORDS records, we start a new log and write a compacted
+    snapshot of the store, vector clock and delivery buffer.  The snapshot
+    records which log it was started with, so on boot we load it and only
+    replay the logs from that one on.  Replaying a record twice is harmless:
+    clock entries only move forward, and later puts and deletes win.
+
+    How often the log is fsynced depends on WAL_FSYNC: after every record
+    ('always'), after every WAL_FSYNC_BATCH records ('batch'), or every
+    WAL_FSYNC_INTERVAL seconds in the background ('interval').
+    """
+
+    def __init__(self, data_dir=DATA_DIR, fsync=WAL_FSYNC):
+        super().__init__(data_dir)
+        self.fsync = fsync
+        os.makedirs(data_dir, exist_ok=True)
+
+        self.generation = 0 # Number of the log we're appending to.
+        self.wal = None
+        self.records = 0 # Records in the current log.
+        self.unsynced = 0 # Records written since the last fsync.
+        self.get_state = None
+
+    def wal_path(self, generation):
+        return os.path.join(self.data_dir, WAL_FILENAME.format(generation))
+
+    def wal_generations(self):
+        paths = glob.glob(os.path.join(self.data_dir, WAL_FILENAME.format('*')))
+        return sorted(int(os.path.basename(path).split('.')[1]) for path in paths)
+
+    def append(self, record):
+        # Caller holds the lock.
+        self.wal.write(json.dumps(record) + '\n')
+        self.wal.flush()
+        self.records += 1
+        self.unsynced += 1
+        if self.fsync == 'always' or (self.fsync == 'batch' and self.unsynced >= WAL_FSYNC_BATCH):
+            self.sync()
+
+    def sync(self):
+        # Caller holds the lock.
+        if self.unsynced > 0:
+            os.fsync(self.wal.fileno())
+            self.unsynced = 0
+
+    def recover(self):
+        state = None
+        snapshot_path = os.path.join(self.data_dir, SNAPSHOT_FILENAME)
+        first_generation = 0
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, 'r') as f:
+                snapshot = json.load(f)
+            self.data.update(snapshot.pop('store'))
+            self.expiries = snapshot.get('expiries', {})
+            self.versions = snapshot.get('versions', {})
+            self.tombstones = snapshot.get('tombstones', {})
+            state = {'vector_clock': snapshot['vector_clock'], 'delivery_buffer': snapshot['delivery_buffer']}
+            first_generation = snapshot['generation']
+
+        start = time.time()
+        replayed = 0
+        generations = [g for g in self.wal_generations() if g >= first_generation]
+        for generation in generations:
+            with open(self.wal_path(generation), 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.decoder.JSONDecodeError: # Torn write at the end of the log.
+                        break
+                    if state is None:
+                        state = {'vector_clock': {}, 'delivery_buffer': []}
+                    self.replay(record, state)
+                    replayed += 1
+        self.tree.rebuild(self.as_record(key, value) for key, value in self.data.items())
+        for key, version in self.tombstones.items():
+            self.tree.add([key, version])
+        self.size = sum(item_size(key, value) for key, value in self.data.items())
+        self.latest = max((version[0] for version in list(self.versions.values()) + list(self.tombstones.values())), default=0)
+        for key, expires in self.expiries.items():
+            self.wheel.schedule(key, expires)
+        logger.info(f'Recovered {len(self.data)} keys, replayed {replayed} records in {time.time() - start:.3f}s')
+
+        for generation in self.wal_generations():
+            if generation < first_generation:
+                os.remove(self.wal_path(generation))
+        self.generation = max(generations + [first_generation - 1]) + 1
+        self.wal = open(self.wal_path(self.generation), 'a')
+        return state
+
+    def replay(self, record, state):
+        op = record['op']
+        if op == 'put':
+            self.data[record['key']] = record['value']
+            self.versions[record['key']] = record.get('version', VERSION_ZERO)
+            self.tombstones.pop(record['key'], None)
+            if 'expires' in record:
+                self.expiries[record['key']] = record['expires']
+            else:
+                self.expiries.pop(record['key'], None)
+        elif op in ('delete', 'tombstone'):
+            self.data.pop(record['key'], None)
+            self.expiries.pop(record['key'], None)
+            self.versions.pop(record['key'], None)
+            self.tombstones.pop(record['key'], None)
+            if op == 'tombstone':
+                self.tombstones[record['key']] = record['version']
+        elif op == 'clear':
+            self.data.clear()
+            self.expiries.clear()
+            self.versions.clear()
+            self.tombstones.clear()
+        elif op == 'clock':
+            vector_clock = state['vector_clock']
+            vector_clock[record['address']] = max(vector_clock.get(record['address'], 0), record['entry'])
+        elif op == 'vector_clock':
+            state['vector_clock'] = record['vector_clock']
+            state['delivery_buffer'] = []
+        elif op == 'buffer':
+            state['delivery_buffer'].append(record['message'])
+
+    def snapshot(self):
+        # Start a new log, then write everything up to it to the snapshot.
+        with self.lock:
+            self.sync()
+            self.wal.close()
+            snapshot = dict(
+                self.get_state(),
+                store=self.data.copy(),
+                expiries=dict(self.expiries),
+                versions=dict(self.versions),
+                tombstones=dict(self.tombstones),
+                generation=self.generation + 1
+            )
+            self.generation += 1
+            self.wal = open(self.wal_path(self.generation), 'a')
+            self.records = 0
+
+        snapshot_path = os.path.join(self.data_dir, SNAPSHOT_FILENAME)
+        with open(snapshot_path + '.tmp', 'w') as f:
+            write_snapshot(f, snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(snapshot_path + '.tmp', snapshot_path)
+
+        for generation in self.wal_generations():
+            if generation < snapshot['generation']:
+                os.remove(self.wal_path(generation))
+
+    def run_snapshots(self):
+        last_snapshot = time.time()
+        while True:
+            time.sleep(1)
+            elapsed = time.time() - last_snapshot
+            if self.records >= SNAPSHOT_MIN_RECORDS or (self.records > 0 and elapsed >= SNAPSHOT_INTERVAL):
+                self.snapshot()
+                last_snapshot = time.time()
+
+    def run_fsync(self):
+        while True:
+            time.sleep(WAL_FSYNC_INTERVAL)
+            with self.lock:
+                self.sync()
+
+    def start(self, get_state):
+        self.get_state = get_state
+        if self.wal is None:
+            self.recover()
+        threading.Thread(target=self.run_snapshots, daemon=True).start()
+        if self.fsync == 'interval':
+            threading.Thread(target=self.run_fsync, daemon=True).start()
+
+
+def open_storage_engine():
+    if STORAGE_ENGINE == 'memory':
+        return StorageEngine()
+    return WALStorageEngine()
@@ -0,0 +1,241 @@
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import json
+import metrics
+import os
+import sys
+import threading
+import zlib
+
+
+STORE_MEMORY_BUDGET = int(os.environ.get('STORE_MEMORY_BUDGET', 0)) # Bytes of values kept in memory, 0 to keep every value in memory as is.
+STORE_COMPRESS_THRESHOLD = int(os.environ.get('STORE_COMPRESS_THRESHOLD', 1024)) # Encoded values at least this long are compressed, 0 to never compress.
+SPILL_COMPACT_MIN_BYTES = 1 << 20 # Dead bytes in the spill log before rewriting it is worth it.
+ENTRY_OVERHEAD = 100 # Rough bytes of bookkeeping per value in memory, besides its key and bytes.
+RAW = b'j'
+COMPRESSED = b'z'
+
+value_reads = metrics.Counter('kvs_store_value_reads_total', 'Reads of values kept encoded, by whether they were in memory or on disk.', ['tier'])
+
+
+def encode(value, compress_threshold=STORE_COMPRESS_THRESHOLD):
+    raw = json.dumps(value, separators=(',', ':')).encode()
+    if compress_threshold > 0 and len(raw) >= compress_threshold:
+        compressed = zlib.compress(raw)
+        if len(compressed) < len(raw):
+            return COMPRESSED + compressed
+    return RAW + raw
+
+
+def decode(encoded):
+    if encoded[:1] == COMPRESSED:
+        return json.loads(zlib.decompress(encoded[1:]))
+    return json.loads(encoded[1:])
+
+
+class TieredDict(MutableMapping):
+    """
+    A dict of JSON values kept encoded, as compact JSON bytes compressed with
+    zlib from compress_threshold bytes on, which take a fraction of the
+    memory of the Python objects they decode to.
+
+    Values in memory are kept within budget bytes, counting their keys and
+    bookkeeping.  Past it, the least recently used ones are appended to a log
+    on disk, and moved back to memory when next read.  Only the keys and log
+    offsets of values on disk stay in memory.  Values overwritten, deleted or
+    read back leave dead bytes in the log, which is rewritten with only the
+    live ones once the dead ones outnumber them.
+
+    The log only holds what doesn't fit in memory: it's started afresh on
+    every boot, and the storage engine recovers the values from its own files.
+
+    Args:
+        spill_filename (str): The log's path, created on the first spill.
+        budget (int): Bytes of values kept in memory.
+    """
+
+    def __init__(self, spill_filename, budget=STORE_MEMORY_BUDGET, compress_threshold=STORE_COMPRESS_THRESHOLD):
+        self.spill_filename = spill_filename
+        self.budget = budget
+        self.compress_threshold = compress_threshold
+        self.hot = OrderedDict() # Key to its encoded value, least recently used first.
+        self.cold = {} # Key to the (offset, length) of its encoded value in the log.
+        self.memory = 0 # Bytes of the values in memory, per entry_size().
+        self.spill = None # The log, opened on the first spill.
+        self.end = 0 # Bytes written to the log.
+        self.live = 0 # Bytes of the log holding values in cold.
+        self.lock = threading.Lock()
+
+        self.hits = 0 # Reads of values in memory.
+        self.misses = 0 # Reads of values on disk.
+        self.spilled = 0
+        self.compactions = 0
+
+    def entry_size(self, key, encoded):
+        return sys.getsizeof(key) + sys.getsizeof(encoded) + ENTRY_OVERHEAD
+
+    def __len__(self):
+        return len(self.hot) + len(self.cold)
+
+    def __contains__(self, key):
+        return key in self.hot or key in self.cold
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.hot) + list(self.cold))
+
+    def read(self, key):
+        # The encoded value of key, wherever it is.  Caller holds the lock.
+        encoded = self.hot.get(key)
+        if encoded is not None:
+            return encoded
+        offset, length = self.cold[key]
+        return os.pread(self.spill.fileno(), length, offset)
+
+    def __getitem__(self, key):
+        with self.lock:
+            encoded = self.hot.get(key)
+            if encoded is not None:
+                self.hot.move_to_end(key)
+                self.hits += 1
+                value_reads.inc('memory')
+            else:
+                encoded = self.read(key)
+                self.discard(key)
+                self.insert(key, encoded)
+                self.misses += 1
+                value_reads.inc('disk')
+        return decode(encoded)
+
+    def __setitem__(self, key, value):
+        encoded = encode(value, self.compress_threshold)
+        with self.lock:
+            self.discard(key)
+            self.insert(key, encoded)
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self:
+                raise KeyError(key)
+            self.discard(key)
+
+    def pop(self, key, *default):
+        with self.lock:
+            if key not in self:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            encoded = self.read(key)
+            self.discard(key)
+        return decode(encoded)
+
+    def insert(self, key, encoded):
+        # Caller holds the lock.
+        self.hot[key] = encoded
+        self.memory += self.entry_size(key, encoded)
+        self.evict()
+
+    def discard(self, key):
+        # Caller holds the lock.
+        encoded = self.hot.pop(key, None)
+        if encoded is not None:
+            self.memory -= self.entry_size(key, encoded)
+        elif key in self.cold:
+            self.live -= self.cold.pop(key)[1]
+            if self.end - self.live > max(self.live, SPILL_COMPACT_MIN_BYTES):
+                self.compact()
+
+    def evict(self):
+        # Appends the least recently used values to the log until the rest
+        # fit in the budget.  Caller holds the lock.
+        while self.memory > self.budget and self.hot:
+            key, encoded = self.hot.popitem(last=False)
+            self.memory -= self.entry_size(key, encoded)
+            if self.spill is None:
+                self.open_spill()
+            os.pwrite(self.spill.fileno(), encoded, self.end)
+            self.cold[key] = (self.end, len(encoded))
+            self.end += len(encoded)
+            self.live += len(encoded)
+            self.spilled += 1
+
+    def open_spill(self):
+        # Always a new file, as copies may still read the previous one.
+        os.makedirs(os.path.dirname(self.spill_filename) or '.', exist_ok=True)
+        if os.path.exists(self.spill_filename):
+            os.remove(self.spill_filename)
+        self.spill = open(self.spill_filename, 'w+b')
+        self.end = 0
+
+    def compact(self):
+        # Rewrites the live values to a new log.  Caller holds the lock.
+        compacted = open(self.spill_filename + '.tmp', 'w+b')
+        end = 0
+        for key, (offset, length) in self.cold.items():
+            compacted.write(os.pread(self.spill.fileno(), length, offset))
+            self.cold[key] = (end, length)
+            end += length
+        compacted.flush()
+        os.replace(self.spill_filename + '.tmp', self.spill_filename)
+        self.spill = compacted
+        self.end = self.live = end
+        self.compactions += 1
+
+    def clear(self):
+        with self.lock:
+            self.hot.clear()
+            self.cold.clear()
+            self.memory = 0
+            self.live = 0
+            self.spill = None # The next spill starts a new log.
+            self.end = 0
+
+    def items(self):
+        """
+        Returns:
+            generator: Every key and value as of now, without changing
+                       which values are in memory.
+        """
+        with self.lock:
+            hot = list(self.hot.items())
+            cold = sorted(self.cold.items(), key=lambda item: item[1][0]) # In log order.
+            spill = self.spill
+        return self.decoded(hot, cold, spill)
+
+    def decoded(self, hot, cold, spill):
+        # The log we read from is never written again at those offsets:
+        # compacting or clearing starts a new one.
+        for key, encoded in hot:
+            yield key, decode(encoded)
+        for key, (offset, length) in cold:
+            yield key, decode(os.pread(spill.fileno(), length, offset))
+
+    def copy(self):
+        """
+        Returns:
+            TieredDict: A copy to read from while this one keeps changing,
+                        sharing its log.  It mustn't be written to.
+        """
+        with self.lock:
+            copy = TieredDict(self.spill_filename, self.budget, self.compress_threshold)
+            copy.hot = OrderedDict(self.hot)
+            copy.cold = dict(self.cold)
+            copy.spill = self.spill
+            return copy
+
+    def stats(self):
+        with self.lock:
+            reads = self.hits + self.misses
+            return {
+                'memory_budget': self.budget,
+                'memory_bytes': self.memory,
+                'memory_keys': len(self.hot),
+                'disk_keys': len(self.cold),
+                'disk_bytes': self.end,
+                'disk_live_bytes': self.live,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / reads if reads else 0,
+                'spilled': self.spilled,
+                'compactions': self.compactions
+            }
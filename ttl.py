@@ -0,0 +1,102 @@
+import os
+
+
+TTL_TICK = float(os.environ.get('TTL_TICK', 0.1)) # Seconds per tick of the timer wheel, the granularity of expiry.
+TTL_SWEEP_INTERVAL = float(os.environ.get('TTL_SWEEP_INTERVAL', 1)) # Seconds between background sweeps of expired keys.
+TTL_SWEEP_BATCH = int(os.environ.get('TTL_SWEEP_BATCH', 1000)) # Keys reclaimed per sweep before letting requests in.
+WHEEL_BITS = 6 # 64 slots per level.
+WHEEL_LEVELS = 6 # 64 ** 6 ticks, about 2000 years at the default tick.
+
+
+class TimerWheel:
+    """
+    Hierarchical hashed timer wheel of key deadlines.
+
+    Level 0 has a slot per tick for the next 64 ticks, level 1 a slot per 64
+    ticks for the next 64 ** 2, and so on.  Scheduling appends to one slot,
+    in O(1).  When the wheel turns past the start of a higher level slot,
+    its deadlines move down to lower levels, so each is moved at most once
+    per level, and reaching a level 0 slot makes its deadlines due.  Nothing
+    is ever scanned for deadlines that aren't due.
+
+    Rescheduling a key doesn't remove its earlier deadline: the caller checks
+    due deadlines against the key's current one, and ignores stale ones.
+
+    Args:
+        now (float): The time to start turning from, in seconds.
+    """
+
+    def __init__(self, now, tick=TTL_TICK, bits=WHEEL_BITS, levels=WHEEL_LEVELS):
+        self.tick = tick
+        self.bits = bits
+        self.levels = levels
+        self.mask = (1 << bits) - 1
+        self.current = int(now / tick) - 1 # Last tick turned to, which has fully passed.
+        self.slots = [[[] for _ in range(1 << bits)] for _ in range(levels)]
+        self.due = [] # (key, deadline) pairs whose deadline passed.
+        self.scheduled = 0 # Deadlines in the slots, not yet due.
+
+    def __len__(self):
+        return self.scheduled + len(self.due)
+
+    def schedule(self, key, deadline):
+        self.insert(key, deadline, int(deadline / self.tick))
+
+    def insert(self, key, deadline, tick):
+        delta = tick - self.current
+        if delta <= 0:
+            self.due.append((key, deadline))
+            return
+        self.scheduled += 1
+        for level in range(self.levels):
+            if delta >> (self.bits * (level + 1)) == 0:
+                self.slots[level][(tick >> (self.bits * level)) & self.mask].append((key, deadline))
+                return
+        # Further than the wheel reaches: park it in the top slot turned to
+        # last, and place it again from there.
+        level = self.levels - 1
+        self.slots[level][((self.current >> (self.bits * level)) - 1) & self.mask].append((key, deadline))
+
+    def advance(self, now):
+        """
+        Turns the wheel to the last tick that fully passed by now, making the
+        deadlines up to it due.  Every due deadline has passed, then.
+        """
+        target = int(now / self.tick) - 1
+        if not self.scheduled:
+            self.current = max(self.current, target)
+            return
+        while self.current < target:
+            # Skip the empty level 0 slots before the next level 1 slot starts.
+            stop = min(target, ((self.current >> self.bits) + 1) << self.bits)
+            tick = self.current + 1
+            while tick < stop and not self.slots[0][tick & self.mask]:
+                tick += 1
+            self.current = tick
+            # Move down the higher level slots that start at this tick, the highest first.
+            level = 1
+            while level < self.levels and self.current & ((1 << (self.bits * level)) - 1) == 0:
+                level += 1
+            for cascading in range(level - 1, 0, -1):
+                slot = (self.current >> (self.bits * cascading)) & self.mask
+                entries, self.slots[cascading][slot] = self.slots[cascading][slot], []
+                self.scheduled -= len(entries)
+                for key, deadline in entries:
+                    self.insert(key, deadline, int(deadline / self.tick))
+            slot = self.current & self.mask
+            if self.slots[0][slot]:
+                entries, self.slots[0][slot] = self.slots[0][slot], []
+                self.scheduled -= len(entries)
+                self.due.extend(entries)
+            if not self.scheduled:
+                self.current = target
+
+    def pop_due(self, now, limit):
+        """
+        Returns:
+            list: Up to limit (key, deadline) pairs whose deadline passed by now.
+        """
+        self.advance(now)
+        due = self.due[-limit:]
+        del self.due[-limit:]
+        return due
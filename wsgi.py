@@ -0,0 +1,6 @@
+from kvs import app, startup
+
+# Entry point for WSGI servers that keep connections alive between requests,
+# which Flask's development server doesn't.  Run with a single worker process,
+# since all node state lives in kvs's globals.
+startup()